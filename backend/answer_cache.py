@@ -0,0 +1,121 @@
+"""Per-class semantic cache of first-turn study-buddy answers.
+
+Before a class's exam, many students open a conversation with nearly the same
+question. A first-turn prompt holds only the system prompt, the class context and
+the question, and that context is the same for every member. So the answer to
+one student's question can be served to the next student whose question embeds
+within ANSWER_CACHE_MIN_SIMILARITY (cosine) of it.
+
+Each class holds up to ANSWER_CACHE_PER_CLASS answers as rows of one matrix, so a
+lookup is a single matrix-vector product. Entries expire after
+ANSWER_CACHE_TTL_SECONDS. A full class replaces an expired row first, otherwise
+its least recently served one. Classes themselves are LRU-bounded. Writes that
+change class content call `invalidate`, so answers never outlive the material
+they were grounded in. The cache is per process.
+"""
+import os
+import time
+from typing import Dict, Optional
+
+import numpy as np
+
+from caches import TTLCache
+
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_PER_CLASS = int(os.getenv("ANSWER_CACHE_PER_CLASS", "256"))
+ANSWER_CACHE_CLASSES = int(os.getenv("ANSWER_CACHE_CLASSES", "256"))
+ANSWER_CACHE_MIN_SIMILARITY = float(os.getenv("ANSWER_CACHE_MIN_SIMILARITY", "0.9"))
+
+
+class _ClassAnswers:
+    def __init__(self, dim: int):
+        self.vectors = np.zeros((ANSWER_CACHE_PER_CLASS, dim), dtype=np.float32)
+        self.expires_at = np.zeros(ANSWER_CACHE_PER_CLASS)  # 0 marks a free row
+        self.last_used = np.zeros(ANSWER_CACHE_PER_CLASS)
+        self.answers = [None] * ANSWER_CACHE_PER_CLASS
+        self.latencies = np.zeros(ANSWER_CACHE_PER_CLASS)
+
+    def best(self, vector: np.ndarray, now: float):
+        """(row, similarity) of the closest live answer, or (None, 0.0)"""
+        live = self.expires_at > now
+        if not live.any():
+            return None, 0.0
+        scores = np.where(live, self.vectors @ vector, -np.inf)
+        row = int(np.argmax(scores))
+        return row, float(scores[row])
+
+    def free_row(self, now: float):
+        """(row, replaced_live_entry): an empty or expired row, else the least recently served"""
+        dead = np.flatnonzero(self.expires_at <= now)
+        if len(dead):
+            return int(dead[0]), False
+        return int(np.argmin(self.last_used)), True
+
+
+class Lookup:
+    """Result of `SemanticAnswerCache.lookup`; pass it back to `store` on a miss"""
+    __slots__ = ("class_id", "vector", "generation", "answer")
+
+    def __init__(self, class_id: str, vector, generation: int, answer: Optional[str]):
+        self.class_id = class_id
+        self.vector = vector
+        self.generation = generation
+        self.answer = answer
+
+
+class SemanticAnswerCache:
+    def __init__(self, embedder):
+        self._embedder = embedder
+        self._classes = TTLCache("answer_cache_classes", maxsize=ANSWER_CACHE_CLASSES)
+        # Bumped by `invalidate` so an answer computed before a content change is not stored
+        self._generations: Dict[str, int] = {}
+        self._stats = {"lookups": 0, "hits": 0, "misses": 0, "stores": 0, "evictions": 0,
+                       "invalidations": 0, "saved_seconds": 0.0}
+
+    async def lookup(self, class_id: str, question: str) -> Lookup:
+        self._stats["lookups"] += 1
+        generation = self._generations.get(class_id, 0)
+        vector = (await self._embedder.embed([question]))[0]
+        answers = self._classes.get(class_id)
+        if answers is not None:
+            now = time.time()
+            row, similarity = answers.best(vector, now)
+            if row is not None and similarity >= ANSWER_CACHE_MIN_SIMILARITY:
+                answers.last_used[row] = now
+                self._stats["hits"] += 1
+                self._stats["saved_seconds"] += float(answers.latencies[row])
+                return Lookup(class_id, vector, generation, answers.answers[row])
+        self._stats["misses"] += 1
+        return Lookup(class_id, vector, generation, None)
+
+    def store(self, lookup: Lookup, answer: str, latency_seconds: float) -> None:
+        """Cache the answer to a missed lookup; `latency_seconds` is what a later hit saves"""
+        if not answer or lookup.generation != self._generations.get(lookup.class_id, 0):
+            return
+        answers = self._classes.get(lookup.class_id)
+        if answers is None:
+            answers = _ClassAnswers(len(lookup.vector))
+            self._classes.set(lookup.class_id, answers)
+        now = time.time()
+        row, evicted = answers.free_row(now)
+        answers.vectors[row] = lookup.vector
+        answers.expires_at[row] = now + ANSWER_CACHE_TTL_SECONDS
+        answers.last_used[row] = now
+        answers.answers[row] = answer
+        answers.latencies[row] = latency_seconds
+        self._stats["stores"] += 1
+        self._stats["evictions"] += int(evicted)
+
+    def invalidate(self, class_id: str) -> None:
+        self._generations[class_id] = self._generations.get(class_id, 0) + 1
+        self._stats["invalidations"] += 1
+        self._classes.pop(class_id)
+
+    def stats(self) -> dict:
+        lookups = self._stats["lookups"]
+        return {
+            **self._stats,
+            "saved_seconds": round(self._stats["saved_seconds"], 3),
+            "hit_ratio": round(self._stats["hits"] / lookups, 4) if lookups else 0.0,
+            "classes": len(self._classes),
+        }
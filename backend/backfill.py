@@ -0,0 +1,93 @@
+"""One-off data backfills for denormalized fields.
+
+Run from the backend directory with the same credentials as the API:
+
+    python backfill.py post-counters            # every class
+    python backfill.py post-counters --class-id <class_id>
+    python backfill.py class-search-index
+"""
+import argparse
+import asyncio
+
+from main import db, class_search_fields
+
+
+async def backfill_post_counters(class_id: str = None):
+    """Recompute score/upvotes/downvotes/comment_count/author_name on every post"""
+    if class_id:
+        class_refs = [db.collection("classes").document(class_id)]
+    else:
+        class_refs = [doc.reference async for doc in db.collection("classes").stream()]
+
+    author_names = {}
+    updated = 0
+    for class_ref in class_refs:
+        async for post_doc in class_ref.collection("posts").stream():
+            post_data = post_doc.to_dict()
+
+            upvotes = downvotes = 0
+            async for vote_doc in post_doc.reference.collection("votes").stream():
+                value = vote_doc.get("value")
+                if value == 1:
+                    upvotes += 1
+                elif value == -1:
+                    downvotes += 1
+
+            count_result = await post_doc.reference.collection("comments").count().get()
+            comment_count = count_result[0][0].value
+
+            author_id = post_data.get("authorId", "")
+            if author_id not in author_names:
+                author_doc = await db.collection("users").document(author_id).get() if author_id else None
+                author_names[author_id] = (author_doc.get("full_name") if author_doc and author_doc.exists else None) or "Unknown"
+
+            await post_doc.reference.update({
+                "score": upvotes - downvotes,
+                "upvotes": upvotes,
+                "downvotes": downvotes,
+                "comment_count": comment_count,
+                "author_name": author_names[author_id],
+            })
+            updated += 1
+
+    print(f"✅ Backfilled counters on {updated} posts across {len(class_refs)} classes")
+
+
+async def backfill_class_search_index():
+    """Populate teacher_name and search_tokens on every class"""
+    teacher_names = {}
+    updated = 0
+    async for class_doc in db.collection("classes").stream():
+        class_data = class_doc.to_dict()
+        teacher_id = class_data.get("teacher_id") or class_data.get("createdBy") or ""
+        if teacher_id not in teacher_names:
+            teacher_doc = await db.collection("users").document(teacher_id).get() if teacher_id else None
+            teacher_names[teacher_id] = (teacher_doc.get("full_name") if teacher_doc and teacher_doc.exists else None) or ""
+
+        await class_doc.reference.update({
+            "teacher_id": teacher_id,
+            **class_search_fields(class_data.get("name") or "", teacher_names[teacher_id]),
+        })
+        updated += 1
+
+    print(f"✅ Indexed {updated} classes for search")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    post_counters = commands.add_parser("post-counters", help="denormalize vote/comment counts and author names onto posts")
+    post_counters.add_argument("--class-id", help="limit the backfill to one class")
+
+    commands.add_parser("class-search-index", help="denormalize teacher names and search tokens onto classes")
+
+    args = parser.parse_args()
+    if args.command == "post-counters":
+        asyncio.run(backfill_post_counters(args.class_id))
+    elif args.command == "class-search-index":
+        asyncio.run(backfill_class_search_index())
+
+
+if __name__ == "__main__":
+    main()
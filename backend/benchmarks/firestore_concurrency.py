@@ -0,0 +1,80 @@
+"""Concurrency benchmark: blocking vs async Firestore client inside async handlers.
+
+Runs against the Firestore emulator so it never touches production data:
+
+    firebase emulators:start --only firestore
+    export FIRESTORE_EMULATOR_HOST=127.0.0.1:8080
+    python benchmarks/firestore_concurrency.py --requests 2000 --concurrency 1 8 32 64
+
+"before" mirrors the old handlers (sync `firestore.Client` called from an
+`async def`, blocking the loop); "after" mirrors the current handlers
+(`AsyncClient`, every round-trip awaited). Each simulated request does the
+same work as a typical class endpoint: a membership read plus a class read.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from google.cloud import firestore
+
+PROJECT = os.getenv("FIREBASE_PROJECT_ID", "demo-synapse-bench")
+CLASS_ID = "bench_class"
+USER_ID = "bench_user"
+
+
+def seed(client):
+    client.collection("classes").document(CLASS_ID).set({"name": "Bench 101", "code": "BENCH1"})
+    client.collection("classMembers").document(f"{CLASS_ID}_{USER_ID}").set(
+        {"classId": CLASS_ID, "userId": USER_ID, "role": "student"}
+    )
+
+
+async def run_blocking_handlers(client, total, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def handler():
+        async with sem:
+            client.collection("classMembers").document(f"{CLASS_ID}_{USER_ID}").get()
+            client.collection("classes").document(CLASS_ID).get()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(handler() for _ in range(total)))
+    return total / (time.perf_counter() - start)
+
+
+async def run_async_handlers(client, total, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def handler():
+        async with sem:
+            await client.collection("classMembers").document(f"{CLASS_ID}_{USER_ID}").get()
+            await client.collection("classes").document(CLASS_ID).get()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(handler() for _ in range(total)))
+    return total / (time.perf_counter() - start)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 64])
+    args = parser.parse_args()
+
+    if not os.getenv("FIRESTORE_EMULATOR_HOST"):
+        raise SystemExit("FIRESTORE_EMULATOR_HOST is not set; refusing to benchmark a real project")
+
+    sync_client = firestore.Client(project=PROJECT)
+    async_client = firestore.AsyncClient(project=PROJECT)
+    seed(sync_client)
+
+    print(f"{'concurrency':>12} {'before req/s':>14} {'after req/s':>13} {'speedup':>9}")
+    for concurrency in args.concurrency:
+        before = await run_blocking_handlers(sync_client, args.requests, concurrency)
+        after = await run_async_handlers(async_client, args.requests, concurrency)
+        print(f"{concurrency:>12} {before:>14.1f} {after:>13.1f} {after / before:>8.2f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
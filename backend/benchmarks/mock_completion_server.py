@@ -0,0 +1,133 @@
+"""Local mock of the OpenAI chat completions endpoint with injectable latency and errors.
+
+    python benchmarks/mock_completion_server.py --port 8090 --latency 1.5 --jitter 0.5 \\
+        --token-latency 0.05 --error-rate 0.1 --rate-limit-rate 0.1
+
+    export OPENAI_API_URL=http://127.0.0.1:8090/v1/chat/completions
+    python main.py
+
+Every request sleeps for `latency +/- jitter` seconds, then fails with a 429
+(with Retry-After) or a 503 at the configured rates, otherwise returns a
+well-formed completion, or an SSE token stream when `"stream": true`.
+Summary-style requests get a JSON body matching SUMMARY_SYSTEM_PROMPT so the
+notes endpoints can be exercised end to end.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MOCK_SUMMARY = {
+    "key_concepts": ["Mock concept A", "Mock concept B", "Mock concept C"],
+    "main_points": ["Mock point 1", "Mock point 2", "Mock point 3"],
+    "study_tips": ["Mock tip 1", "Mock tip 2", "Mock tip 3"],
+    "questions_for_review": ["Mock question 1?", "Mock question 2?", "Mock question 3?"],
+    "difficulty_level": "intermediate",
+    "estimated_study_time": "30 minutes",
+    "title": "Mock Summary",
+}
+
+stats = {"requests": 0, "errors": 0, "rate_limited": 0}
+stats_lock = threading.Lock()
+
+
+def build_reply(payload):
+    system = next((m.get("content", "") for m in payload.get("messages", []) if m.get("role") == "system"), "")
+    if isinstance(system, str) and "JSON" in system:
+        return json.dumps(MOCK_SUMMARY)
+    return "What do you already know about this topic? Let's break it into smaller parts."
+
+
+class MockCompletionHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, payload, opts):
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for word in build_reply(payload).split(" "):
+            chunk = {"choices": [{"index": 0, "delta": {"content": word + " "}}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(opts.token_latency)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        opts = self.server.options
+
+        with stats_lock:
+            stats["requests"] += 1
+
+        time.sleep(max(0.0, opts.latency + random.uniform(-opts.jitter, opts.jitter)))
+
+        roll = random.random()
+        if roll < opts.rate_limit_rate:
+            with stats_lock:
+                stats["rate_limited"] += 1
+            self._send_json(429, {"error": {"message": "Rate limit reached"}}, {"Retry-After": "1"})
+            return
+        if roll < opts.rate_limit_rate + opts.error_rate:
+            with stats_lock:
+                stats["errors"] += 1
+            self._send_json(503, {"error": {"message": "Injected upstream failure"}})
+            return
+
+        if payload.get("stream"):
+            self._send_stream(payload, opts)
+            return
+
+        self._send_json(200, {
+            "id": f"chatcmpl-mock-{stats['requests']}",
+            "object": "chat.completion",
+            "model": payload.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": build_reply(payload)},
+                "finish_reason": "stop",
+            }],
+        })
+
+    def do_GET(self):
+        with stats_lock:
+            self._send_json(200, dict(stats))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=1.0, help="base response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2, help="+/- seconds added to latency")
+    parser.add_argument("--token-latency", type=float, default=0.05, help="delay between streamed tokens")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    options = parser.parse_args()
+
+    server = ThreadingHTTPServer((options.host, options.port), MockCompletionHandler)
+    server.options = options
+    print(f"Mock completion server on http://{options.host}:{options.port}/v1/chat/completions (GET / for stats)")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
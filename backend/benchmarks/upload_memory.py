@@ -0,0 +1,79 @@
+"""Memory benchmark: whole-file read + base64 vs the spooled, chunked upload stage.
+
+    python benchmarks/upload_memory.py --sizes-mb 1 5 20
+
+Each upload is a Starlette UploadFile over a SpooledTemporaryFile, exactly as the
+multipart parser hands it to a handler. "before" mirrors the old image path
+(`file.file.read()` then `b64encode(...).decode()`); "after" is
+`SpooledUpload.data_url()`. Peak Python allocations are measured with
+tracemalloc and reported as a multiple of the file size. The finished data URL
+(~1.33x) has to exist to build the request, so "after" peaks while the encoded
+chunks are joined into it; the raw file bytes are never held in memory at once.
+"""
+import argparse
+import asyncio
+import base64
+import os
+import sys
+import tracemalloc
+from tempfile import SpooledTemporaryFile
+
+from starlette.datastructures import UploadFile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from uploads import spool_uploads  # noqa: E402
+
+STARLETTE_SPOOL_BYTES = 1024 * 1024
+
+
+def make_upload(size: int) -> UploadFile:
+    spool = SpooledTemporaryFile(max_size=STARLETTE_SPOOL_BYTES)
+    block = os.urandom(1024 * 1024)
+    remaining = size
+    while remaining:
+        chunk = block[:min(remaining, len(block))]
+        spool.write(chunk)
+        remaining -= len(chunk)
+    spool.seek(0)
+    return UploadFile(file=spool, filename="bench.png")
+
+
+async def before(upload: UploadFile) -> int:
+    image_bytes = upload.file.read()
+    base64_image = base64.b64encode(image_bytes).decode("utf-8")
+    return len(f"data:image/png;base64,{base64_image}")
+
+
+async def after(upload: UploadFile) -> int:
+    (spooled,) = await spool_uploads([upload])
+    return len(await spooled.data_url("image/png"))
+
+
+async def measure(fn, size: int) -> int:
+    upload = make_upload(size)
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    await fn(upload)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    upload.file.close()
+    return peak
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes-mb", type=float, nargs="+", default=[1, 5, 20])
+    args = parser.parse_args()
+
+    print(f"{'size MB':>8} {'before peak MB':>15} {'after peak MB':>14} {'before x':>9} {'after x':>8}")
+    for size_mb in args.sizes_mb:
+        size = int(size_mb * 1024 * 1024)
+        peak_before = await measure(before, size)
+        peak_after = await measure(after, size)
+        print(f"{size_mb:>8.1f} {peak_before / 2**20:>15.1f} {peak_after / 2**20:>14.1f} "
+              f"{peak_before / size:>9.2f} {peak_after / size:>8.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
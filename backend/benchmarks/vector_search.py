@@ -0,0 +1,87 @@
+"""Latency benchmark: top-k search over one class's vector index.
+
+    python benchmarks/vector_search.py --chunks 50000 --k 5
+
+Builds a throwaway index of random unit vectors (EMBEDDING_DIM wide) in a temp
+directory with the same append path the API uses, reopens it from disk, then
+times ClassIndex.search alone and together with reading the k hit chunks back.
+Query embedding is timed separately for the local hash embedder.
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embeddings import EMBEDDING_DIM, HashEmbedder  # noqa: E402
+from vector_index import ClassIndex  # noqa: E402
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=50000)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=500)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    directory = tempfile.mkdtemp(prefix="vector_bench_")
+    try:
+        index = ClassIndex(directory, EMBEDDING_DIM, "bench")
+        for start in range(0, args.chunks, 5000):
+            rows = min(5000, args.chunks - start)
+            vectors = rng.standard_normal((rows, EMBEDDING_DIM), dtype=np.float32)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            chunks = [(f"post:{start + i}", f"chunk {start + i} " + "lorem ipsum " * 60) for i in range(rows)]
+            index.append(chunks, vectors)
+
+        index = ClassIndex(directory, EMBEDDING_DIM, "bench")
+        started = time.perf_counter()
+        index.load()
+        load_ms = (time.perf_counter() - started) * 1000
+
+        queries = rng.standard_normal((args.queries, EMBEDDING_DIM), dtype=np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        index.search(queries[0], args.k)
+
+        search_timings, timings = [], []
+        for query in queries:
+            started = time.perf_counter()
+            hits = index.search(query, args.k)
+            searched = time.perf_counter()
+            chunks = index.chunks([row for _, row in hits])
+            finished = time.perf_counter()
+            search_timings.append((searched - started) * 1000)
+            timings.append((finished - started) * 1000)
+        assert len(chunks) == args.k
+
+        embedder = HashEmbedder()
+        question = "How does the Krebs cycle produce ATP and NADH in the mitochondria?"
+        embed_timings = []
+        for _ in range(200):
+            started = time.perf_counter()
+            embedder.embed_sync([question])
+            embed_timings.append((time.perf_counter() - started) * 1000)
+
+        print(f"chunks={args.chunks} dim={EMBEDDING_DIM} k={args.k} "
+              f"index={os.path.getsize(os.path.join(directory, 'vectors.f32')) / 2**20:.1f} MB load={load_ms:.0f} ms")
+        print(f"search        p50={statistics.median(search_timings):.2f} ms  p99={percentile(search_timings, 0.99):.2f} ms")
+        print(f"search+fetch  p50={statistics.median(timings):.2f} ms  p99={percentile(timings, 0.99):.2f} ms")
+        print(f"hash embed    p50={statistics.median(embed_timings):.3f} ms")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
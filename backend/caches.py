@@ -0,0 +1,99 @@
+"""In-process caches with LRU bounds, per-entry expiry and hit/eviction counters.
+
+Each cache registers itself by name so `/api/v1/metrics/caches` can report
+every cache in the process. Caches are per worker process; anything that must
+be shared across instances belongs in Firestore instead.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+_MISSING = object()
+
+_registry: Dict[str, Any] = {}
+
+
+class TTLCache:
+    """Bounded LRU mapping whose entries expire at an absolute wall-clock time."""
+
+    def __init__(self, name: str, maxsize: int, ttl_seconds: Optional[float] = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "purged": 0}
+        register_cache(name, self)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                self._stats["misses"] += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._entries[key]
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return default
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, expires_at: Optional[float] = None) -> None:
+        """Store `value`; expiry is the earlier of `expires_at` and now + ttl_seconds"""
+        if self.ttl_seconds is not None:
+            ttl_expiry = time.time() + self.ttl_seconds
+            expires_at = ttl_expiry if expires_at is None else min(expires_at, ttl_expiry)
+        if self.maxsize <= 0 or (expires_at is not None and expires_at <= time.time()):
+            return
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            if self._entries.pop(key, _MISSING) is not _MISSING:
+                self._stats["purged"] += 1
+
+    def purge(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        """Drop every entry for which predicate(key, value) is true; returns the count"""
+        with self._lock:
+            doomed = [key for key, (value, _) in self._entries.items() if predicate(key, value)]
+            for key in doomed:
+                del self._entries[key]
+            self._stats["purged"] += len(doomed)
+            return len(doomed)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._stats["purged"] += len(self._entries)
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else None,
+            }
+
+
+def register_cache(name: str, cache) -> None:
+    """Report another cache-like object (anything with `stats()`) under `name`"""
+    _registry[name] = cache
+
+
+def cache_stats() -> Dict[str, dict]:
+    """Snapshot of every registered cache, keyed by name"""
+    return {name: cache.stats() for name, cache in _registry.items()}
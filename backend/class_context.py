@@ -0,0 +1,192 @@
+"""Class context for study-buddy prompts, cached per class and ranked per question.
+
+The first turn that needs a class builds a small corpus from Firestore: the class
+name, its most recent posts (title, body, tags and a few comments from the
+newest ones) and its most recent note summaries. The corpus is cached in memory,
+so later turns pay no Firestore reads for context. Each turn picks the items most
+relevant to the student's message (BM25 over the item text, newest first when
+nothing matches) and renders them into a block of at most CLASS_CONTEXT_TOKENS.
+
+Writers that change what the corpus holds (new posts, comments, note summaries,
+class deletion) call `invalidate`. The cache is per process, so other instances
+see such changes once their entry expires (CLASS_CONTEXT_TTL_SECONDS).
+"""
+import asyncio
+import math
+import os
+import re
+from collections import Counter
+from typing import Dict, List, Optional
+
+from firebase_admin import firestore
+
+import token_budget
+from caches import TTLCache
+
+CLASS_CONTEXT_TTL_SECONDS = float(os.getenv("CLASS_CONTEXT_TTL_SECONDS", "300"))
+CLASS_CONTEXT_CACHE_SIZE = int(os.getenv("CLASS_CONTEXT_CACHE_SIZE", "512"))
+CLASS_CONTEXT_TOKENS = int(os.getenv("CLASS_CONTEXT_TOKENS", "600"))
+CLASS_CONTEXT_MAX_POSTS = int(os.getenv("CLASS_CONTEXT_MAX_POSTS", "50"))
+CLASS_CONTEXT_MAX_SUMMARIES = int(os.getenv("CLASS_CONTEXT_MAX_SUMMARIES", "20"))
+# Comments are read for the newest posts only, a few per post
+CLASS_CONTEXT_COMMENTED_POSTS = int(os.getenv("CLASS_CONTEXT_COMMENTED_POSTS", "10"))
+CLASS_CONTEXT_COMMENTS_PER_POST = int(os.getenv("CLASS_CONTEXT_COMMENTS_PER_POST", "3"))
+# Longest text rendered for any one post or summary
+CLASS_CONTEXT_ITEM_TOKENS = int(os.getenv("CLASS_CONTEXT_ITEM_TOKENS", "150"))
+
+_WORD = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from how i if in is it its me my of on or so "
+    "that the their them then there these this to was what when where which who why will with "
+    "you your we our us help explain please understand about".split()
+)
+_BM25_K1 = 1.2
+_BM25_B = 0.75
+
+
+def terms(text: str) -> List[str]:
+    return [word for word in _WORD.findall((text or "").lower()) if len(word) > 1 and word not in _STOPWORDS]
+
+
+class _Item:
+    __slots__ = ("text", "term_counts", "length")
+
+    def __init__(self, text: str):
+        self.text = token_budget.truncate_to_tokens(text, CLASS_CONTEXT_ITEM_TOKENS)
+        words = terms(text)
+        self.term_counts = Counter(words)
+        self.length = len(words)
+
+
+class _Corpus:
+    """Posts and summaries of one class, newest first, with BM25 statistics"""
+
+    def __init__(self, class_name: str, items: List[_Item]):
+        self.class_name = class_name
+        self.items = items
+        self.average_length = (sum(item.length for item in items) / len(items)) if items else 0.0
+        document_frequency = Counter()
+        for item in items:
+            document_frequency.update(item.term_counts.keys())
+        self.idf = {
+            term: math.log(1 + (len(items) - count + 0.5) / (count + 0.5))
+            for term, count in document_frequency.items()
+        }
+
+    def score(self, item: _Item, query_terms: List[str]) -> float:
+        total = 0.0
+        norm = _BM25_K1 * (1 - _BM25_B + _BM25_B * item.length / (self.average_length or 1))
+        for term in query_terms:
+            tf = item.term_counts.get(term)
+            if tf:
+                total += self.idf[term] * tf * (_BM25_K1 + 1) / (tf + norm)
+        return total
+
+    def ranked(self, question: str) -> List[_Item]:
+        """Items matching the question by score, then the rest in recency order"""
+        query_terms = list(dict.fromkeys(terms(question)))
+        scored = [(self.score(item, query_terms), index, item) for index, item in enumerate(self.items)]
+        matching = sorted((entry for entry in scored if entry[0] > 0), key=lambda entry: (-entry[0], entry[1]))
+        rest = [entry for entry in scored if entry[0] <= 0]
+        return [item for _, _, item in matching + rest]
+
+
+def may_have_comments(post: dict) -> bool:
+    """False only when the post's comment counter says it has none.
+
+    Posts written before the denormalized counters have no `comment_count` (until
+    backfill.py runs), so a missing counter means "unknown" and comments are read.
+    Read it from `to_dict()`: DocumentSnapshot.get raises on a missing field.
+    """
+    return post.get("comment_count") != 0
+
+
+def _post_text(post: dict, comments: List[str]) -> str:
+    text = f"Post: {post.get('title', 'Untitled')} ({post.get('post_type', 'discussion')})"
+    if post.get("tags"):
+        text += f" [tags: {', '.join(post['tags'])}]"
+    if post.get("content"):
+        text += f" - {' '.join(post['content'].split())}"
+    if comments:
+        text += " | Replies: " + " / ".join(comments)
+    return text
+
+
+def _summary_text(summary: dict) -> str:
+    text = f"Note summary: {summary.get('title', 'Study Notes')}"
+    if summary.get("key_concepts"):
+        text += f" - key concepts: {', '.join(summary['key_concepts'])}"
+    if summary.get("main_points"):
+        text += f"; main points: {' '.join(summary['main_points'])}"
+    return text
+
+
+class ClassContextService:
+    def __init__(self, client):
+        self._client = client
+        self._corpora = TTLCache("class_context", maxsize=CLASS_CONTEXT_CACHE_SIZE, ttl_seconds=CLASS_CONTEXT_TTL_SECONDS)
+        # Bumped by `invalidate` so a build that raced a write is not cached
+        self._generations: Dict[str, int] = {}
+
+    async def _recent_comments(self, post_ref) -> List[str]:
+        query = (post_ref.collection("comments")
+                 .order_by("createdAt", direction=firestore.Query.DESCENDING)
+                 .limit(CLASS_CONTEXT_COMMENTS_PER_POST))
+        return [" ".join((doc.get("content") or "").split()) async for doc in query.stream()]
+
+    async def _build(self, class_id: str) -> Optional[_Corpus]:
+        class_ref = self._client.collection("classes").document(class_id)
+        class_doc = await class_ref.get()
+        if not class_doc.exists:
+            return None
+
+        posts_query = (class_ref.collection("posts")
+                       .order_by("createdAt", direction=firestore.Query.DESCENDING)
+                       .limit(CLASS_CONTEXT_MAX_POSTS))
+        summaries_query = (class_ref.collection("note_summaries")
+                           .order_by("created_at", direction=firestore.Query.DESCENDING)
+                           .limit(CLASS_CONTEXT_MAX_SUMMARIES))
+        post_docs, summary_docs = await asyncio.gather(
+            posts_query.get(), summaries_query.get()
+        )
+
+        commented = [doc for doc in post_docs[:CLASS_CONTEXT_COMMENTED_POSTS] if may_have_comments(doc.to_dict())]
+        comments = await asyncio.gather(*(self._recent_comments(doc.reference) for doc in commented))
+        comments_by_post = {doc.id: post_comments for doc, post_comments in zip(commented, comments)}
+
+        items = [_Item(_post_text(doc.to_dict(), comments_by_post.get(doc.id, []))) for doc in post_docs]
+        items += [_Item(_summary_text(doc.to_dict())) for doc in summary_docs]
+        return _Corpus(class_doc.to_dict().get("name") or "", items)
+
+    async def _corpus(self, class_id: str) -> Optional[_Corpus]:
+        corpus = self._corpora.get(class_id)
+        if corpus is None:
+            generation = self._generations.get(class_id, 0)
+            corpus = await self._build(class_id)
+            if corpus is not None and self._generations.get(class_id, 0) == generation:
+                self._corpora.set(class_id, corpus)
+        return corpus
+
+    async def context_for(self, class_id: str, question: str = "") -> str:
+        """Compact context block for one turn: the class name plus the most relevant items"""
+        corpus = await self._corpus(class_id)
+        if corpus is None:
+            return ""
+
+        lines = [f"Class: {corpus.class_name}"]
+        budget = CLASS_CONTEXT_TOKENS - token_budget.estimate_tokens(lines[0])
+        selected = []
+        for item in corpus.ranked(question):
+            cost = token_budget.estimate_tokens(item.text) + 1
+            if cost > budget:
+                continue
+            selected.append(item.text)
+            budget -= cost
+        if selected:
+            lines.append("Relevant class material:")
+            lines.extend(f"- {text}" for text in selected)
+        return "\n".join(lines)
+
+    def invalidate(self, class_id: str) -> None:
+        self._generations[class_id] = self._generations.get(class_id, 0) + 1
+        self._corpora.pop(class_id)
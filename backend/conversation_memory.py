@@ -0,0 +1,84 @@
+"""Token-budgeted study-buddy history.
+
+A conversation keeps a rolling `summary` of its oldest `summarized_count`
+messages (see conversations.py). Each turn works on the system prompt followed
+by the messages not yet summarized, and sends the summary plus as many of the
+newest of those as fit in STUDY_BUDDY_CONTEXT_TOKENS, so prompt size stays flat
+however long the conversation gets.
+
+Once the unsummarized messages older than the STUDY_BUDDY_RECENT_MESSAGES most
+recent ones reach STUDY_BUDDY_COMPACT_TOKENS, they are folded into the summary
+(see `pending_compaction`); the caller does that off the request path.
+"""
+import os
+from typing import Dict, List
+
+import token_budget
+
+STUDY_BUDDY_CONTEXT_TOKENS = int(os.getenv("STUDY_BUDDY_CONTEXT_TOKENS", "3000"))
+STUDY_BUDDY_RECENT_MESSAGES = int(os.getenv("STUDY_BUDDY_RECENT_MESSAGES", "6"))
+STUDY_BUDDY_COMPACT_TOKENS = int(os.getenv("STUDY_BUDDY_COMPACT_TOKENS", "800"))
+STUDY_BUDDY_SUMMARY_TOKENS = int(os.getenv("STUDY_BUDDY_SUMMARY_TOKENS", "400"))
+
+# Per-message framing overhead in the chat format, and the cost of one image at
+# the vision model's effective 768 px resolution (4 tiles + base)
+MESSAGE_OVERHEAD_TOKENS = 4
+IMAGE_TOKENS = 765
+
+
+def message_text(message: Dict) -> str:
+    """Text of a message, ignoring attached images"""
+    content = message.get("content") or ""
+    if isinstance(content, str):
+        return content
+    return "\n".join(part.get("text", "") for part in content if part.get("type") == "text")
+
+
+def message_tokens(message: Dict) -> int:
+    content = message.get("content") or ""
+    if isinstance(content, str):
+        return MESSAGE_OVERHEAD_TOKENS + token_budget.estimate_tokens(content)
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    for part in content:
+        if part.get("type") == "image_url":
+            tokens += IMAGE_TOKENS
+        else:
+            tokens += token_budget.estimate_tokens(part.get("text") or part.get("content") or "")
+    return tokens
+
+
+def context_window(messages: List[Dict], reserved_tokens: int) -> List[Dict]:
+    """Newest messages (after the system prompt) that fit the budget, oldest first.
+
+    `reserved_tokens` covers the system prompt, class context and summary. The
+    newest message is always included, even when it alone is over budget.
+    """
+    budget = STUDY_BUDDY_CONTEXT_TOKENS - reserved_tokens
+    window = []
+    for message in reversed(messages[1:]):
+        tokens = message_tokens(message)
+        if window and tokens > budget:
+            break
+        window.append(message)
+        budget -= tokens
+    window.reverse()
+    return window
+
+
+def pending_compaction(messages: List[Dict]) -> List[Dict]:
+    """Messages to fold into the summary now; empty until enough have piled up"""
+    pending = messages[1:len(messages) - STUDY_BUDDY_RECENT_MESSAGES]
+    if sum(message_tokens(message) for message in pending) < STUDY_BUDDY_COMPACT_TOKENS:
+        return []
+    return pending
+
+
+def summary_prompt(summary: str, messages: List[Dict]) -> str:
+    transcript = "\n".join(f"{message['role']}: {message_text(message)}" for message in messages)
+    previous = f"Summary so far:\n{summary}\n\n" if summary else ""
+    return (
+        f"{previous}New conversation turns:\n{transcript}\n\n"
+        "Update the summary of this tutoring conversation between a student and a study buddy. "
+        "Keep the topics covered, what the student understood or struggled with, and any open "
+        f"questions. Reply with the summary only, under {STUDY_BUDDY_SUMMARY_TOKENS * 3 // 4} words."
+    )
@@ -0,0 +1,130 @@
+"""Study-buddy conversation storage: a small parent doc plus append-only message docs.
+
+    ai_conversations/{id}                    conversation_id, user_id, class_id,
+                                             created_at, last_updated, preview,
+                                             message_count, summary, summarized_count
+    ai_conversations/{id}/messages/{seq}     seq, role, content, created_at
+
+`seq` counts non-system messages from 0 (the system prompt is not stored), and
+message doc IDs are the zero-padded seq so they sort in conversation order. A
+turn writes its messages and bumps the parent's counters in one transaction, so
+its cost does not depend on conversation length, and the conversation list only
+reads parent docs.
+
+Conversations written before this layout keep every message in a `messages`
+array on the parent; they are read as-is and moved into the subcollection on
+their next turn.
+"""
+import datetime
+import os
+from typing import Dict, List, Tuple
+
+from firebase_admin import firestore
+
+CONVERSATION_MAX_LOADED_MESSAGES = int(os.getenv("CONVERSATION_MAX_LOADED_MESSAGES", "50"))
+PREVIEW_CHARS = 100
+# Firestore caps a batch at 500 writes
+_BATCH_WRITES = 400
+
+
+def message_id(seq: int) -> str:
+    return f"{seq:08d}"
+
+
+def conversation_preview(messages: List[Dict]) -> str:
+    """First user message, shortened for the conversation list"""
+    for message in messages:
+        if message.get("role") == "user" and isinstance(message.get("content"), str):
+            return message["content"][:PREVIEW_CHARS] + "..."
+    return ""
+
+
+def _legacy_messages(conv_data: dict) -> List[Dict]:
+    return [m for m in conv_data.get("messages", []) if m.get("role") != "system"]
+
+
+@firestore.async_transactional
+async def _append(transaction, conv_ref, messages: List[Dict], fields: dict) -> int:
+    snapshot = await conv_ref.get(transaction=transaction)
+    data = snapshot.to_dict() if snapshot.exists else {}
+    seq = data.get("message_count", 0)
+    now = datetime.datetime.utcnow()
+
+    for offset, message in enumerate(messages):
+        transaction.set(conv_ref.collection("messages").document(message_id(seq + offset)), {
+            "seq": seq + offset,
+            "role": message["role"],
+            "content": message["content"],
+            "created_at": now,
+        })
+
+    parent = {**fields, "message_count": seq + len(messages), "last_updated": now}
+    if not data.get("preview"):
+        parent["preview"] = conversation_preview(messages)
+    transaction.set(conv_ref, parent, merge=True)
+    return seq
+
+
+class ConversationStore:
+    def __init__(self, client, collection: str = "ai_conversations"):
+        self._client = client
+        self._collection = collection
+
+    def ref(self, conversation_id: str):
+        return self._client.collection(self._collection).document(conversation_id)
+
+    async def load_unsummarized(self, conv_ref, conv_data: dict) -> Tuple[int, List[Dict]]:
+        """(seq of the first message, messages) not yet folded into the summary, oldest first.
+
+        At most the newest CONVERSATION_MAX_LOADED_MESSAGES are loaded.
+        """
+        summarized_count = conv_data.get("summarized_count", 0)
+        if "messages" in conv_data:
+            pending = _legacy_messages(conv_data)[summarized_count:]
+            skipped = max(0, len(pending) - CONVERSATION_MAX_LOADED_MESSAGES)
+            return summarized_count + skipped, pending[skipped:]
+
+        query = (conv_ref.collection("messages")
+                 .where("seq", ">=", summarized_count)
+                 .order_by("seq", direction=firestore.Query.DESCENDING)
+                 .limit(CONVERSATION_MAX_LOADED_MESSAGES))
+        docs = [doc async for doc in query.stream()]
+        docs.reverse()
+        first_seq = docs[0].get("seq") if docs else summarized_count
+        return first_seq, [{"role": doc.get("role"), "content": doc.get("content")} for doc in docs]
+
+    async def list_messages(self, conv_ref, conv_data: dict) -> List[Dict]:
+        """Full transcript for display: role, content and created_at (None for legacy messages)"""
+        if "messages" in conv_data:
+            return [{**m, "created_at": None} for m in _legacy_messages(conv_data)]
+        query = conv_ref.collection("messages").order_by("seq")
+        return [
+            {"role": doc.get("role"), "content": doc.get("content"), "created_at": doc.get("created_at")}
+            async for doc in query.stream()
+        ]
+
+    async def append(self, conv_ref, conv_data: dict, messages: List[Dict], fields: dict) -> int:
+        """Append messages and merge `fields` into the parent; returns the first new seq"""
+        if "messages" in conv_data:
+            await self._migrate(conv_ref, conv_data)
+        return await _append(self._client.transaction(), conv_ref, messages, fields)
+
+    async def _migrate(self, conv_ref, conv_data: dict) -> None:
+        """Move a legacy `messages` array into the subcollection (idempotent)"""
+        legacy = _legacy_messages(conv_data)
+        created_at = conv_data.get("last_updated") or datetime.datetime.utcnow()
+        for start in range(0, len(legacy), _BATCH_WRITES):
+            batch = self._client.batch()
+            for seq in range(start, min(start + _BATCH_WRITES, len(legacy))):
+                batch.set(conv_ref.collection("messages").document(message_id(seq)), {
+                    "seq": seq,
+                    "role": legacy[seq].get("role"),
+                    "content": legacy[seq].get("content"),
+                    "created_at": created_at,
+                })
+            await batch.commit()
+        await conv_ref.update({
+            "messages": firestore.DELETE_FIELD,
+            "message_count": len(legacy),
+            "preview": conversation_preview(legacy),
+        })
@@ -0,0 +1,42 @@
+"""Request-scoped batched document reads.
+
+Handlers collect every document they need for a response (authors, students,
+classes) and resolve them with a single `get_all` round trip instead of one
+`get()` per row. Snapshots are memoized by path for the lifetime of the
+loader, so an author who wrote ten comments is read once.
+"""
+from typing import Dict, Iterable
+
+# Keep each BatchGetDocuments request comfortably under Firestore's request size limits
+GET_ALL_CHUNK_SIZE = 500
+
+
+class DocumentLoader:
+    def __init__(self, client):
+        self._client = client
+        self._snapshots = {}
+
+    async def load_many(self, refs: Iterable) -> Dict[str, object]:
+        """Return {path: snapshot} for `refs`, fetching only paths not seen yet"""
+        refs = list(refs)
+        missing = {}
+        for ref in refs:
+            if ref.path not in self._snapshots:
+                missing[ref.path] = ref
+
+        pending = list(missing.values())
+        for start in range(0, len(pending), GET_ALL_CHUNK_SIZE):
+            async for snapshot in self._client.get_all(pending[start:start + GET_ALL_CHUNK_SIZE]):
+                self._snapshots[snapshot.reference.path] = snapshot
+
+        return {ref.path: self._snapshots.get(ref.path) for ref in refs}
+
+    async def load_data(self, collection: str, ids: Iterable[str]) -> Dict[str, dict]:
+        """Return {id: data} for the existing documents among `ids` in a top-level collection"""
+        unique_ids = [doc_id for doc_id in dict.fromkeys(ids) if doc_id]
+        snapshots = await self.load_many(self._client.collection(collection).document(doc_id) for doc_id in unique_ids)
+        return {
+            snapshot.id: snapshot.to_dict()
+            for snapshot in snapshots.values()
+            if snapshot is not None and snapshot.exists
+        }
@@ -0,0 +1,83 @@
+"""Text embedders for class-material retrieval.
+
+EMBEDDING_BACKEND selects the model:
+  * "hash" (default): a local feature-hashing embedder. Words and word bigrams are
+    hashed into EMBEDDING_DIM signed buckets and the vector is L2-normalized. It
+    needs no network or model download and captures lexical overlap only.
+  * "openai": the provider's embeddings endpoint (EMBEDDING_MODEL), truncated to
+    EMBEDDING_DIM dimensions by the API.
+
+Every embedder returns float32 rows with unit length, so a dot product is the
+cosine similarity. `model_id` is stored with each index so an index built by a
+different model or dimension is rebuilt rather than searched.
+"""
+import asyncio
+import hashlib
+import os
+import re
+from typing import List
+
+import numpy as np
+
+import llm_client
+
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "hash")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "256"))
+# Texts per provider request
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "128"))
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32, copy=False)
+
+
+class HashEmbedder:
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+        self.model_id = f"hash-v1:{dim}"
+
+    def _features(self, text: str) -> List[str]:
+        words = [word for word in _WORD.findall(text.lower()) if len(word) > 1]
+        return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    def _embed_one(self, text: str, row: np.ndarray) -> None:
+        for feature in self._features(text):
+            # blake2b, not hash(): bucket assignments must be stable across processes
+            digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+            row[digest % self.dim] += 1.0 if (digest >> 63) & 1 else -1.0
+
+    def embed_sync(self, texts: List[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for text, row in zip(texts, matrix):
+            self._embed_one(text, row)
+        return _normalize(matrix)
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        return await asyncio.get_running_loop().run_in_executor(None, self.embed_sync, texts)
+
+
+class OpenAIEmbedder:
+    def __init__(self, api_key: str, model: str = EMBEDDING_MODEL, dim: int = EMBEDDING_DIM):
+        self.api_key = api_key
+        self.model = model
+        self.dim = dim
+        self.model_id = f"openai:{model}:{dim}"
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        rows = []
+        for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            rows.extend(await llm_client.embeddings(
+                texts[start:start + EMBEDDING_BATCH_SIZE], self.api_key, self.model, dimensions=self.dim
+            ))
+        return _normalize(np.asarray(rows, dtype=np.float32).reshape(len(texts), self.dim))
+
+
+def get_embedder(api_key: str = None):
+    if EMBEDDING_BACKEND == "openai":
+        return OpenAIEmbedder(api_key)
+    return HashEmbedder()
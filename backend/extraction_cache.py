@@ -0,0 +1,157 @@
+"""Two-tier cache of extracted file text, keyed by content hash and extractor version.
+
+Re-uploads of the same slide deck or photo skip PDF parsing and vision OCR. The
+key is sha256(file bytes) plus an extractor version string, so changing the
+parser, OCR model/prompt or image preprocessing invalidates old entries.
+
+Tiers:
+  * local disk (EXTRACTION_CACHE_DIR): fast, per instance, evicted
+    least-recently-used once it grows past EXTRACTION_CACHE_DISK_BYTES
+  * Firestore `extraction_cache/{key}`: shared by every instance; entries above
+    EXTRACTION_CACHE_FIRESTORE_MAX_BYTES are kept on disk only (documents are
+    capped at 1 MiB). `expires_at` is set for a Firestore TTL policy.
+A Firestore hit is written back to disk.
+"""
+import asyncio
+import datetime
+import hashlib
+import os
+import tempfile
+import threading
+from typing import Optional
+
+EXTRACTION_CACHE_DIR = os.getenv("EXTRACTION_CACHE_DIR", os.path.join(tempfile.gettempdir(), "extraction_cache"))
+EXTRACTION_CACHE_DISK_BYTES = int(os.getenv("EXTRACTION_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
+EXTRACTION_CACHE_FIRESTORE_MAX_BYTES = int(os.getenv("EXTRACTION_CACHE_FIRESTORE_MAX_BYTES", str(900 * 1024)))
+EXTRACTION_CACHE_TTL_DAYS = int(os.getenv("EXTRACTION_CACHE_TTL_DAYS", "90"))
+
+# Eviction trims the disk tier down to this fraction of its budget so it does not run on every write
+_EVICT_TO_FRACTION = 0.9
+
+
+def cache_key(digest: str, extractor_version: str) -> str:
+    return hashlib.sha256(f"{extractor_version}:{digest}".encode("utf-8")).hexdigest()
+
+
+class ExtractionCache:
+    def __init__(self, client, directory: str = EXTRACTION_CACHE_DIR,
+                 max_disk_bytes: int = EXTRACTION_CACHE_DISK_BYTES, collection: str = "extraction_cache"):
+        self._client = client
+        self._directory = directory
+        self._max_disk_bytes = max_disk_bytes
+        self._collection = collection
+        self._disk_bytes: Optional[int] = None
+        self._lock = threading.Lock()
+        self._stats = {"disk_hits": 0, "firestore_hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._directory, key[:2], f"{key}.txt")
+
+    # Disk tier (blocking; run in the default executor)
+
+    def _disk_get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(path)  # mtime doubles as last-used time for LRU eviction
+        return text
+
+    def _disk_put(self, key: str, text: str) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_size()
+            else:
+                self._disk_bytes += size
+            if self._disk_bytes > self._max_disk_bytes:
+                self._evict()
+
+    def _entries(self):
+        for root, _, names in os.walk(self._directory):
+            for name in names:
+                if name.endswith(".txt"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield stat.st_mtime, stat.st_size, path
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        """Delete least-recently-used files until the tier is back under budget (lock held)"""
+        target = self._max_disk_bytes * _EVICT_TO_FRACTION
+        total = self._scan_size()
+        for _, size, path in sorted(self._entries()):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            self._stats["evictions"] += 1
+        self._disk_bytes = total
+
+    # Public async API
+
+    async def get(self, key: str) -> Optional[str]:
+        loop = asyncio.get_running_loop()
+        try:
+            text = await loop.run_in_executor(None, self._disk_get, key)
+            if text is not None:
+                self._stats["disk_hits"] += 1
+                return text
+        except OSError as e:
+            print(f"⚠️ Extraction cache disk read failed: {e}")
+
+        try:
+            snapshot = await self._client.collection(self._collection).document(key).get()
+            if snapshot.exists:
+                text = snapshot.get("text")
+                self._stats["firestore_hits"] += 1
+                await loop.run_in_executor(None, self._disk_put, key, text)
+                return text
+        except Exception as e:
+            print(f"⚠️ Extraction cache Firestore read failed: {e}")
+
+        self._stats["misses"] += 1
+        return None
+
+    async def put(self, key: str, text: str, extractor_version: str = None) -> None:
+        """Best-effort write to both tiers; failures are logged, never raised"""
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._disk_put, key, text)
+        except OSError as e:
+            print(f"⚠️ Extraction cache disk write failed: {e}")
+
+        size = len(text.encode("utf-8"))
+        if size <= EXTRACTION_CACHE_FIRESTORE_MAX_BYTES:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            try:
+                await self._client.collection(self._collection).document(key).set({
+                    "text": text,
+                    "extractor": extractor_version,
+                    "size": size,
+                    "created_at": now,
+                    "expires_at": now + datetime.timedelta(days=EXTRACTION_CACHE_TTL_DAYS),
+                })
+            except Exception as e:
+                print(f"⚠️ Extraction cache Firestore write failed: {e}")
+        self._stats["writes"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "disk_bytes": self._disk_bytes, "max_disk_bytes": self._max_disk_bytes}
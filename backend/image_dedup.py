@@ -0,0 +1,97 @@
+"""Per-class perceptual-hash index of OCR'd note photos.
+
+Two photos of the same whiteboard or slide never share bytes, so the content-hash
+extraction cache misses on them. Each OCR'd image's dHash (see
+`image_prep.dhash`) is recorded under `classes/{class_id}/image_hashes/{key}`,
+where `key` is the image's extraction cache key. A new upload whose hash is within
+IMAGE_DEDUP_MAX_DISTANCE bits of a recorded one reuses that extraction instead of
+calling the vision model again.
+
+The index is scoped per class (a class's notes are only ever matched against the
+same class) and held in memory per class for IMAGE_DEDUP_INDEX_TTL_SECONDS, so a
+lookup is one linear scan of at most IMAGE_DEDUP_INDEX_LIMIT hashes.
+"""
+import datetime
+import os
+from typing import List, Optional, Tuple
+
+from caches import TTLCache
+
+IMAGE_DEDUP_HASH_SIZE = int(os.getenv("IMAGE_DEDUP_HASH_SIZE", "16"))
+# Out of IMAGE_DEDUP_HASH_SIZE ** 2 bits (256 by default). Re-encoded, resized or
+# lightly blurred copies land within ~6 bits; two slides on the same template that
+# differ by one line can be as close as ~7, so raising this trades accuracy for hits.
+IMAGE_DEDUP_MAX_DISTANCE = int(os.getenv("IMAGE_DEDUP_MAX_DISTANCE", "6"))
+IMAGE_DEDUP_INDEX_LIMIT = int(os.getenv("IMAGE_DEDUP_INDEX_LIMIT", "2000"))
+IMAGE_DEDUP_INDEX_TTL_SECONDS = float(os.getenv("IMAGE_DEDUP_INDEX_TTL_SECONDS", "300"))
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class PerceptualHashIndex:
+    def __init__(self, client, subcollection: str = "image_hashes"):
+        self._client = client
+        self._subcollection = subcollection
+        self._indexes = TTLCache("image_hash_indexes", maxsize=256, ttl_seconds=IMAGE_DEDUP_INDEX_TTL_SECONDS)
+        self._stats = {"lookups": 0, "hits": 0, "misses": 0, "stale": 0, "added": 0}
+
+    def _collection(self, class_id: str):
+        return self._client.collection("classes").document(class_id).collection(self._subcollection)
+
+    async def _load(self, class_id: str) -> List[Tuple[int, str]]:
+        """(hash, extraction key) pairs for a class, most recent first"""
+        entries = self._indexes.get(class_id)
+        if entries is None:
+            query = (self._collection(class_id)
+                     .order_by("created_at", direction="DESCENDING")
+                     .limit(IMAGE_DEDUP_INDEX_LIMIT))
+            entries = []
+            async for doc in query.stream():
+                data = doc.to_dict()
+                if data.get("hash_size") == IMAGE_DEDUP_HASH_SIZE:
+                    entries.append((int(data["hash"], 16), data["extraction_key"]))
+            self._indexes.set(class_id, entries)
+        return entries
+
+    async def find(self, class_id: str, phash: int) -> Optional[str]:
+        """Extraction key of the closest recorded image within the threshold, if any"""
+        self._stats["lookups"] += 1
+        best_key, best_distance = None, IMAGE_DEDUP_MAX_DISTANCE + 1
+        for other, key in await self._load(class_id):
+            distance = hamming(phash, other)
+            if distance < best_distance:
+                best_key, best_distance = key, distance
+        if best_key is None:
+            self._stats["misses"] += 1
+        return best_key
+
+    def record_hit(self, hit: bool) -> None:
+        """Whether the key returned by `find` still resolved to cached text"""
+        self._stats["hits" if hit else "stale"] += 1
+
+    async def add(self, class_id: str, phash: int, extraction_key: str) -> None:
+        await self._collection(class_id).document(extraction_key).set({
+            "hash": format(phash, "x"),
+            "hash_size": IMAGE_DEDUP_HASH_SIZE,
+            "extraction_key": extraction_key,
+            "created_at": datetime.datetime.now(datetime.timezone.utc),
+        })
+        entries = self._indexes.get(class_id)
+        if entries is not None:
+            entries.insert(0, (phash, extraction_key))
+            del entries[IMAGE_DEDUP_INDEX_LIMIT:]
+        self._stats["added"] += 1
+
+    def invalidate(self, class_id: str) -> None:
+        self._indexes.pop(class_id)
+
+    def stats(self) -> dict:
+        lookups = self._stats["lookups"]
+        return {
+            **self._stats,
+            "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else None,
+            "max_distance": IMAGE_DEDUP_MAX_DISTANCE,
+            "hash_bits": IMAGE_DEDUP_HASH_SIZE ** 2,
+        }
@@ -0,0 +1,75 @@
+"""Shrink uploaded images before they are sent to the vision model.
+
+Phone photos arrive as 5-12 MB JPEG/HEIC-sized files, but the provider scales
+every image to fit 2048x2048 and then to a 768 px shortest side before tiling
+it, so anything larger only costs upload time and payload bytes. Images are
+auto-oriented from EXIF, downscaled to that effective resolution, flattened to
+RGB and re-encoded as JPEG without metadata (EXIF/GPS, ICC, comments).
+
+Everything here is blocking Pillow work; call it through `run_blocking`.
+"""
+import io
+import os
+
+from PIL import Image, ImageOps
+
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", "2048"))
+VISION_MAX_SHORT_SIDE = int(os.getenv("VISION_MAX_SHORT_SIDE", "768"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "85"))
+
+# Part of the extraction cache key: OCR output depends on what the model is shown
+PREP_VERSION = f"jpeg-{VISION_MAX_SIDE}-{VISION_MAX_SHORT_SIDE}-q{VISION_JPEG_QUALITY}"
+
+
+def target_size(width: int, height: int) -> tuple:
+    """Size the provider would actually look at, never upscaling"""
+    scale = min(1.0, VISION_MAX_SIDE / max(width, height), VISION_MAX_SHORT_SIDE / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def prepare_for_vision(fileobj) -> bytes:
+    """Auto-oriented, downscaled, metadata-free JPEG bytes for an image file object"""
+    fileobj.seek(0)
+    with Image.open(fileobj) as image:
+        # Let the JPEG decoder skip straight to a nearby power-of-two scale
+        width, height = image.size
+        image.draft("RGB", target_size(width, height))
+        image = ImageOps.exif_transpose(image)
+
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+
+        size = target_size(*image.size)
+        if size != image.size:
+            image = image.resize(size, Image.LANCZOS)
+
+        out = io.BytesIO()
+        image.save(out, format="JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+    fileobj.seek(0)
+    return out.getvalue()
+
+
+def dhash(fileobj, hash_size: int = 16) -> int:
+    """Difference hash: one bit per horizontally adjacent pixel pair of a grayscale thumbnail
+
+    Robust to rescaling, recompression and small shifts in framing, so two photos
+    of the same slide land a few bits apart.
+    """
+    fileobj.seek(0)
+    with Image.open(fileobj) as image:
+        image.draft("L", (hash_size * 4, hash_size * 4))
+        image = ImageOps.exif_transpose(image)
+        pixels = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS).tobytes()
+    fileobj.seek(0)
+
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
@@ -0,0 +1,250 @@
+"""Persistent background jobs for long-running note analysis.
+
+Endpoints enqueue a job and return its id at once; a pool of asyncio workers in
+the same process runs the registered handler for the job's kind. Job state
+lives in Firestore (`note_jobs/{job_id}`), so clients can poll from any
+instance, and uploaded files are copied to a local spool directory so a restart
+of this instance can pick up jobs that were queued or running when it stopped.
+
+Lifecycle: queued -> running -> succeeded | failed. A handler that raises
+`JobFailed` fails the job immediately; any other exception is retried with
+backoff until NOTE_JOB_MAX_ATTEMPTS is reached. A running job carries a lease.
+Unfinished jobs are re-queued at startup, and every NOTE_JOB_SWEEP_SECONDS a
+sweeper re-queues this instance's running jobs whose lease has expired (a worker
+that died or hung mid-run), so they do not wait for the next restart.
+"""
+import asyncio
+import datetime
+import os
+import shutil
+import socket
+import tempfile
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from firebase_admin import firestore
+
+NOTE_JOB_WORKERS = int(os.getenv("NOTE_JOB_WORKERS", "2"))
+NOTE_JOB_MAX_ATTEMPTS = int(os.getenv("NOTE_JOB_MAX_ATTEMPTS", "3"))
+NOTE_JOB_RETRY_DELAY_SECONDS = float(os.getenv("NOTE_JOB_RETRY_DELAY_SECONDS", "5"))
+NOTE_JOB_LEASE_SECONDS = float(os.getenv("NOTE_JOB_LEASE_SECONDS", "900"))
+NOTE_JOB_SWEEP_SECONDS = float(os.getenv("NOTE_JOB_SWEEP_SECONDS", "60"))
+NOTE_JOB_SPOOL_DIR = os.getenv("NOTE_JOB_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "note_jobs"))
+# Spooled files only exist on this machine, so jobs are pinned to the instance that accepted them.
+# Give each worker process its own value when running several on one machine.
+NOTE_JOB_HOST = os.getenv("NOTE_JOB_HOST", socket.gethostname())
+
+ACTIVE_STATUSES = ("queued", "running")
+TERMINAL_STATUSES = ("succeeded", "failed")
+
+
+class JobFailed(Exception):
+    """Permanent failure: the job is marked failed without further attempts."""
+
+
+def _utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+@firestore.async_transactional
+async def _claim(transaction, job_ref) -> Optional[dict]:
+    """Move a queued (or lease-expired running) job to running; None if someone else has it"""
+    snapshot = await job_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+    job = snapshot.to_dict()
+    lease = job.get("lease_expires_at")
+    if job.get("status") == "running" and lease and lease > _utcnow():
+        return None
+    if job.get("status") not in ACTIVE_STATUSES:
+        return None
+
+    now = _utcnow()
+    claimed = {
+        "status": "running",
+        "attempts": job.get("attempts", 0) + 1,
+        "lease_expires_at": now + datetime.timedelta(seconds=NOTE_JOB_LEASE_SECONDS),
+        "updated_at": now,
+    }
+    transaction.update(job_ref, claimed)
+    return {**job, **claimed}
+
+
+class JobQueue:
+    def __init__(self, client, collection: str = "note_jobs", workers: int = NOTE_JOB_WORKERS,
+                 spool_dir: str = NOTE_JOB_SPOOL_DIR):
+        self._client = client
+        self._collection = collection
+        self._workers = workers
+        self._spool_dir = spool_dir
+        self._handlers: Dict[str, Callable[[dict], Awaitable[dict]]] = {}
+        self._queue: asyncio.Queue = None
+        self._tasks: List[asyncio.Task] = []
+        self._changed: Dict[str, asyncio.Event] = {}
+
+    def register(self, kind: str, handler: Callable[[dict], Awaitable[dict]]):
+        """handler(job) -> JSON-serializable result stored on the job when it succeeds"""
+        self._handlers[kind] = handler
+
+    def _ref(self, job_id: str):
+        return self._client.collection(self._collection).document(job_id)
+
+    def spool_path(self, job_id: str) -> str:
+        return os.path.join(self._spool_dir, job_id)
+
+    def _spool_files(self, job_id: str, files: List[Tuple[str, object]]) -> List[dict]:
+        directory = self.spool_path(job_id)
+        os.makedirs(directory, exist_ok=True)
+        spooled = []
+        for index, (filename, fileobj) in enumerate(files):
+            path = os.path.join(directory, f"{index:03d}")
+            fileobj.seek(0)
+            with open(path, "wb") as out:
+                shutil.copyfileobj(fileobj, out)
+            spooled.append({"filename": filename, "path": path})
+        return spooled
+
+    async def enqueue(self, kind: str, user_id: str, params: dict,
+                      files: List[Tuple[str, object]] = None) -> dict:
+        """Persist a queued job (copying any (filename, fileobj) uploads to the spool) and schedule it"""
+        if kind not in self._handlers:
+            raise ValueError(f"No handler registered for job kind '{kind}'")
+        job_id = str(uuid.uuid4())
+        spooled = []
+        if files:
+            loop = asyncio.get_running_loop()
+            spooled = await loop.run_in_executor(None, self._spool_files, job_id, files)
+
+        now = _utcnow()
+        job = {
+            "job_id": job_id,
+            "kind": kind,
+            "status": "queued",
+            "user_id": user_id,
+            "params": params,
+            "files": spooled,
+            "attempts": 0,
+            "error": None,
+            "result": None,
+            "worker_host": NOTE_JOB_HOST,
+            "created_at": now,
+            "updated_at": now,
+        }
+        await self._ref(job_id).set(job)
+        self._schedule(job_id)
+        return job
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        snapshot = await self._ref(job_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    async def wait_for_change(self, job_id: str, timeout: float) -> None:
+        """Wait until this instance updates the job, or `timeout` elapses"""
+        event = self._changed.setdefault(job_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            event.clear()
+
+    def _notify(self, job_id: str, final: bool = False):
+        event = self._changed.pop(job_id, None) if final else self._changed.get(job_id)
+        if event is not None:
+            event.set()
+
+    def _schedule(self, job_id: str, delay: float = 0):
+        if self._queue is None:
+            return
+        if delay:
+            asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, job_id)
+        else:
+            self._queue.put_nowait(job_id)
+
+    async def start(self):
+        """Start the workers and re-queue this instance's unfinished jobs"""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self._workers)]
+        self._tasks.append(asyncio.create_task(self._sweep_expired_leases()))
+        try:
+            query = (self._client.collection(self._collection)
+                     .where("worker_host", "==", NOTE_JOB_HOST)
+                     .where("status", "in", list(ACTIVE_STATUSES)))
+            recovered = 0
+            async for snapshot in query.stream():
+                if snapshot.get("status") == "running":
+                    # Its worker was this instance before the restart, so the lease is stale
+                    await snapshot.reference.update({"status": "queued", "lease_expires_at": None})
+                self._schedule(snapshot.id)
+                recovered += 1
+            if recovered:
+                print(f"♻️ Re-queued {recovered} unfinished note jobs")
+        except Exception as e:
+            print(f"⚠️ Could not recover note jobs: {e}")
+
+    async def _sweep_expired_leases(self):
+        """Periodically re-schedule this instance's running jobs whose lease has expired"""
+        while True:
+            await asyncio.sleep(NOTE_JOB_SWEEP_SECONDS)
+            try:
+                query = (self._client.collection(self._collection)
+                         .where("worker_host", "==", NOTE_JOB_HOST)
+                         .where("status", "==", "running"))
+                now = _utcnow()
+                async for snapshot in query.stream():
+                    lease = snapshot.to_dict().get("lease_expires_at")
+                    if lease is None or lease <= now:
+                        # _claim re-checks the lease in a transaction, so a live worker keeps the job
+                        print(f"♻️ Reclaiming note job {snapshot.id} after its lease expired")
+                        self._schedule(snapshot.id)
+            except Exception as e:
+                print(f"⚠️ Note job lease sweep failed: {e}")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except Exception as e:
+                print(f"❌ Note job {job_id} crashed the worker loop: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _finish(self, job: dict, updates: dict):
+        await self._ref(job["job_id"]).update({**updates, "lease_expires_at": None, "updated_at": _utcnow()})
+        if updates.get("status") in TERMINAL_STATUSES and job.get("files"):
+            shutil.rmtree(self.spool_path(job["job_id"]), ignore_errors=True)
+        self._notify(job["job_id"], final=updates.get("status") in TERMINAL_STATUSES)
+
+    async def _run(self, job_id: str):
+        job = await _claim(self._client.transaction(), self._ref(job_id))
+        if job is None:
+            return
+        self._notify(job_id)
+
+        handler = self._handlers.get(job.get("kind"))
+        if handler is None:
+            await self._finish(job, {"status": "failed", "error": f"Unknown job kind '{job.get('kind')}'"})
+            return
+
+        try:
+            result = await handler(job)
+        except JobFailed as e:
+            await self._finish(job, {"status": "failed", "error": str(e)})
+        except Exception as e:
+            if job["attempts"] >= NOTE_JOB_MAX_ATTEMPTS:
+                await self._finish(job, {"status": "failed", "error": str(e)})
+            else:
+                print(f"⚠️ Note job {job_id} attempt {job['attempts']} failed, retrying: {e}")
+                await self._finish(job, {"status": "queued", "error": str(e)})
+                self._schedule(job_id, delay=NOTE_JOB_RETRY_DELAY_SECONDS * 2 ** (job["attempts"] - 1))
+        else:
+            await self._finish(job, {"status": "succeeded", "result": result, "error": None})
@@ -0,0 +1,229 @@
+"""Shared async HTTP client for the LLM provider (OpenAI-compatible chat completions).
+
+One pooled httpx.AsyncClient is reused by every AI helper so connections stay
+alive between calls. Each call gets a deadline that covers all of its retries,
+concurrency against the provider is capped by a semaphore, and 429/5xx
+responses are retried with jittered exponential backoff.
+
+Point OPENAI_API_URL at benchmarks/mock_completion_server.py to exercise this
+module against injected latency and errors.
+"""
+import asyncio
+import json
+import os
+import random
+
+import httpx
+
+OPENAI_API_URL = os.getenv("OPENAI_API_URL", "https://api.openai.com/v1/chat/completions")
+OPENAI_EMBEDDINGS_URL = os.getenv("OPENAI_EMBEDDINGS_URL", "https://api.openai.com/v1/embeddings")
+
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+LLM_CONNECT_TIMEOUT_SECONDS = float(os.getenv("LLM_CONNECT_TIMEOUT_SECONDS", "5"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv("LLM_BACKOFF_BASE_SECONDS", "0.5"))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv("LLM_BACKOFF_MAX_SECONDS", "8"))
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+_client: httpx.AsyncClient = None
+_semaphore: asyncio.Semaphore = None
+
+
+class LLMError(Exception):
+    """Raised when the provider call fails after retries or exceeds its deadline."""
+
+    def __init__(self, message: str, status_code: int = 502):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def get_client() -> httpx.AsyncClient:
+    """Return the process-wide pooled client, creating it on first use"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(LLM_TIMEOUT_SECONDS, connect=LLM_CONNECT_TIMEOUT_SECONDS),
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONCURRENCY,
+                max_keepalive_connections=LLM_MAX_CONCURRENCY,
+            ),
+        )
+    return _client
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+    return _semaphore
+
+
+async def aclose():
+    """Close the pooled client (called on app shutdown)"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _backoff_delay(attempt: int, retry_after: str = None) -> float:
+    """Full-jitter exponential backoff, honouring a numeric Retry-After header"""
+    if retry_after:
+        try:
+            return min(float(retry_after), LLM_BACKOFF_MAX_SECONDS)
+        except ValueError:
+            pass
+    cap = min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * (2 ** attempt))
+    return random.uniform(0, cap)
+
+
+def _headers(api_key: str) -> dict:
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+    }
+
+
+async def chat_completion(payload: dict, api_key: str, timeout: float = None) -> dict:
+    """POST a chat completion and return the decoded JSON body.
+
+    `timeout` is the total deadline for the call including retries and the time
+    spent waiting for a concurrency slot.
+    """
+    return await _post_json(OPENAI_API_URL, payload, api_key, timeout)
+
+
+async def _post_json(url: str, payload: dict, api_key: str, timeout: float = None) -> dict:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + (timeout or LLM_TIMEOUT_SECONDS)
+    client = get_client()
+    last_error = "no attempts made"
+    attempts = 0
+
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        retry_after = None
+        try:
+            async with _get_semaphore():
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                attempts += 1
+                response = await client.post(
+                    url, headers=_headers(api_key), json=payload, timeout=remaining
+                )
+        except httpx.TimeoutException:
+            last_error = "request timed out"
+        except httpx.TransportError as e:
+            last_error = f"connection error: {e}"
+        else:
+            if response.status_code < 400:
+                return response.json()
+            last_error = f"provider returned {response.status_code}: {response.text[:200]}"
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                raise LLMError(last_error, status_code=502)
+            retry_after = response.headers.get("retry-after")
+
+        if attempt == LLM_MAX_RETRIES:
+            break
+        delay = _backoff_delay(attempt, retry_after)
+        if loop.time() + delay >= deadline:
+            break
+        await asyncio.sleep(delay)
+
+    if attempts <= LLM_MAX_RETRIES:
+        raise LLMError(f"AI request exceeded its deadline ({last_error})", status_code=504)
+    raise LLMError(f"AI request failed after {attempts} attempts ({last_error})", status_code=502)
+
+
+async def chat_completion_text(payload: dict, api_key: str, timeout: float = None) -> str:
+    """Convenience wrapper returning the first choice's message content"""
+    result = await chat_completion(payload, api_key, timeout=timeout)
+    try:
+        return result["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        raise LLMError("AI response was missing message content", status_code=502)
+
+
+async def embeddings(texts: list, api_key: str, model: str, dimensions: int = None, timeout: float = None) -> list:
+    """Embedding vectors for `texts`, in input order (same retry/deadline rules as chat_completion)"""
+    payload = {"model": model, "input": texts}
+    if dimensions:
+        payload["dimensions"] = dimensions
+    result = await _post_json(OPENAI_EMBEDDINGS_URL, payload, api_key, timeout)
+    try:
+        return [item["embedding"] for item in sorted(result["data"], key=lambda item: item["index"])]
+    except (KeyError, TypeError):
+        raise LLMError("AI response was missing embeddings", status_code=502)
+
+
+async def stream_chat_completion(payload: dict, api_key: str, timeout: float = None):
+    """Stream a chat completion, yielding content deltas as they arrive.
+
+    Retries (429/5xx, connection errors) only happen before the first byte is
+    received; once tokens are flowing a failure is raised to the caller.
+    `timeout` bounds the wait for the response to start, and each gap between
+    chunks is bounded by LLM_TIMEOUT_SECONDS.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + (timeout or LLM_TIMEOUT_SECONDS)
+    client = get_client()
+    body = dict(payload, stream=True)
+    last_error = "no attempts made"
+
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        retry_after = None
+        async with _get_semaphore():
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            request = client.build_request(
+                "POST", OPENAI_API_URL, headers=_headers(api_key), json=body,
+                timeout=httpx.Timeout(LLM_TIMEOUT_SECONDS, connect=min(LLM_CONNECT_TIMEOUT_SECONDS, remaining)),
+            )
+            try:
+                response = await asyncio.wait_for(client.send(request, stream=True), remaining)
+            except (asyncio.TimeoutError, httpx.TimeoutException):
+                last_error = "request timed out"
+                response = None
+            except httpx.TransportError as e:
+                last_error = f"connection error: {e}"
+                response = None
+
+            if response is not None:
+                try:
+                    if response.status_code >= 400:
+                        await response.aread()
+                        last_error = f"provider returned {response.status_code}: {response.text[:200]}"
+                        if response.status_code not in RETRYABLE_STATUS_CODES:
+                            raise LLMError(last_error, status_code=502)
+                        retry_after = response.headers.get("retry-after")
+                    else:
+                        async for line in response.aiter_lines():
+                            if not line.startswith("data:"):
+                                continue
+                            data = line[len("data:"):].strip()
+                            if data == "[DONE]":
+                                return
+                            try:
+                                chunk = json.loads(data)
+                                delta = chunk["choices"][0].get("delta", {}).get("content")
+                            except (ValueError, KeyError, IndexError, TypeError):
+                                continue
+                            if delta:
+                                yield delta
+                        return
+                except httpx.HTTPError as e:
+                    raise LLMError(f"AI stream interrupted: {e}", status_code=502)
+                finally:
+                    await response.aclose()
+
+        if attempt == LLM_MAX_RETRIES:
+            break
+        delay = _backoff_delay(attempt, retry_after)
+        if loop.time() + delay >= deadline:
+            raise LLMError(f"AI request exceeded its deadline ({last_error})", status_code=504)
+        await asyncio.sleep(delay)
+
+    raise LLMError(f"AI stream could not be started ({last_error})", status_code=502)
@@ -1,10 +1,11 @@
 from fastapi import FastAPI, HTTPException, Depends, Header, File, UploadFile, Form
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer
 from pydantic import BaseModel, EmailStr
 from typing import Optional, List
 import firebase_admin
-from firebase_admin import credentials, firestore, auth
+from firebase_admin import credentials, firestore, firestore_async, auth
 import random
 import string
 import datetime
@@ -16,9 +17,35 @@ import uuid
 from dotenv import load_dotenv
 from fastapi import UploadFile
 import base64
-import PyPDF2
-from PIL import Image
 import io
+import asyncio
+import functools
+import hashlib
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+import llm_client
+from llm_client import LLMError
+from document_loader import DocumentLoader
+from caches import TTLCache, cache_stats, register_cache
+import pdf_extract
+import token_budget
+import conversation_memory
+from conversations import ConversationStore, conversation_preview
+from class_context import ClassContextService
+import embeddings
+import vector_index
+from vector_index import VectorIndex
+from answer_cache import SemanticAnswerCache
+from singleflight import SingleFlight
+import image_prep
+import uploads
+from uploads import SpooledUpload, spool_uploads
+from jobs import JobQueue, JobFailed
+from extraction_cache import ExtractionCache
+import extraction_cache
+from image_dedup import PerceptualHashIndex
+import image_dedup
 
 # Load environment variables
 load_dotenv()
@@ -44,9 +71,21 @@ if not firebase_admin._apps:
         print(f"❌ Firebase initialization failed: {e}")
         raise
 
-db = firestore.client()
+# Async Firestore client: every read/write is awaited so a slow round-trip
+# never stalls the event loop for other requests.
+db = firestore_async.client()
 app = FastAPI(title="Classroom API", version="1.0.0")
 
+# Bounded pool for SDK calls that have no async API (Firebase Auth, Identity Toolkit REST)
+BLOCKING_POOL_SIZE = int(os.getenv("BLOCKING_POOL_SIZE", "16"))
+blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_POOL_SIZE, thread_name_prefix="blocking")
+
+@app.on_event("shutdown")
+async def shutdown_blocking_executor():
+    blocking_executor.shutdown(wait=False)
+    pdf_extract.shutdown()
+    await llm_client.aclose()
+
 # CORS middleware for frontend integration
 app.add_middleware(
     CORSMiddleware,
@@ -56,6 +95,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def reject_oversized_uploads(request, call_next):
+    """Turn away multipart bodies over the per-request cap before they are parsed and spooled"""
+    if (request.headers.get("content-type", "").startswith("multipart/")
+            and not uploads.check_request_size(request.headers.get("content-length"))):
+        return JSONResponse(status_code=413, content={"detail": "Upload too large"})
+    return await call_next(request)
+
 # Reserved for future auth middleware
 # security = HTTPBearer()
 
@@ -179,6 +226,7 @@ class NoteSummary(BaseModel):
 class SummaryResponse(BaseModel):
     summary: NoteSummary
     raw_content_preview: str  # First 200 chars of original content
+    cache_hit: bool = False  # True when the structured summary came from summary_cache
 
 # Simple note models for user-written notes
 class Note(BaseModel):
@@ -208,14 +256,29 @@ class SummarizeNotesRequest(BaseModel):
 # -------------------------------
 # Auth Dependencies
 # -------------------------------
+# Verified ID tokens, keyed by sha256 of the raw token and kept until the token's own `exp`
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000"))
+token_cache = TTLCache("auth_tokens", maxsize=AUTH_TOKEN_CACHE_SIZE)
+
+def token_cache_key(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+def purge_cached_tokens(uid: str) -> int:
+    """Forget every cached token for a user so the next request re-verifies"""
+    return token_cache.purge(lambda key, claims: claims.get('uid') == uid)
+
 async def get_current_user(authorization: Optional[str] = Header(None)):
     """Extract and verify Firebase ID token from Authorization header and normalize uid."""
     if not authorization or not authorization.startswith('Bearer '):
         raise HTTPException(status_code=401, detail="Authentication required")
     
     token = authorization.split('Bearer ')[1]
+    cache_key = token_cache_key(token)
+    cached = token_cache.get(cache_key)
+    if cached is not None:
+        return dict(cached)
     try:
-        decoded_token = auth.verify_id_token(token)
+        decoded_token = await run_blocking(auth.verify_id_token, token)
         # Normalize UID: accept common token fields and ensure 'uid' exists for downstream code.
         uid = decoded_token.get('uid') or decoded_token.get('user_id') or decoded_token.get('sub')
         if not uid:
@@ -227,10 +290,47 @@ async def get_current_user(authorization: Optional[str] = Header(None)):
             normalized['email'] = decoded_token.get('email')
         if 'name' not in normalized and decoded_token.get('name'):
             normalized['name'] = decoded_token.get('name')
+        if decoded_token.get('exp'):
+            token_cache.set(cache_key, dict(normalized), expires_at=float(decoded_token['exp']))
         return normalized
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"Invalid authentication token: {str(e)}")
 
+# Class membership lookups: resolved once per request (FastAPI caches dependencies)
+# and kept briefly per process. Only positive results are cached, so a join made
+# on another instance is visible immediately; removals elsewhere lag by at most the TTL.
+MEMBERSHIP_CACHE_TTL_SECONDS = float(os.getenv("MEMBERSHIP_CACHE_TTL_SECONDS", "30"))
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "20000"))
+membership_cache = TTLCache("class_membership", maxsize=MEMBERSHIP_CACHE_SIZE,
+                            ttl_seconds=MEMBERSHIP_CACHE_TTL_SECONDS)
+
+async def get_membership(class_id: str, uid: str) -> Optional[dict]:
+    """classMembers/{class_id}_{uid} data, or None when the user is not in the class"""
+    cached = membership_cache.get((class_id, uid))
+    if cached is not None:
+        return cached
+    member_doc = await db.collection("classMembers").document(f"{class_id}_{uid}").get()
+    if not member_doc.exists:
+        return None
+    membership = member_doc.to_dict()
+    membership_cache.set((class_id, uid), membership)
+    return membership
+
+def invalidate_membership(class_id: str, uid: Optional[str] = None):
+    """Drop one member's cached membership, or every member of the class when uid is None"""
+    if uid:
+        membership_cache.pop((class_id, uid))
+    else:
+        membership_cache.purge(lambda key, _: key[0] == class_id)
+
+async def class_membership(class_id: str, current_user: dict = Depends(get_current_user)) -> Optional[dict]:
+    """Dependency: the caller's membership in the class named by the route, or None"""
+    return await get_membership(class_id, current_user['uid'])
+
+def get_document_loader() -> DocumentLoader:
+    """Request-scoped batched reader (FastAPI caches one instance per request)"""
+    return DocumentLoader(db)
+
 # Mock auth for development/testing
 async def mock_get_current_user():
     """Mock user for testing - replace with real auth in production"""
@@ -247,94 +347,181 @@ def generate_class_code(length: int = 6) -> str:
     """Generate a class join code like 'ABC123'"""
     return "".join(random.choices(string.ascii_uppercase + string.digits, k=length))
 
+def encode_cursor(doc_id: str) -> str:
+    """Opaque page token pointing at the last document of a page"""
+    raw = json.dumps({"id": doc_id}).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> str:
+    """Return the document id encoded in a page token"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded))["id"]
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def fetch_page(query, collection_ref, limit: int, cursor: Optional[str] = None):
+    """Run an ordered query from `cursor` with start_after, returning (docs, next_cursor).
+
+    Resuming costs one read for the cursor document regardless of page depth,
+    unlike offset() which is billed for every skipped document.
+    """
+    limit = max(limit, 1)
+    if cursor:
+        cursor_doc = await collection_ref.document(decode_cursor(cursor)).get()
+        if not cursor_doc.exists:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.start_after(cursor_doc)
+    docs = await query.limit(limit + 1).get()
+    next_cursor = encode_cursor(docs[limit - 1].id) if len(docs) > limit else None
+    return docs[:limit], next_cursor
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call on the bounded executor without stalling the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, functools.partial(func, *args, **kwargs))
+
+SEARCH_NGRAM_SIZE = 3
+SEARCH_CANDIDATE_LIMIT = 200
+
+def normalize_search_text(text: str) -> str:
+    """Lowercase and collapse whitespace for search matching"""
+    return " ".join(text.lower().split())
+
+def search_tokens(text: str, field: str) -> List[str]:
+    """Index tokens for `text`: short word prefixes plus n-grams, namespaced by field.
+
+    Stored on the class doc as `search_tokens` so a partial, case-insensitive
+    query resolves with a single array_contains lookup.
+    """
+    normalized = normalize_search_text(text)
+    tokens = set()
+    for word in normalized.split():
+        for i in range(1, min(len(word), SEARCH_NGRAM_SIZE - 1) + 1):
+            tokens.add(f"{field}:{word[:i]}")
+    for i in range(len(normalized) - SEARCH_NGRAM_SIZE + 1):
+        tokens.add(f"{field}:{normalized[i:i + SEARCH_NGRAM_SIZE]}")
+    return sorted(tokens)
+
+def search_query_token(query: str, field: str) -> str:
+    """Pick the index token to look up for a normalized query string"""
+    if len(query) < SEARCH_NGRAM_SIZE:
+        return f"{field}:{query.split()[0]}"
+    grams = [query[i:i + SEARCH_NGRAM_SIZE] for i in range(len(query) - SEARCH_NGRAM_SIZE + 1)]
+    # Grams without spaces and with fewer repeated letters tend to be rarer
+    return f"{field}:{max(grams, key=lambda g: (' ' not in g, len(set(g))))}"
+
+def search_match_rank(query: str, value: str) -> int:
+    """0 exact, 1 prefix, 2 word prefix, 3 substring"""
+    if value == query:
+        return 0
+    if value.startswith(query):
+        return 1
+    if f" {query}" in value:
+        return 2
+    return 3
+
+def class_search_fields(name: str, teacher_name: str) -> dict:
+    """Denormalized search fields stored on a class document"""
+    return {
+        "teacher_name": teacher_name,
+        "search_tokens": search_tokens(name, "name") + search_tokens(teacher_name, "teacher"),
+    }
+
 def serialize_datetime(obj):
     """Convert datetime objects to ISO string for JSON serialization"""
     if isinstance(obj, datetime.datetime):
         return obj.isoformat()
     return obj
 
-def get_ai_response(conversation_history: List[Dict], api_key: str, class_context: str = None) -> str:
-    """Get AI response from OpenAI API with classroom context"""
-    
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    
-    # Enhance system prompt with class context if available
+def study_buddy_system_message(conversation_history: List[Dict], class_context: str = None, summary: str = None) -> dict:
+    """System prompt enhanced with class context and the rolling summary of older turns"""
     system_message = conversation_history[0].copy()
     if class_context:
         system_message["content"] += f"\n\nClass Context: {class_context}"
+    if summary:
+        system_message["content"] += f"\n\nSummary of the earlier conversation:\n{summary}"
+    return system_message
+
+def build_study_buddy_payload(conversation_history: List[Dict], class_context: str = None, summary: str = None) -> dict:
+    """Build the chat completion payload for a study buddy turn"""
+    system_message = study_buddy_system_message(conversation_history, class_context, summary)
     
-    # Update the conversation with enhanced context
-    enhanced_history = [system_message] + conversation_history[1:]
+    # Only the newest turns that fit the token budget are sent verbatim
+    enhanced_history = [system_message] + conversation_memory.context_window(
+        conversation_history, conversation_memory.message_tokens(system_message)
+    )
     
-    data = {
+    return {
         "model": "gpt-3.5-turbo",
         "messages": enhanced_history,
         "max_tokens": 300,
         "temperature": 0.7
     }
+
+async def get_ai_response(conversation_history: List[Dict], api_key: str, class_context: str = None,
+                          summary: str = None) -> str:
+    """Get AI response from OpenAI API with classroom context"""
+    data = build_study_buddy_payload(conversation_history, class_context, summary)
     
     try:
-        response = requests.post(OPENAI_API_URL, headers=headers, json=data)
-        response.raise_for_status()
-        result = response.json()
-        return result["choices"][0]["message"]["content"]
-    except requests.exceptions.RequestException as e:
-        raise HTTPException(status_code=500, detail=f"AI service error: {str(e)}")
+        return await llm_client.chat_completion_text(data, api_key)
+    except LLMError as e:
+        raise HTTPException(status_code=e.status_code, detail=f"AI service error: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"AI processing error: {str(e)}")
 
-def get_class_context(class_id: str, db) -> str:
-    """Get recent class context for AI conversations"""
+# Ranked, per-class cached context; invalidate_class_content() after writes it draws on
+class_context_service = ClassContextService(db)
+
+async def get_class_context(class_id: str, question: str = "") -> str:
+    """Class name plus the posts and note summaries most relevant to the question"""
     try:
-        # Get class info
-        class_doc = db.collection("classes").document(class_id).get()
-        if not class_doc.exists:
-            return ""
-        
-        class_data = class_doc.to_dict()
-        class_name = class_data.get("name", "")
-        
-        # Get recent posts for context (last 3 posts)
-        recent_posts = (db.collection("classes").document(class_id)
-                       .collection("posts")
-                       .order_by("createdAt", direction=firestore.Query.DESCENDING)
-                       .limit(3)
-                       .stream())
-        
-        context = f"Class: {class_name}\n"
-        context += "Recent discussion topics:\n"
-        
-        for post in recent_posts:
-            post_data = post.to_dict()
-            context += f"- {post_data.get('title', 'Untitled')}: {post_data.get('post_type', 'discussion')}\n"
-        
-        return context
-    except Exception:
+        return await class_context_service.context_for(class_id, question)
+    except Exception as e:
+        print(f"⚠️ Could not build class context for {class_id}: {e}")
         return ""
+
+# Local per-class vector index over posts, comments and note summaries
+class_embedder = embeddings.get_embedder(os.getenv("OPENAI_API_KEY"))
+class_vector_index = VectorIndex(db, class_embedder)
+register_cache("vector_index", class_vector_index)
+# First-turn answers served again for near-identical questions in the same class
+study_buddy_answer_cache = SemanticAnswerCache(class_embedder)
+register_cache("answer_cache", study_buddy_answer_cache)
+
+async def get_class_excerpts(class_id: str, question: str) -> str:
+    """Chunks of class material most similar to the question (empty until the class is indexed)"""
+    try:
+        return await class_vector_index.excerpts(class_id, question)
+    except Exception as e:
+        print(f"⚠️ Could not search class material for {class_id}: {e}")
+        return ""
+
+def invalidate_class_content(class_id: str, chunks: List[vector_index.Chunk] = None):
+    """Drop cached study-buddy context and answers after a post, comment or note summary changes; index any new chunks"""
+    class_context_service.invalidate(class_id)
+    study_buddy_answer_cache.invalidate(class_id)
+    if chunks:
+        class_vector_index.schedule_add(class_id, chunks)
     
-def get_ai_response_with_files(conversation_history: List[Dict], api_key: str, 
-                               files_content: List[Dict] = None, class_context: str = None) -> str:
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    
+async def get_ai_response_with_files(conversation_history: List[Dict], api_key: str, 
+                                     files_content: List[Dict] = None, class_context: str = None,
+                                     summary: str = None) -> str:
     # Enhance system prompt for file analysis
-    system_message = conversation_history[0].copy()
+    system_message = study_buddy_system_message(conversation_history, class_context, summary)
     if files_content:
         system_message["content"] += "\n\nYou can analyze uploaded files (PDFs and images). When files are provided, analyze their content and help the student understand the material through guiding questions."
     
-    if class_context:
-        system_message["content"] += f"\n\nClass Context: {class_context}"
-    
-    enhanced_history = [system_message] + conversation_history[1:]
+    # File content shares the token budget with the history sent verbatim
+    reserved_tokens = conversation_memory.message_tokens(system_message)
+    if files_content:
+        reserved_tokens += conversation_memory.message_tokens({"content": files_content})
+    enhanced_history = [system_message] + conversation_memory.context_window(conversation_history, reserved_tokens)
     
-    # Add file content to the last user message if files were provided
+    # Add file content to (a copy of) the last user message, so it is sent but not stored
     if files_content and enhanced_history:
-        last_message = enhanced_history[-1]
+        last_message = enhanced_history[-1] = enhanced_history[-1].copy()
         if last_message.get("role") == "user":
             # For OpenAI GPT-4 Vision API
             if any(f["type"] == "image" for f in files_content):
@@ -353,85 +540,182 @@ def get_ai_response_with_files(conversation_history: List[Dict], api_key: str,
         "temperature": 0.7
     }
     
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=data)
-    response.raise_for_status()
-    result = response.json()
-    return result["choices"][0]["message"]["content"]
+    return await llm_client.chat_completion_text(data, api_key)
 
 # File processing functions
-def extract_pdf_text(pdf_file: UploadFile) -> str:
-    pdf_reader = PyPDF2.PdfReader(pdf_file.file)
-    text = ""
-    for page in pdf_reader.pages:
-        text += page.extract_text() + "\n"
+# Extracted text is cached by file hash + extractor version (local disk, then Firestore)
+VISION_OCR_MODEL = "gpt-4o"
+VISION_EXTRACTOR_VERSION = f"{VISION_OCR_MODEL}:ocr-1:{image_prep.PREP_VERSION}"
+text_extraction_cache = ExtractionCache(db)
+register_cache("extracted_text", text_extraction_cache)
+# Near-duplicate photos (same slide, different shot) reuse an earlier OCR within the class
+image_hash_index = PerceptualHashIndex(db)
+register_cache("image_dedup", image_hash_index)
+# Concurrent identical AI requests (same content key) share one provider call
+image_ocr_flights = SingleFlight("image_ocr_flights")
+summary_flights = SingleFlight("summary_flights")
+post_help_flights = SingleFlight("post_help_flights")
+
+async def extract_pdf_text(pdf_file: SpooledUpload) -> str:
+    """Extract PDF text in the process pool (page-range parallel, page/time budgeted)"""
+    key = extraction_cache.cache_key(await pdf_file.sha256(), pdf_extract.EXTRACTOR_VERSION)
+    cached = await text_extraction_cache.get(key)
+    if cached is not None:
+        return cached
+
+    # Workers read a temporary copy of the spool by path; the bytes are never held in memory
+    text, incomplete = await pdf_extract.extract_text_result(pdf_file.upload.file)
+    if not incomplete:
+        await text_extraction_cache.put(key, text, pdf_extract.EXTRACTOR_VERSION)
     return text
 
-def process_image(image_file: UploadFile) -> str:
-    image_bytes = image_file.file.read()
-    base64_image = base64.b64encode(image_bytes).decode('utf-8')
-    return f"data:image/{image_file.filename.split('.')[-1]};base64,{base64_image}"
+async def vision_data_url(image_file: SpooledUpload, fallback_mime_type: str) -> str:
+    """Downscaled, metadata-free JPEG data URL; the original bytes if Pillow cannot decode it"""
+    try:
+        jpeg_bytes = await run_blocking(image_prep.prepare_for_vision, image_file.upload.file)
+        return f"data:image/jpeg;base64,{base64.b64encode(jpeg_bytes).decode('ascii')}"
+    except Exception as e:
+        print(f"⚠️ Image preprocessing failed for {image_file.filename}: {e}")
+        return await image_file.data_url(fallback_mime_type)
+
+async def process_image(image_file: SpooledUpload) -> str:
+    return await vision_data_url(image_file, f"image/{image_file.filename.split('.')[-1]}")
 
-def extract_text_from_image(image_file: UploadFile, api_key: str) -> str:
+async def find_near_duplicate_text(class_id: str, phash: int) -> Optional[str]:
+    """Cached extraction of a perceptually matching image already OCR'd in this class"""
+    try:
+        match_key = await image_hash_index.find(class_id, phash)
+        if match_key is None:
+            return None
+        text = await text_extraction_cache.get(match_key)
+        image_hash_index.record_hit(text is not None)
+        return text
+    except Exception as e:
+        print(f"⚠️ Image dedup lookup failed: {e}")
+        return None
+
+async def extract_text_from_image(image_file: SpooledUpload, api_key: str, class_id: Optional[str] = None) -> str:
     """Extract text content from image using OpenAI Vision API"""
     try:
-        # Convert image to base64
-        image_bytes = image_file.file.read()
-        base64_image = base64.b64encode(image_bytes).decode('utf-8')
+        key = extraction_cache.cache_key(await image_file.sha256(), VISION_EXTRACTOR_VERSION)
+        cached = await text_extraction_cache.get(key)
+        if cached is not None:
+            return cached
+
+        phash = None
+        if class_id:
+            try:
+                phash = await run_blocking(image_prep.dhash, image_file.upload.file, image_dedup.IMAGE_DEDUP_HASH_SIZE)
+            except Exception as e:
+                print(f"⚠️ Could not hash {image_file.filename}: {e}")
+            if phash is not None:
+                duplicate_text = await find_near_duplicate_text(class_id, phash)
+                if duplicate_text is not None:
+                    return duplicate_text
 
         # Determine image format
-        file_extension = image_file.filename.split('.')[-1].lower()
+        file_extension = image_file.extension
         mime_type = f"image/{file_extension if file_extension in ['png', 'jpeg', 'jpg'] else 'jpeg'}"
 
-        # Use OpenAI Vision API to extract text
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-
-        data = {
-            "model": "gpt-4o",  # gpt-4o has vision capabilities and is faster/cheaper than gpt-4-vision-preview
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": "Please extract ALL text content from this image. If it's a class note, lecture slide, or study material, transcribe everything you see including headings, bullet points, definitions, examples, and any other text. Preserve the structure and formatting as much as possible. Return ONLY the extracted text content, nothing else."
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:{mime_type};base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            "max_tokens": 2000
-        }
-
-        response = requests.post(OPENAI_API_URL, headers=headers, json=data)
-        response.raise_for_status()
-        result = response.json()
+        # Downscale/re-encode for the vision model, then base64. Built before joining the
+        # flight so the shared call never reads a spool its first caller may close.
+        image_data_url = await vision_data_url(image_file, mime_type)
 
-        extracted_text = result["choices"][0]["message"]["content"].strip()
+        # Simultaneous uploads of the same file share one OCR call
+        extracted_text = await image_ocr_flights.do(key, lambda: ocr_image(image_data_url, api_key, key))
+        if phash is not None:
+            try:
+                await image_hash_index.add(class_id, phash, key)
+            except Exception as e:
+                print(f"⚠️ Could not index {image_file.filename}: {e}")
         return extracted_text
 
     except Exception as e:
         # Fallback to placeholder if vision API fails
         return f"[Image file: {image_file.filename} - text extraction failed: {str(e)}]"
 
-def get_structured_summary(file_content: str, api_key: str, user_title: str = None) -> dict:
-    """Get structured JSON summary from OpenAI"""
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
+async def ocr_image(image_data_url: str, api_key: str, key: str) -> str:
+    """Vision OCR of one image, stored in the extraction cache under `key`"""
+    # Use OpenAI Vision API to extract text
+    data = {
+        "model": VISION_OCR_MODEL,  # gpt-4o has vision capabilities and is faster/cheaper than gpt-4-vision-preview
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": "Please extract ALL text content from this image. If it's a class note, lecture slide, or study material, transcribe everything you see including headings, bullet points, definitions, examples, and any other text. Preserve the structure and formatting as much as possible. Return ONLY the extracted text content, nothing else."
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": image_data_url
+                        }
+                    }
+                ]
+            }
+        ],
+        "max_tokens": 2000
     }
-    
-    user_message = f"Analyze and summarize this content:\n\n{file_content[:3000]}"  # Limit content length
-    if user_title:
-        user_message = f"Title: {user_title}\n\n{user_message}"
-    
+
+    extracted_text = (await llm_client.chat_completion_text(data, api_key)).strip()
+    await text_extraction_cache.put(key, extracted_text, VISION_EXTRACTOR_VERSION)
+    return extracted_text
+
+# Per-file text budget when uploaded PDFs are pasted into a study-buddy turn
+STUDY_BUDDY_FILE_TOKENS = int(os.getenv("STUDY_BUDDY_FILE_TOKENS", "3000"))
+
+# Files of one upload are extracted concurrently, at most this many at a time
+FILE_EXTRACTION_CONCURRENCY = int(os.getenv("FILE_EXTRACTION_CONCURRENCY", "4"))
+
+async def extract_upload_text(file: SpooledUpload, api_key: str, class_id: Optional[str] = None) -> Optional[str]:
+    """Text of one uploaded note file (PDF, image or .txt); None if unsupported or unreadable"""
+    name = file.filename.lower()
+    try:
+        if name.endswith('.pdf'):
+            return await extract_pdf_text(file)
+        if name.endswith(('.png', '.jpg', '.jpeg')):
+            # Use OpenAI Vision API to extract text from image
+            return await extract_text_from_image(file, api_key, class_id)
+        if name.endswith('.txt'):
+            return await file.read_text()
+    except Exception as e:
+        print(f"⚠️ Could not extract text from {file.filename}: {e}")
+    finally:
+        # Release the spool (and its temp file) as soon as the file is consumed
+        await file.close()
+    return None
+
+async def extract_uploads_text(files: List[SpooledUpload], api_key: str, class_id: Optional[str] = None) -> List[Optional[str]]:
+    """Extract every file concurrently (bounded), results in upload order"""
+    semaphore = asyncio.Semaphore(FILE_EXTRACTION_CONCURRENCY)
+
+    async def extract(file: SpooledUpload) -> Optional[str]:
+        async with semaphore:
+            return await extract_upload_text(file, api_key, class_id)
+
+    return await asyncio.gather(*(extract(file) for file in files))
+
+# Long content is summarized map-reduce style: token-sized chunks are summarized
+# concurrently into the NoteSummary schema, then merged (in rounds, if needed)
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", "3000"))
+SUMMARY_REDUCE_TOKENS = int(os.getenv("SUMMARY_REDUCE_TOKENS", "6000"))
+SUMMARY_MAP_CONCURRENCY = int(os.getenv("SUMMARY_MAP_CONCURRENCY", "4"))
+SUMMARY_MAX_CHUNKS = int(os.getenv("SUMMARY_MAX_CHUNKS", "40"))
+
+def parse_summary_json(ai_response: str) -> dict:
+    """Parse the model's JSON reply, tolerating extra text around the object"""
+    try:
+        return json.loads(ai_response)
+    except json.JSONDecodeError as e:
+        # Fallback: try to extract JSON from response if AI added extra text
+        json_match = re.search(r'\{.*\}', ai_response, re.DOTALL)
+        if json_match:
+            return json.loads(json_match.group())
+        raise HTTPException(status_code=500, detail=f"AI returned invalid JSON: {str(e)}")
+
+async def request_summary_json(user_message: str, api_key: str) -> dict:
     data = {
         "model": "gpt-3.5-turbo",
         "messages": [
@@ -441,33 +725,135 @@ def get_structured_summary(file_content: str, api_key: str, user_title: str = No
         "max_tokens": 800,
         "temperature": 0.3  # Lower temperature for more consistent JSON
     }
-    
+    return parse_summary_json((await llm_client.chat_completion_text(data, api_key)).strip())
+
+async def merge_summaries(partials: List[dict], api_key: str, user_title: str = None) -> dict:
+    """Reduce step: fold partial summaries (in document order) into one"""
+    semaphore = asyncio.Semaphore(SUMMARY_MAP_CONCURRENCY)
+
+    async def merge(group: List[dict], final: bool) -> dict:
+        parts = "\n\n".join(f"Part {index + 1}:\n{json.dumps(part)}" for index, part in enumerate(group))
+        user_message = (
+            "These JSON objects summarize consecutive parts of one document. Merge them into a single "
+            "summary of the whole document: keep the most important items, remove duplicates, and "
+            f"estimate the study time for the whole document.\n\n{parts}"
+        )
+        if final and user_title:
+            user_message = f"Title: {user_title}\n\n{user_message}"
+        async with semaphore:
+            return await request_summary_json(user_message, api_key)
+
+    while len(partials) > 1:
+        groups, current, current_tokens = [], [], 0
+        for part in partials:
+            part_tokens = token_budget.estimate_tokens(json.dumps(part))
+            if len(current) >= 2 and current_tokens + part_tokens > SUMMARY_REDUCE_TOKENS:
+                groups.append(current)
+                current, current_tokens = [], 0
+            current.append(part)
+            current_tokens += part_tokens
+        groups.append(current)
+
+        if len(groups) == 1:
+            return await merge(groups[0], final=True)
+        partials = await asyncio.gather(*(
+            merge(group, final=False) if len(group) > 1 else asyncio.sleep(0, result=group[0])
+            for group in groups
+        ))
+    return partials[0]
+
+async def get_structured_summary(file_content: str, api_key: str, user_title: str = None) -> dict:
+    """Get structured JSON summary from OpenAI, map-reducing content longer than one chunk"""
     try:
-        response = requests.post(OPENAI_API_URL, headers=headers, json=data)
-        response.raise_for_status()
-        result = response.json()
-        
-        ai_response = result["choices"][0]["message"]["content"].strip()
-        
-        # Parse JSON response
-        try:
-            summary_data = json.loads(ai_response)
-            return summary_data
-        except json.JSONDecodeError as e:
-            # Fallback: try to extract JSON from response if AI added extra text
-            import re
-            json_match = re.search(r'\{.*\}', ai_response, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-            else:
-                raise HTTPException(status_code=500, detail=f"AI returned invalid JSON: {str(e)}")
-                
-    except requests.exceptions.RequestException as e:
-        raise HTTPException(status_code=500, detail=f"AI service error: {str(e)}")
+        chunks = token_budget.chunk_text(file_content, SUMMARY_CHUNK_TOKENS)
+        if len(chunks) > SUMMARY_MAX_CHUNKS:
+            print(f"⚠️ Summarizing the first {SUMMARY_MAX_CHUNKS} of {len(chunks)} chunks")
+            chunks = chunks[:SUMMARY_MAX_CHUNKS]
+
+        if len(chunks) <= 1:
+            user_message = f"Analyze and summarize this content:\n\n{chunks[0] if chunks else file_content}"
+            if user_title:
+                user_message = f"Title: {user_title}\n\n{user_message}"
+            return await request_summary_json(user_message, api_key)
+
+        # Map: summarize every chunk concurrently (bounded; llm_client also caps global concurrency)
+        semaphore = asyncio.Semaphore(SUMMARY_MAP_CONCURRENCY)
+
+        async def summarize_chunk(index: int, chunk: str) -> dict:
+            user_message = f"Analyze and summarize part {index + 1} of {len(chunks)} of this content:\n\n{chunk}"
+            if user_title:
+                user_message = f"Title: {user_title}\n\n{user_message}"
+            async with semaphore:
+                return await request_summary_json(user_message, api_key)
+
+        partials = await asyncio.gather(*(summarize_chunk(i, chunk) for i, chunk in enumerate(chunks)))
+
+        # Reduce: merge the partial summaries into the NoteSummary schema
+        return await merge_summaries(list(partials), api_key, user_title)
+
+    except HTTPException:
+        raise
+    except LLMError as e:
+        raise HTTPException(status_code=e.status_code, detail=f"AI service error: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Summary processing error: {str(e)}")
 
 
+# Structured summaries keyed by content hash: an in-process LRU in front of the
+# Firestore `summary_cache` collection, so a lecture PDF uploaded by a whole class
+# is summarized once. Bump SUMMARY_PROMPT_VERSION whenever SUMMARY_SYSTEM_PROMPT,
+# the model or the request shape changes so stale entries stop matching.
+SUMMARY_PROMPT_VERSION = "2"
+SUMMARY_CACHE_SIZE = int(os.getenv("SUMMARY_CACHE_SIZE", "512"))
+summary_cache = TTLCache("structured_summaries", maxsize=SUMMARY_CACHE_SIZE)
+
+def summary_cache_key(file_content: str, user_title: str = None) -> str:
+    """Hash of the normalized content, title and prompt version"""
+    # Source banners carry upload filenames; drop them so renamed copies still match
+    content = re.sub(r"^--- .* ---$", "", file_content, flags=re.MULTILINE)
+    content = " ".join(content.split())
+    title = " ".join((user_title or "").split())
+    raw = json.dumps({"v": SUMMARY_PROMPT_VERSION, "title": title, "content": content})
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+async def get_cached_structured_summary(file_content: str, api_key: str, user_title: str = None):
+    """Return (summary_data, cache_hit), calling the model only on a miss"""
+    key = summary_cache_key(file_content, user_title)
+    cached = summary_cache.get(key)
+    if cached is not None:
+        return dict(cached), True
+
+    # The same handout uploaded by several students at once is summarized once
+    (summary_data, cache_hit), joined = await summary_flights.do_shared(
+        key, lambda: load_or_create_summary(key, file_content, api_key, user_title)
+    )
+    # Callers that joined another's flight made no model call of their own
+    return dict(summary_data), cache_hit or joined
+
+async def load_or_create_summary(key: str, file_content: str, api_key: str, user_title: str = None):
+    """Firestore `summary_cache` lookup, then the model; fills both cache tiers"""
+    cache_ref = db.collection("summary_cache").document(key)
+    try:
+        cache_doc = await cache_ref.get()
+        if cache_doc.exists:
+            summary_data = cache_doc.get("summary")
+            summary_cache.set(key, summary_data)
+            return summary_data, True
+    except Exception as e:
+        print(f"⚠️ Summary cache read failed: {e}")
+
+    summary_data = await get_structured_summary(file_content, api_key, user_title)
+    summary_cache.set(key, summary_data)
+    try:
+        await cache_ref.set({
+            "summary": summary_data,
+            "prompt_version": SUMMARY_PROMPT_VERSION,
+            "created_at": datetime.datetime.utcnow(),
+        })
+    except Exception as e:
+        print(f"⚠️ Summary cache write failed: {e}")
+    return summary_data, False
+
 
 # -------------------------------
 # AUTH ENDPOINTS
@@ -477,7 +863,8 @@ async def signup(request: SignupRequest):
     """Register new user account"""
     try:
         # Create Firebase user
-        user_record = auth.create_user(
+        user_record = await run_blocking(
+            auth.create_user,
             email=request.email,
             password=request.password,
             display_name=request.full_name
@@ -493,10 +880,10 @@ async def signup(request: SignupRequest):
             "created_at": datetime.datetime.utcnow(),
             "karma": 0
         }
-        db.collection("users").document(user_record.uid).set(user_data)
+        await db.collection("users").document(user_record.uid).set(user_data)
         
         # Generate custom token for immediate login
-        custom_token = auth.create_custom_token(user_record.uid)
+        custom_token = await run_blocking(auth.create_custom_token, user_record.uid)
         
         return AuthResponse(
             user_id=user_record.uid,
@@ -529,7 +916,8 @@ async def login(request: LoginRequest):
         print(f"🔐 Attempting login for: {request.email}")
         
         try:
-            sign_in_response = requests.post(
+            sign_in_response = await run_blocking(
+                requests.post,
                 sign_in_url,
                 json={
                     "email": request.email,
@@ -578,7 +966,7 @@ async def login(request: LoginRequest):
         print(f"✅ Login successful for user: {user_id}")
 
         # Get user profile
-        user_doc = db.collection("users").document(user_id).get()
+        user_doc = await db.collection("users").document(user_id).get()
         user_data = user_doc.to_dict() if user_doc.exists else {}
 
         return {
@@ -600,11 +988,11 @@ async def login(request: LoginRequest):
 async def google_auth(request: GoogleAuthRequest):
     """Google OAuth authentication"""
     try:
-        decoded_token = auth.verify_id_token(request.id_token)
+        decoded_token = await run_blocking(auth.verify_id_token, request.id_token)
         uid = decoded_token['uid']
         
         # Check if user exists, create if not
-        user_doc = db.collection("users").document(uid).get()
+        user_doc = await db.collection("users").document(uid).get()
         if not user_doc.exists:
             user_data = {
                 "email": decoded_token.get('email', ''),
@@ -613,7 +1001,7 @@ async def google_auth(request: GoogleAuthRequest):
                 "created_at": datetime.datetime.utcnow(),
                 "karma": 0
             }
-            db.collection("users").document(uid).set(user_data)
+            await db.collection("users").document(uid).set(user_data)
         else:
             user_data = user_doc.to_dict()
         
@@ -631,8 +1019,9 @@ async def signout(current_user: dict = Depends(get_current_user)):
     """Sign out current user"""
     # In Firebase, sign out is typically handled on the frontend
     # Backend can revoke tokens if needed
+    purge_cached_tokens(current_user['uid'])
     try:
-        auth.revoke_refresh_tokens(current_user['uid'])
+        await run_blocking(auth.revoke_refresh_tokens, current_user['uid'])
         return {"message": "Successfully signed out"}
     except Exception as e:
         return {"message": "Signed out (token revocation failed)"}
@@ -650,7 +1039,7 @@ async def get_me(email: Optional[str] = None, current_user: dict = Depends(get_c
     try:
         if email:
             # First, try Firestore by email
-            users_q = list(db.collection("users").where("email", "==", email).limit(1).stream())
+            users_q = await db.collection("users").where("email", "==", email).limit(1).get()
             if users_q:
                 doc = users_q[0]
                 data = doc.to_dict()
@@ -665,15 +1054,15 @@ async def get_me(email: Optional[str] = None, current_user: dict = Depends(get_c
 
             # Not found in Firestore → try Firebase Auth and upsert
             try:
-                user_record = auth.get_user_by_email(email)
+                user_record = await run_blocking(auth.get_user_by_email, email)
                 uid = user_record.uid
             except Exception:
                 raise HTTPException(status_code=404, detail="User not found")
 
             user_doc_ref = db.collection("users").document(uid)
-            user_doc = user_doc_ref.get()
+            user_doc = await user_doc_ref.get()
             if not user_doc.exists:
-                user_doc_ref.set({
+                await user_doc_ref.set({
                     "email": email,
                     "full_name": getattr(user_record, 'display_name', "") or "",
                     "university": None,
@@ -682,7 +1071,7 @@ async def get_me(email: Optional[str] = None, current_user: dict = Depends(get_c
                     "created_at": datetime.datetime.utcnow(),
                     "karma": 0,
                 })
-                data = user_doc_ref.get().to_dict()
+                data = (await user_doc_ref.get()).to_dict()
             else:
                 data = user_doc.to_dict()
 
@@ -697,7 +1086,7 @@ async def get_me(email: Optional[str] = None, current_user: dict = Depends(get_c
 
         # No email param: use current_user
         uid = current_user.get('uid')
-        user_doc = db.collection("users").document(uid).get()
+        user_doc = await db.collection("users").document(uid).get()
         if not user_doc.exists:
             raise HTTPException(status_code=404, detail="User profile not found")
         data = user_doc.to_dict()
@@ -724,17 +1113,17 @@ async def update_me(payload: ProfileUpdateRequest, email: Optional[str] = None,
 
         if email:
             try:
-                user_record = auth.get_user_by_email(email)
+                user_record = await run_blocking(auth.get_user_by_email, email)
                 uid = user_record.uid
             except Exception:
                 raise HTTPException(status_code=404, detail="User not found")
-            db.collection("users").document(uid).set({
+            await db.collection("users").document(uid).set({
                 "email": email,
                 **update_data
             }, merge=True)
         else:
             uid = current_user.get('uid')
-            db.collection("users").document(uid).set(update_data, merge=True)
+            await db.collection("users").document(uid).set(update_data, merge=True)
         return {"message": "Profile updated"}
     except HTTPException:
         raise
@@ -745,7 +1134,6 @@ async def update_me(payload: ProfileUpdateRequest, email: Optional[str] = None,
 # AI STUDY BOT ENDPOINTS
 # -------------------------------
 
-OPENAI_API_URL = "https://api.openai.com/v1/chat/completions"
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "your-openai-api-key-here")
 STUDY_BUDDY_SYSTEM_PROMPT = """You are an AI Study Buddy for a classroom discussion platform. Your role is to help students learn by:
 
@@ -783,6 +1171,166 @@ Rules:
 - Base difficulty on content complexity
 - Estimate realistic study time
 - Generate a clear, specific title that captures the main topic or lesson (e.g., "Introduction to Object-Oriented Programming", "Chemical Reactions and Equilibrium", "The French Revolution Overview")"""
+conversation_store = ConversationStore(db)
+
+async def prepare_study_buddy_turn(request: AIStudyRequest, current_user: dict, with_class_context: bool = True) -> dict:
+    """Load (or start) the conversation, append the user's message and resolve class context"""
+    # Generate or use existing conversation ID
+    conversation_id = request.conversation_id or str(uuid.uuid4())
+    
+    # Load the parent doc and only the messages not yet folded into its summary
+    conv_doc_ref = conversation_store.ref(conversation_id)
+    conv_doc = await conv_doc_ref.get()
+    
+    conv_data = conv_doc.to_dict() if conv_doc.exists else {}
+    conversation_history = [{"role": "system", "content": STUDY_BUDDY_SYSTEM_PROMPT}]
+    history_start = 0
+    if conv_doc.exists:
+        history_start, messages = await conversation_store.load_unsummarized(conv_doc_ref, conv_data)
+        conversation_history += messages
+    
+    # Add user message to history
+    conversation_history.append({"role": "user", "content": request.message})
+    
+    # Class material is only shared with members of the class
+    class_context = ""
+    if with_class_context and request.class_context and await get_membership(request.class_context, current_user['uid']):
+        class_context, excerpts = await asyncio.gather(
+            get_class_context(request.class_context, request.message),
+            get_class_excerpts(request.class_context, request.message),
+        )
+        if excerpts:
+            class_context = f"{class_context}\n\n{excerpts}" if class_context else excerpts
+    
+    return {
+        "conversation_id": conversation_id,
+        "conv_doc_ref": conv_doc_ref,
+        "conv_data": conv_data,
+        "created_at": conv_doc.get("created_at") if conv_doc.exists else datetime.datetime.utcnow(),
+        "history": conversation_history,
+        "summary": conv_data.get("summary", ""),
+        "history_start": history_start,
+        "class_id": request.class_context,
+        "class_context": class_context,
+    }
+
+# Conversations whose older turns are being folded into the summary (per process)
+_compacting_conversations = set()
+_compaction_tasks = set()
+
+async def compact_conversation(conv_doc_ref, history: List[Dict], summary: str, history_start: int):
+    """Fold older unsummarized turns into the conversation's rolling summary.
+
+    `history` is the system prompt followed by messages from seq `history_start` on.
+    """
+    pending = conversation_memory.pending_compaction(history)
+    if not pending or conv_doc_ref.id in _compacting_conversations:
+        return
+    _compacting_conversations.add(conv_doc_ref.id)
+    try:
+        data = {
+            "model": "gpt-3.5-turbo",
+            "messages": [{"role": "user", "content": conversation_memory.summary_prompt(summary, pending)}],
+            "max_tokens": conversation_memory.STUDY_BUDDY_SUMMARY_TOKENS,
+            "temperature": 0.3
+        }
+        new_summary = (await llm_client.chat_completion_text(data, OPENAI_API_KEY)).strip()
+        await conv_doc_ref.update({
+            "summary": new_summary,
+            "summarized_count": history_start + len(pending),
+        })
+    except Exception as e:
+        print(f"⚠️ Conversation compaction failed for {conv_doc_ref.id}: {e}")
+    finally:
+        _compacting_conversations.discard(conv_doc_ref.id)
+
+def schedule_conversation_compaction(conv_doc_ref, history: List[Dict], summary: str, history_start: int):
+    """Compact in the background so the turn that crosses the threshold is not slowed down"""
+    if not conversation_memory.pending_compaction(history):
+        return
+    task = asyncio.create_task(compact_conversation(conv_doc_ref, history, summary, history_start))
+    _compaction_tasks.add(task)
+    task.add_done_callback(_compaction_tasks.discard)
+
+async def save_study_buddy_turn(turn: dict, ai_response: str, current_user: dict, extra_fields: dict = None):
+    """Append the user message and assistant reply to the conversation in Firestore"""
+    turn["history"].append({"role": "assistant", "content": ai_response})
+    fields = {
+        "conversation_id": turn["conversation_id"],
+        "class_id": turn["class_id"],
+        "user_id": current_user['uid'],
+        "created_at": turn["created_at"],
+        **(extra_fields or {})
+    }
+    # Parent fields are merged, so `summary`/`summarized_count` (written only by compaction) survive
+    await conversation_store.append(turn["conv_doc_ref"], turn["conv_data"], turn["history"][-2:], fields)
+    schedule_conversation_compaction(turn["conv_doc_ref"], turn["history"], turn["summary"], turn["history_start"])
+
+async def lookup_cached_answer(turn: dict, message: str):
+    """Answer-cache lookup for a first turn in a class, else None.
+
+    Such a turn depends only on the class context and the question. The cache is
+    best-effort: an embedding failure falls through to the model.
+    """
+    if not (turn["class_context"] and len(turn["history"]) == 2 and not turn["summary"]):
+        return None
+    try:
+        return await study_buddy_answer_cache.lookup(turn["class_id"], message)
+    except Exception as e:
+        print(f"⚠️ Answer cache lookup failed for {turn['class_id']}: {e}")
+        return None
+
+def store_cached_answer(cached, ai_response: str, latency_seconds: float):
+    if cached is None:
+        return
+    try:
+        study_buddy_answer_cache.store(cached, ai_response, latency_seconds)
+    except Exception as e:
+        print(f"⚠️ Answer cache store failed for {cached.class_id}: {e}")
+
+def format_sse(data: dict, event: str = None) -> str:
+    """Encode one server-sent event frame"""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(data)}\n\n"
+
+async def stream_study_buddy_events(turn: dict, current_user: dict):
+    """Relay completion tokens as SSE frames, then persist the finished conversation"""
+    yield format_sse({"conversation_id": turn["conversation_id"]}, event="start")
+    parts = []
+    try:
+        cached = turn.get("cached_answer")
+        if cached and cached.answer:
+            # Replayed as a single delta so clients need no separate path
+            ai_response = cached.answer
+            yield format_sse({"delta": ai_response})
+        else:
+            started = time.perf_counter()
+            payload = build_study_buddy_payload(turn["history"], turn["class_context"], turn["summary"])
+            async for delta in llm_client.stream_chat_completion(payload, OPENAI_API_KEY):
+                parts.append(delta)
+                yield format_sse({"delta": delta})
+            ai_response = "".join(parts)
+            store_cached_answer(cached, ai_response, time.perf_counter() - started)
+        
+        # Only a completed stream is written to ai_conversations
+        await save_study_buddy_turn(turn, ai_response, current_user)
+        yield format_sse({
+            "conversation_id": turn["conversation_id"],
+            "response": ai_response,
+            "timestamp": datetime.datetime.utcnow().isoformat()
+        }, event="done")
+    except LLMError as e:
+        yield format_sse({"status_code": e.status_code, "detail": f"AI service error: {str(e)}"}, event="error")
+    except Exception as e:
+        yield format_sse({"status_code": 500, "detail": f"Study buddy error: {str(e)}"}, event="error")
+
+def study_buddy_stream_response(turn: dict, current_user: dict) -> StreamingResponse:
+    return StreamingResponse(
+        stream_study_buddy_events(turn, current_user),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/api/v1/ai-study-buddy", response_model=AIStudyResponse)
 async def chat_with_study_buddy(
     request: AIStudyRequest,
@@ -793,50 +1341,23 @@ async def chat_with_study_buddy(
         if not OPENAI_API_KEY or OPENAI_API_KEY == "your-openai-api-key-here":
             raise HTTPException(status_code=503, detail="AI service not configured")
         
-        # Generate or use existing conversation ID
-        conversation_id = request.conversation_id or str(uuid.uuid4())
+        turn = await prepare_study_buddy_turn(request, current_user)
         
-        # Get or create conversation history
-        conv_doc_ref = db.collection("ai_conversations").document(conversation_id)
-        conv_doc = conv_doc_ref.get()
-        
-        if conv_doc.exists:
-            conv_data = conv_doc.to_dict()
-            conversation_history = conv_data.get("messages", [])
+        cached = await lookup_cached_answer(turn, request.message)
+        if cached and cached.answer:
+            ai_response = cached.answer
         else:
-            # Initialize new conversation with system prompt
-            conversation_history = [
-                {"role": "system", "content": STUDY_BUDDY_SYSTEM_PROMPT}
-            ]
-        
-        # Add user message to history
-        conversation_history.append({"role": "user", "content": request.message})
-        
-        # Get class context if provided
-        class_context = ""
-        if request.class_context:
-            class_context = get_class_context(request.class_context, db)
-        
-        # Get AI response
-        ai_response = get_ai_response(conversation_history, OPENAI_API_KEY, class_context)
-        
-        # Add AI response to history
-        conversation_history.append({"role": "assistant", "content": ai_response})
+            # Get AI response
+            started = time.perf_counter()
+            ai_response = await get_ai_response(turn["history"], OPENAI_API_KEY, turn["class_context"], turn["summary"])
+            store_cached_answer(cached, ai_response, time.perf_counter() - started)
         
         # Save conversation to Firestore
-        conv_data = {
-            "conversation_id": conversation_id,
-            "messages": conversation_history,
-            "class_id": request.class_context,
-            "user_id": current_user['uid'],
-            "created_at": conv_doc.get("created_at") if conv_doc.exists else datetime.datetime.utcnow(),
-            "last_updated": datetime.datetime.utcnow()
-        }
-        conv_doc_ref.set(conv_data)
+        await save_study_buddy_turn(turn, ai_response, current_user)
         
         return AIStudyResponse(
             response=ai_response,
-            conversation_id=conversation_id,
+            conversation_id=turn["conversation_id"],
             timestamp=datetime.datetime.utcnow().isoformat()
         )
         
@@ -845,12 +1366,36 @@ async def chat_with_study_buddy(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Study buddy error: {str(e)}")
 
+@app.post("/api/v1/ai-study-buddy/stream")
+async def stream_with_study_buddy(
+    request: AIStudyRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Chat with AI Study Buddy, streaming the reply as server-sent events.
+
+    Events: `start` (conversation_id), unnamed `data: {"delta": ...}` frames per token,
+    then `done` (full response) once the conversation is saved, or `error`.
+    """
+    try:
+        if not OPENAI_API_KEY or OPENAI_API_KEY == "your-openai-api-key-here":
+            raise HTTPException(status_code=503, detail="AI service not configured")
+        
+        turn = await prepare_study_buddy_turn(request, current_user)
+        turn["cached_answer"] = await lookup_cached_answer(turn, request.message)
+        return study_buddy_stream_response(turn, current_user)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Study buddy error: {str(e)}")
+
 @app.get("/api/v1/ai-study-buddy/conversations")
 async def get_study_buddy_conversations(
     current_user: dict = Depends(get_current_user)
 ):
     """Get user's AI study buddy conversation history"""
     try:
+        # Parent docs carry denormalized preview/message_count; messages are not read
         conversations = (db.collection("ai_conversations")
                         .where("user_id", "==", current_user['uid'])
                         .order_by("last_updated", direction=firestore.Query.DESCENDING)
@@ -858,21 +1403,16 @@ async def get_study_buddy_conversations(
                         .stream())
         
         conversation_list = []
-        for conv in conversations:
+        async for conv in conversations:
             conv_data = conv.to_dict()
-            # Get the first user message as preview
-            first_message = ""
-            for msg in conv_data.get("messages", []):
-                if msg.get("role") == "user":
-                    first_message = msg.get("content", "")[:100] + "..."
-                    break
+            legacy_messages = [m for m in conv_data.get("messages", []) if m.get("role") != "system"]
             
             conversation_list.append({
                 "conversation_id": conv_data.get("conversation_id"),
-                "preview": first_message,
+                "preview": conv_data.get("preview") or conversation_preview(legacy_messages),
                 "class_id": conv_data.get("class_id"),
                 "last_updated": serialize_datetime(conv_data.get("last_updated")),
-                "message_count": len([m for m in conv_data.get("messages", []) if m.get("role") != "system"])
+                "message_count": conv_data.get("message_count", len(legacy_messages))
             })
         
         return {"conversations": conversation_list}
@@ -887,7 +1427,8 @@ async def get_conversation_details(
 ):
     """Get specific AI study buddy conversation"""
     try:
-        conv_doc = db.collection("ai_conversations").document(conversation_id).get()
+        conv_doc_ref = conversation_store.ref(conversation_id)
+        conv_doc = await conv_doc_ref.get()
         if not conv_doc.exists:
             raise HTTPException(status_code=404, detail="Conversation not found")
         
@@ -897,15 +1438,14 @@ async def get_conversation_details(
         if conv_data.get("user_id") != current_user['uid']:
             raise HTTPException(status_code=403, detail="Access denied")
         
-        # Format messages for response (exclude system message)
+        # Format messages for response (the system prompt is not stored)
         formatted_messages = []
-        for msg in conv_data.get("messages", []):
-            if msg.get("role") != "system":
-                formatted_messages.append({
-                    "role": msg.get("role"),
-                    "content": msg.get("content"),
-                    "timestamp": serialize_datetime(conv_data.get("last_updated"))
-                })
+        for msg in await conversation_store.list_messages(conv_doc_ref, conv_data):
+            formatted_messages.append({
+                "role": msg.get("role"),
+                "content": msg.get("content"),
+                "timestamp": serialize_datetime(msg.get("created_at") or conv_data.get("last_updated"))
+            })
         
         return {
             "conversation_id": conversation_id,
@@ -924,13 +1464,13 @@ async def get_conversation_details(
 async def class_specific_study_buddy(
     class_id: str,
     request: AIStudyRequest,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    membership: Optional[dict] = Depends(class_membership)
 ):
     """Chat with AI Study Buddy in context of specific class"""
     try:
         # Verify user is member of class
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        if membership is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
         
         # Set class context and call main study buddy endpoint
@@ -942,35 +1482,100 @@ async def class_specific_study_buddy(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Class study buddy error: {str(e)}")
 
+@app.post("/api/v1/classes/{class_id}/ai-study-buddy/stream")
+async def class_specific_study_buddy_stream(
+    class_id: str,
+    request: AIStudyRequest,
+    current_user: dict = Depends(get_current_user),
+    membership: Optional[dict] = Depends(class_membership)
+):
+    """Streaming (SSE) variant of the class-specific AI Study Buddy"""
+    try:
+        # Verify user is member of class
+        if membership is None:
+            raise HTTPException(status_code=403, detail="Not a member of this class")
+        
+        request.class_context = class_id
+        return await stream_with_study_buddy(request, current_user)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Class study buddy error: {str(e)}")
+
+# The opening help for a post is the same prompt for every student, so its reply is
+# generated once and stored on the post as `ai_help`, keyed by a hash of the prompt
+POST_HELP_VERSION = "1"
+
+def post_help_message(post_data: dict) -> str:
+    return f"I'm looking at this post: '{post_data.get('title')}' - {(post_data.get('content') or '')[:200]}... Can you help me understand this better?"
+
+def post_help_source_hash(message: str) -> str:
+    """Changes when the post's title or content (or the study-buddy prompt) changes"""
+    return hashlib.sha256(f"{POST_HELP_VERSION}\n{STUDY_BUDDY_SYSTEM_PROMPT}\n{message}".encode("utf-8")).hexdigest()
+
+async def generate_post_help(post_ref, turn: dict, source_hash: str) -> str:
+    """Run the opening help turn for a post and store the reply on the post"""
+    ai_response = await get_ai_response(turn["history"], OPENAI_API_KEY, turn["class_context"], turn["summary"])
+    try:
+        await post_ref.update({"ai_help": {
+            "source_hash": source_hash,
+            "response": ai_response,
+            "created_at": datetime.datetime.utcnow()
+        }})
+    except Exception as e:
+        print(f"⚠️ Could not store AI help for post {post_ref.id}: {e}")
+    return ai_response
+
 # Add this endpoint to integrate AI suggestions with posts
 @app.post("/api/v1/classes/{class_id}/posts/{post_id}/ai-help")
 async def get_ai_help_for_post(
     class_id: str,
     post_id: str,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    membership: Optional[dict] = Depends(class_membership)
 ):
     """Get AI study buddy help for a specific post"""
     try:
         # Verify user is member of class
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        if membership is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
         
+        if not OPENAI_API_KEY or OPENAI_API_KEY == "your-openai-api-key-here":
+            raise HTTPException(status_code=503, detail="AI service not configured")
+        
         # Get post content
-        post_doc = (db.collection("classes").document(class_id)
-                   .collection("posts").document(post_id).get())
+        post_ref = (db.collection("classes").document(class_id)
+                    .collection("posts").document(post_id))
+        post_doc = await post_ref.get()
         if not post_doc.exists:
             raise HTTPException(status_code=404, detail="Post not found")
         
         post_data = post_doc.to_dict()
+        message = post_help_message(post_data)
+        source_hash = post_help_source_hash(message)
+        cached_help = post_data.get("ai_help") or {}
+        cache_hit = cached_help.get("source_hash") == source_hash and bool(cached_help.get("response"))
         
-        # Create AI request based on post content
-        ai_request = AIStudyRequest(
-            message=f"I'm looking at this post: '{post_data.get('title')}' - {post_data.get('content')[:200]}... Can you help me understand this better?",
-            class_context=class_id
-        )
+        # Every student gets their own conversation, seeded with the shared first turn
+        ai_request = AIStudyRequest(message=message, class_context=class_id)
+        turn = await prepare_study_buddy_turn(ai_request, current_user, with_class_context=not cache_hit)
+        
+        if cache_hit:
+            ai_response = cached_help["response"]
+        else:
+            # Students opening a fresh post together share one generation
+            ai_response = await post_help_flights.do(
+                (class_id, post_id, source_hash), lambda: generate_post_help(post_ref, turn, source_hash)
+            )
         
-        return await chat_with_study_buddy(ai_request, current_user)
+        await save_study_buddy_turn(turn, ai_response, current_user, {"post_id": post_id})
+        
+        return AIStudyResponse(
+            response=ai_response,
+            conversation_id=turn["conversation_id"],
+            timestamp=datetime.datetime.utcnow().isoformat()
+        )
         
     except HTTPException:
         raise
@@ -1004,7 +1609,7 @@ async def create_class(request: CreateClassRequest, email: Optional[str] = None,
     try:
         # Resolve creator uid
         if email:
-            user_record = auth.get_user_by_email(email)
+            user_record = await run_blocking(auth.get_user_by_email, email)
             creator_uid = user_record.uid
         else:
             creator_uid = current_user.get('uid')
@@ -1012,6 +1617,8 @@ async def create_class(request: CreateClassRequest, email: Optional[str] = None,
         class_ref = db.collection("classes").document()
         class_id = class_ref.id
         code = generate_class_code()
+        creator_doc = await db.collection("users").document(creator_uid).get()
+        teacher_name = (creator_doc.to_dict() or {}).get("full_name", "") if creator_doc.exists else ""
         class_doc = {
             "name": request.name,
             "code": code,
@@ -1019,8 +1626,10 @@ async def create_class(request: CreateClassRequest, email: Optional[str] = None,
             "createdAt": datetime.datetime.utcnow(),
             "joinMode": request.join_mode,
             "visibility": request.visibility,
+            "teacher_id": creator_uid,
+            **class_search_fields(request.name, teacher_name),
         }
-        class_ref.set(class_doc)
+        await class_ref.set(class_doc)
 
         # Add creator as instructor member
         member_doc = {
@@ -1029,7 +1638,7 @@ async def create_class(request: CreateClassRequest, email: Optional[str] = None,
             "role": "instructor",
             "joinedAt": datetime.datetime.utcnow()
         }
-        db.collection("classMembers").document(f"{class_id}_{creator_uid}").set(member_doc)
+        await db.collection("classMembers").document(f"{class_id}_{creator_uid}").set(member_doc)
 
         return {
             "class_id": class_id,
@@ -1039,13 +1648,14 @@ async def create_class(request: CreateClassRequest, email: Optional[str] = None,
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to create class: {str(e)}")
 @app.get("/api/v1/classes")
-async def get_user_classes(email: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+async def get_user_classes(email: Optional[str] = None, current_user: dict = Depends(get_current_user),
+                           loader: DocumentLoader = Depends(get_document_loader)):
     """Get user's enrolled classes. In dev, allow ?email=... to resolve uid via Firebase Auth."""
     try:
         # Resolve uid from email if provided (dev convenience), else use current user
         if email:
             try:
-                user_record = auth.get_user_by_email(email)
+                user_record = await run_blocking(auth.get_user_by_email, email)
                 resolved_uid = user_record.uid
             except Exception:
                 raise HTTPException(status_code=404, detail="User not found")
@@ -1053,17 +1663,16 @@ async def get_user_classes(email: Optional[str] = None, current_user: dict = Dep
             resolved_uid = current_user['uid']
 
         # Get user's class memberships
-        memberships = db.collection("classMembers").where("userId", "==", resolved_uid).stream()
+        memberships = [m.to_dict() for m in await db.collection("classMembers").where("userId", "==", resolved_uid).get()]
+        
+        # Get class details in one batched read
+        class_docs = await loader.load_data("classes", (m.get("classId") for m in memberships))
         
         classes = []
-        for membership in memberships:
-            member_data = membership.to_dict()
+        for member_data in memberships:
             class_id = member_data.get("classId")
-            
-            # Get class details
-            class_doc = db.collection("classes").document(class_id).get()
-            if class_doc.exists:
-                class_data = class_doc.to_dict()
+            class_data = class_docs.get(class_id)
+            if class_data is not None:
                 classes.append({
                     "class_id": class_id,
                     "name": class_data.get("name"),
@@ -1083,74 +1692,52 @@ async def search_classes(
     limit: int = 20,
     current_user: dict = Depends(get_current_user)
 ):
-    """Search for classes by name or teacher name"""
+    """Search for classes by name or teacher name (case-insensitive partial match)"""
     try:
-        if not name and not teacher:
+        name_q = normalize_search_text(name or "")
+        teacher_q = normalize_search_text(teacher or "")
+        if not name_q and not teacher_q:
             raise HTTPException(status_code=400, detail="Must provide at least one search parameter: name or teacher")
 
-        # Start with all classes
-        query = db.collection("classes")
-
-        # Build query based on provided parameters
-        # Note: Firestore doesn't support full-text search or case-insensitive queries natively,
-        # so we'll do client-side filtering for more flexible matching
-        classes = list(query.stream())
+        # One indexed query on the more selective term; the other is checked in memory
+        # against the denormalized fields on the class doc.
+        if name_q and (len(name_q) >= len(teacher_q)):
+            token = search_query_token(name_q, "name")
+        else:
+            token = search_query_token(teacher_q, "teacher")
+        candidates = await (db.collection("classes")
+                            .where("search_tokens", "array_contains", token)
+                            .limit(SEARCH_CANDIDATE_LIMIT)
+                            .get())
+
+        ranked = []
+        for class_doc in candidates:
+            class_data = class_doc.to_dict()
+            class_name = normalize_search_text(class_data.get("name") or "")
+            teacher_name = normalize_search_text(class_data.get("teacher_name") or "")
 
-        results = []
-        name_lower = name.lower() if name else None
-        teacher_lower = teacher.lower() if teacher else None
+            if name_q and name_q not in class_name:
+                continue
+            if teacher_q and teacher_q not in teacher_name:
+                continue
 
-        for class_doc in classes:
-            class_data = class_doc.to_dict()
-            class_name = (class_data.get("name") or "").lower()
-            teacher_id = class_data.get("teacher_id")
-
-            # Check name match
-            name_match = not name_lower or name_lower in class_name
-
-            # Check teacher match - need to get teacher's full name
-            teacher_match = True
-            if teacher_lower and teacher_id:
-                try:
-                    teacher_doc = db.collection("users").document(teacher_id).get()
-                    if teacher_doc.exists:
-                        teacher_data = teacher_doc.to_dict()
-                        teacher_full_name = (teacher_data.get("full_name") or "").lower()
-                        teacher_match = teacher_lower in teacher_full_name
-                    else:
-                        teacher_match = False
-                except Exception:
-                    teacher_match = False
-            elif teacher_lower:
-                teacher_match = False
-
-            # Include if both conditions match
-            if name_match and teacher_match:
-                # Get teacher info for result
-                teacher_info = {}
-                if teacher_id:
-                    try:
-                        teacher_doc = db.collection("users").document(teacher_id).get()
-                        if teacher_doc.exists:
-                            teacher_data = teacher_doc.to_dict()
-                            teacher_info = {
-                                "teacher_id": teacher_id,
-                                "teacher_name": teacher_data.get("full_name", "Unknown")
-                            }
-                    except Exception:
-                        pass
-
-                results.append({
-                    "class_id": class_doc.id,
-                    "name": class_data.get("name"),
-                    "code": class_data.get("code"),
-                    "created_at": serialize_datetime(class_data.get("createdAt")),
-                    **teacher_info
-                })
+            rank = min(
+                search_match_rank(name_q, class_name) if name_q else 3,
+                search_match_rank(teacher_q, teacher_name) if teacher_q else 3,
+            )
+            ranked.append((rank, len(class_name), class_name, class_doc.id, class_data))
 
-                # Apply limit
-                if len(results) >= limit:
-                    break
+        ranked.sort(key=lambda r: r[:3])
+        results = []
+        for _, _, _, class_id, class_data in ranked[:limit]:
+            results.append({
+                "class_id": class_id,
+                "name": class_data.get("name"),
+                "code": class_data.get("code"),
+                "created_at": serialize_datetime(class_data.get("createdAt")),
+                "teacher_id": class_data.get("teacher_id") or class_data.get("createdBy"),
+                "teacher_name": class_data.get("teacher_name", "Unknown"),
+            })
 
         return {"classes": results}
     except HTTPException:
@@ -1166,7 +1753,7 @@ async def join_class_by_code(request: JoinClassRequest, email: Optional[str] = N
         
         # Find class by code
         classes_query = db.collection("classes").where("code", "==", code).limit(1)
-        classes = list(classes_query.stream())
+        classes = await classes_query.get()
         
         if not classes:
             raise HTTPException(status_code=404, detail="Invalid class code")
@@ -1178,7 +1765,7 @@ async def join_class_by_code(request: JoinClassRequest, email: Optional[str] = N
         # Resolve user id
         if email:
             try:
-                user_record = auth.get_user_by_email(email)
+                user_record = await run_blocking(auth.get_user_by_email, email)
                 uid = user_record.uid
             except Exception:
                 raise HTTPException(status_code=404, detail="User not found")
@@ -1186,8 +1773,7 @@ async def join_class_by_code(request: JoinClassRequest, email: Optional[str] = N
             uid = current_user['uid']
         
         # Check if already a member
-        member_doc = db.collection("classMembers").document(f"{class_id}_{uid}").get()
-        if member_doc.exists:
+        if await get_membership(class_id, uid) is not None:
             return {"message": "Already a member of this class", "class_id": class_id}
         
         # Add as student
@@ -1197,7 +1783,8 @@ async def join_class_by_code(request: JoinClassRequest, email: Optional[str] = N
             "role": "student",
             "joinedAt": datetime.datetime.utcnow()
         }
-        db.collection("classMembers").document(f"{class_id}_{uid}").set(member_data)
+        await db.collection("classMembers").document(f"{class_id}_{uid}").set(member_data)
+        invalidate_membership(class_id, uid)
         
         return {
             "message": "Successfully joined class",
@@ -1210,52 +1797,49 @@ async def join_class_by_code(request: JoinClassRequest, email: Optional[str] = N
         raise HTTPException(status_code=500, detail=f"Failed to join class: {str(e)}")
 
 @app.get("/api/v1/classes/{class_id}")
-async def get_class_details(class_id: str, limit: int = 20, offset: int = 0, 
-                           current_user: dict = Depends(get_current_user)):
+async def get_class_details(class_id: str, limit: int = 20, cursor: Optional[str] = None,
+                           current_user: dict = Depends(get_current_user),
+                           membership: Optional[dict] = Depends(class_membership),
+                           loader: DocumentLoader = Depends(get_document_loader)):
     """Get class details and posts"""
     try:
         # Verify user is member of class (student OR instructor) - this was also part of the issue
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        if membership is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
         
-        user_role = member_doc.to_dict().get("role", "student")
+        user_role = membership.get("role", "student")
         
         # Get class details
-        class_doc = db.collection("classes").document(class_id).get()
+        class_doc = await db.collection("classes").document(class_id).get()
         if not class_doc.exists:
             raise HTTPException(status_code=404, detail="Class not found")
         
         class_data = class_doc.to_dict()
         
-        # Get posts with pagination
-        posts_query = (db.collection("classes").document(class_id)
-                      .collection("posts")
-                      .order_by("createdAt", direction=firestore.Query.DESCENDING)
-                      .limit(limit)
-                      .offset(offset))
+        # Get posts with cursor pagination
+        posts_col = db.collection("classes").document(class_id).collection("posts")
+        posts_query = posts_col.order_by("createdAt", direction=firestore.Query.DESCENDING)
+        post_docs, next_cursor = await fetch_page(posts_query, posts_col, limit, cursor)
+        
+        # Counters and author name live on the post document; the caller's votes
+        # for the whole page come back in one batched read.
+        vote_snaps = await loader.load_many(
+            post_doc.reference.collection("votes").document(current_user['uid']) for post_doc in post_docs
+        )
+        my_votes = {
+            snap.reference.parent.parent.id: snap.get("value")
+            for snap in vote_snaps.values() if snap is not None and snap.exists
+        }
+        
+        # Posts written before counters were denormalized (until backfill.py runs)
+        legacy_authors = await loader.load_data(
+            "users", (data.get("authorId") for data in (d.to_dict() for d in post_docs) if data.get("author_name") is None)
+        )
         
         posts = []
-        for post_doc in posts_query.stream():
+        for post_doc in post_docs:
             post_data = post_doc.to_dict()
-            
-            # Get author info
-            author_doc = db.collection("users").document(post_data.get("authorId", "")).get()
-            author_data = author_doc.to_dict() if author_doc.exists else {}
-            # Aggregate votes
-            votes_col = (db.collection("classes").document(class_id)
-                         .collection("posts").document(post_doc.id)
-                         .collection("votes"))
-            upvotes = len(list(votes_col.where("value", "==", 1).stream()))
-            downvotes = len(list(votes_col.where("value", "==", -1).stream()))
-            score = upvotes - downvotes
-            my_vote_doc = votes_col.document(current_user['uid']).get()
-            my_vote = my_vote_doc.to_dict().get("value") if my_vote_doc.exists else 0
-            # Count comments
-            comments_col = (db.collection("classes").document(class_id)
-                            .collection("posts").document(post_doc.id)
-                            .collection("comments"))
-            comment_count = len(list(comments_col.stream()))
+            author_name = post_data.get("author_name") or legacy_authors.get(post_data.get("authorId"), {}).get("full_name", "Unknown")
             
             posts.append({
                 "post_id": post_doc.id,
@@ -1264,12 +1848,14 @@ async def get_class_details(class_id: str, limit: int = 20, offset: int = 0,
                 "post_type": post_data.get("post_type", "discussion"),
                 "tags": post_data.get("tags", []),
                 "author_id": post_data.get("authorId"),
-                "author_name": author_data.get("full_name", "Unknown"),
+                "author_name": author_name,
                 "created_at": serialize_datetime(post_data.get("createdAt")),
                 "files": post_data.get("files", []),
-                "score": score,
-                "my_vote": my_vote,
-                "comment_count": comment_count
+                "score": post_data.get("score", 0),
+                "upvotes": post_data.get("upvotes", 0),
+                "downvotes": post_data.get("downvotes", 0),
+                "my_vote": my_votes.get(post_doc.id, 0),
+                "comment_count": post_data.get("comment_count", 0)
             })
         
         return {
@@ -1286,8 +1872,8 @@ async def get_class_details(class_id: str, limit: int = 20, offset: int = 0,
             "posts": posts,
             "pagination": {
                 "limit": limit,
-                "offset": offset,
-                "has_more": len(posts) == limit
+                "next_cursor": next_cursor,
+                "has_more": next_cursor is not None
             }
         }
     except HTTPException:
@@ -1304,7 +1890,7 @@ async def delete_class(class_id: str, email: Optional[str] = None, current_user:
         # Resolve acting uid
         if email:
             try:
-                user_record = auth.get_user_by_email(email)
+                user_record = await run_blocking(auth.get_user_by_email, email)
                 uid = user_record.uid
             except Exception:
                 raise HTTPException(status_code=404, detail="User not found")
@@ -1313,38 +1899,43 @@ async def delete_class(class_id: str, email: Optional[str] = None, current_user:
 
         # Verify class exists
         class_ref = db.collection("classes").document(class_id)
-        class_doc = class_ref.get()
+        class_doc = await class_ref.get()
         if not class_doc.exists:
             raise HTTPException(status_code=404, detail="Class not found")
         class_data = class_doc.to_dict()
 
         # Verify user is instructor and creator
         creator_uid = class_data.get("createdBy")
-        member_doc = db.collection("classMembers").document(f"{class_id}_{uid}").get()
-        if not member_doc.exists or member_doc.to_dict().get("role") != "instructor" or uid != creator_uid:
+        membership = await get_membership(class_id, uid)
+        if membership is None or membership.get("role") != "instructor" or uid != creator_uid:
             raise HTTPException(status_code=403, detail="Only the creating instructor can delete this class")
 
         # Best-effort delete subcollections
-        def _delete_subcollection(parent_ref, sub_name):
+        async def _delete_subcollection(parent_ref, sub_name):
             try:
-                for doc in parent_ref.collection(sub_name).stream():
-                    doc.reference.delete()
+                async for doc in parent_ref.collection(sub_name).stream():
+                    await doc.reference.delete()
             except Exception:
                 pass
 
-        _delete_subcollection(class_ref, "posts")
-        _delete_subcollection(class_ref, "assignments")
-        _delete_subcollection(class_ref, "grades")
+        await _delete_subcollection(class_ref, "posts")
+        await _delete_subcollection(class_ref, "assignments")
+        await _delete_subcollection(class_ref, "grades")
+        await _delete_subcollection(class_ref, "image_hashes")
 
         # Delete memberships for this class
         try:
-            for m in db.collection("classMembers").where("classId", "==", class_id).stream():
-                m.reference.delete()
+            async for m in db.collection("classMembers").where("classId", "==", class_id).stream():
+                await m.reference.delete()
         except Exception:
             pass
 
         # Finally delete the class document
-        class_ref.delete()
+        await class_ref.delete()
+        invalidate_membership(class_id)
+        image_hash_index.invalidate(class_id)
+        invalidate_class_content(class_id)
+        await class_vector_index.drop(class_id)
 
         return {"message": "Class deleted"}
     except HTTPException:
@@ -1354,18 +1945,21 @@ async def delete_class(class_id: str, email: Optional[str] = None, current_user:
 
 @app.post("/api/v1/classes/{class_id}/posts")
 async def create_post(class_id: str, request: CreatePostRequest, 
-                     current_user: dict = Depends(get_current_user)):
+                     current_user: dict = Depends(get_current_user),
+                     membership: Optional[dict] = Depends(class_membership)):
     """Create new post in class"""
     try:
         # Verify user is member of class
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        if membership is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
         
         # Create post
         post_ref = (db.collection("classes").document(class_id)
                    .collection("posts").document())
         
+        author_doc = await db.collection("users").document(current_user['uid']).get()
+        author_data = author_doc.to_dict() if author_doc.exists else {}
+        
         post_data = {
             "title": request.title,
             "content": request.content,
@@ -1374,9 +1968,16 @@ async def create_post(class_id: str, request: CreatePostRequest,
             "files": request.files,
             "authorId": current_user['uid'],
             "createdAt": datetime.datetime.utcnow(),
-            "isPublic": True
+            "isPublic": True,
+            # Denormalized feed fields, kept current by vote_on_post / add_post_comment
+            "author_name": author_data.get("full_name", "Unknown"),
+            "score": 0,
+            "upvotes": 0,
+            "downvotes": 0,
+            "comment_count": 0
         }
-        post_ref.set(post_data)
+        await post_ref.set(post_data)
+        invalidate_class_content(class_id, vector_index.post_chunks(post_ref.id, post_data))
         
         return {
             "message": "Post created successfully",
@@ -1387,69 +1988,100 @@ async def create_post(class_id: str, request: CreatePostRequest,
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to create post: {str(e)}")
 
+@firestore.async_transactional
+async def apply_vote(transaction, post_ref, vote_ref, uid: str, value: int):
+    """Write the caller's vote and adjust the post's denormalized counters atomically"""
+    post_snap = await post_ref.get(transaction=transaction)
+    if not post_snap.exists:
+        return None
+    vote_snap = await vote_ref.get(transaction=transaction)
+    previous = vote_snap.get("value") if vote_snap.exists else 0
+
+    up_delta = int(value == 1) - int(previous == 1)
+    down_delta = int(value == -1) - int(previous == -1)
+
+    if value == 0:
+        transaction.delete(vote_ref)
+    else:
+        transaction.set(vote_ref, {
+            "userId": uid,
+            "value": value,
+            "updatedAt": datetime.datetime.utcnow(),
+        })
+    if up_delta or down_delta:
+        transaction.update(post_ref, {
+            "upvotes": firestore.Increment(up_delta),
+            "downvotes": firestore.Increment(down_delta),
+            "score": firestore.Increment(up_delta - down_delta),
+        })
+
+    post_data = post_snap.to_dict()
+    return {
+        "score": post_data.get("score", 0) + up_delta - down_delta,
+        "upvotes": post_data.get("upvotes", 0) + up_delta,
+        "downvotes": post_data.get("downvotes", 0) + down_delta,
+    }
+
+@firestore.async_transactional
+async def apply_comment(transaction, post_ref, comment_ref, comment_data: dict) -> bool:
+    """Create a comment and bump the post's comment_count atomically"""
+    post_snap = await post_ref.get(transaction=transaction)
+    if not post_snap.exists:
+        return False
+    transaction.create(comment_ref, comment_data)
+    transaction.update(post_ref, {"comment_count": firestore.Increment(1)})
+    return True
+
 @app.post("/api/v1/classes/{class_id}/posts/{post_id}/vote")
-async def vote_on_post(class_id: str, post_id: str, request: VoteRequest, current_user: dict = Depends(get_current_user)):
+async def vote_on_post(class_id: str, post_id: str, request: VoteRequest, current_user: dict = Depends(get_current_user),
+                       membership: Optional[dict] = Depends(class_membership)):
     """Upvote/downvote/unvote a post. value in {-1, 0, 1}."""
     try:
         if request.value not in (-1, 0, 1):
             raise HTTPException(status_code=400, detail="Invalid vote value")
 
         # Membership check
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        if membership is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
 
         post_ref = (db.collection("classes").document(class_id)
                     .collection("posts").document(post_id))
-        if not post_ref.get().exists:
-            raise HTTPException(status_code=404, detail="Post not found")
-
         vote_ref = post_ref.collection("votes").document(current_user['uid'])
-        if request.value == 0:
-            vote_ref.delete()
-        else:
-            vote_ref.set({
-                "userId": current_user['uid'],
-                "value": request.value,
-                "updatedAt": datetime.datetime.utcnow(),
-            })
 
-        # Recompute score and my vote
-        votes_col = post_ref.collection("votes")
-        upvotes = len(list(votes_col.where("value", "==", 1).stream()))
-        downvotes = len(list(votes_col.where("value", "==", -1).stream()))
-        score = upvotes - downvotes
-        my_vote_doc = vote_ref.get()
-        my_vote = my_vote_doc.to_dict().get("value") if my_vote_doc.exists else 0
+        counters = await apply_vote(db.transaction(), post_ref, vote_ref, current_user['uid'], request.value)
+        if counters is None:
+            raise HTTPException(status_code=404, detail="Post not found")
 
-        return {"score": score, "my_vote": my_vote}
+        return {"score": counters["score"], "my_vote": request.value}
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to vote: {str(e)}")
 
 @app.get("/api/v1/classes/{class_id}/posts/{post_id}/comments")
-async def list_post_comments(class_id: str, post_id: str, limit: int = 50, current_user: dict = Depends(get_current_user)):
+async def list_post_comments(class_id: str, post_id: str, limit: int = 50, cursor: Optional[str] = None,
+                             current_user: dict = Depends(get_current_user),
+                             membership: Optional[dict] = Depends(class_membership),
+                             loader: DocumentLoader = Depends(get_document_loader)):
     """List comments for a post."""
     try:
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        if membership is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
 
         post_ref = (db.collection("classes").document(class_id)
                     .collection("posts").document(post_id))
-        if not post_ref.get().exists:
+        if not (await post_ref.get()).exists:
             raise HTTPException(status_code=404, detail="Post not found")
 
-        q = (post_ref.collection("comments")
-             .order_by("createdAt", direction=firestore.Query.DESCENDING)
-             .limit(limit))
+        comments_col = post_ref.collection("comments")
+        q = comments_col.order_by("createdAt", direction=firestore.Query.DESCENDING)
+        comment_docs, next_cursor = await fetch_page(q, comments_col, limit, cursor)
 
+        authors = await loader.load_data("users", (cdoc.to_dict().get("authorId") for cdoc in comment_docs))
         results = []
-        for cdoc in q.stream():
+        for cdoc in comment_docs:
             c = cdoc.to_dict()
-            user_doc = db.collection("users").document(c.get("authorId", "")).get()
-            u = user_doc.to_dict() if user_doc.exists else {}
+            u = authors.get(c.get("authorId"), {})
             results.append({
                 "comment_id": cdoc.id,
                 "content": c.get("content", ""),
@@ -1458,34 +2090,35 @@ async def list_post_comments(class_id: str, post_id: str, limit: int = 50, curre
                 "created_at": serialize_datetime(c.get("createdAt")),
             })
 
-        return {"comments": results}
+        return {"comments": results, "next_cursor": next_cursor}
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to list comments: {str(e)}")
 
 @app.post("/api/v1/classes/{class_id}/posts/{post_id}/comments")
-async def add_post_comment(class_id: str, post_id: str, request: CreateCommentRequest, current_user: dict = Depends(get_current_user)):
+async def add_post_comment(class_id: str, post_id: str, request: CreateCommentRequest, current_user: dict = Depends(get_current_user),
+                           membership: Optional[dict] = Depends(class_membership)):
     """Add a comment to a post."""
     try:
         if not request.content or not request.content.strip():
             raise HTTPException(status_code=400, detail="Content is required")
 
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        if membership is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
 
         post_ref = (db.collection("classes").document(class_id)
                     .collection("posts").document(post_id))
-        if not post_ref.get().exists:
-            raise HTTPException(status_code=404, detail="Post not found")
 
         c_ref = post_ref.collection("comments").document()
-        c_ref.set({
+        created = await apply_comment(db.transaction(), post_ref, c_ref, {
             "content": request.content.strip(),
             "authorId": current_user['uid'],
             "createdAt": datetime.datetime.utcnow(),
         })
+        if not created:
+            raise HTTPException(status_code=404, detail="Post not found")
+        invalidate_class_content(class_id, vector_index.comment_chunks(post_id, c_ref.id, request.content.strip()))
 
         return {"message": "Comment added", "comment_id": c_ref.id}
     except HTTPException:
@@ -1494,14 +2127,14 @@ async def add_post_comment(class_id: str, post_id: str, request: CreateCommentRe
         raise HTTPException(status_code=500, detail=f"Failed to add comment: {str(e)}")
 
 @app.post("/api/v1/classes/{class_id}/assignments")
-async def create_assignment(class_id: str, request: CreateAssignmentRequest, current_user: dict = Depends(get_current_user)):
+async def create_assignment(class_id: str, request: CreateAssignmentRequest, current_user: dict = Depends(get_current_user),
+                            membership: Optional[dict] = Depends(class_membership)):
     """Create an assignment (instructors only)."""
     try:
         # Verify membership and role
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        if membership is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
-        role = member_doc.to_dict().get("role")
+        role = membership.get("role")
         if role != "instructor":
             raise HTTPException(status_code=403, detail="Only instructors can create assignments")
 
@@ -1516,7 +2149,7 @@ async def create_assignment(class_id: str, request: CreateAssignmentRequest, cur
             "createdAt": datetime.datetime.utcnow(),
             "createdBy": current_user['uid'],
         }
-        asg_ref.set(assignment_data)
+        await asg_ref.set(assignment_data)
 
         return {"message": "Assignment created", "assignment_id": asg_ref.id}
     except HTTPException:
@@ -1525,18 +2158,18 @@ async def create_assignment(class_id: str, request: CreateAssignmentRequest, cur
         raise HTTPException(status_code=500, detail=f"Failed to create assignment: {str(e)}")
 
 @app.get("/api/v1/classes/{class_id}/assignments")
-async def list_assignments(class_id: str, current_user: dict = Depends(get_current_user)):
+async def list_assignments(class_id: str, current_user: dict = Depends(get_current_user),
+                           membership: Optional[dict] = Depends(class_membership)):
     """List assignments for a class (students and instructors)."""
     try:
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        if membership is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
 
         q = (db.collection("classes").document(class_id)
              .collection("assignments")
              .order_by("createdAt", direction=firestore.Query.DESCENDING))
         results = []
-        for doc in q.stream():
+        async for doc in q.stream():
             d = doc.to_dict()
             results.append({
                 "assignment_id": doc.id,
@@ -1552,24 +2185,24 @@ async def list_assignments(class_id: str, current_user: dict = Depends(get_curre
         raise HTTPException(status_code=500, detail=f"Failed to list assignments: {str(e)}")
 
 @app.get("/api/v1/classes/{class_id}/roster")
-async def get_class_roster(class_id: str, current_user: dict = Depends(get_current_user)):
+async def get_class_roster(class_id: str, current_user: dict = Depends(get_current_user),
+                           membership: Optional[dict] = Depends(class_membership),
+                           loader: DocumentLoader = Depends(get_document_loader)):
     """Get class roster. Students see classmates; instructors see all students and their roles."""
     try:
         # Check if user is a member (student OR instructor) - this was the bug!
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        if membership is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
         
-        caller_role = member_doc.to_dict().get("role", "student")
+        caller_role = membership.get("role", "student")
 
-        # Get all members of the class
-        members = db.collection("classMembers").where("classId", "==", class_id).stream()
+        # Get all members of the class, then their profiles in one batched read
+        members = [m.to_dict() for m in await db.collection("classMembers").where("classId", "==", class_id).get()]
+        users = await loader.load_data("users", (m.get("userId") for m in members))
         roster = []
-        for m in members:
-            mdata = m.to_dict()
+        for mdata in members:
             user_id = mdata.get("userId")
-            user_doc = db.collection("users").document(user_id).get()
-            u = user_doc.to_dict() if user_doc.exists else {}
+            u = users.get(user_id, {})
             roster.append({
                 "user_id": user_id,
                 "full_name": u.get("full_name", "Unknown"),
@@ -1585,19 +2218,19 @@ async def get_class_roster(class_id: str, current_user: dict = Depends(get_curre
         raise HTTPException(status_code=500, detail=f"Failed to get roster: {str(e)}")
 
 @app.delete("/api/v1/classes/{class_id}/roster/{student_id}")
-async def remove_student_from_class(class_id: str, student_id: str, current_user: dict = Depends(get_current_user)):
+async def remove_student_from_class(class_id: str, student_id: str, current_user: dict = Depends(get_current_user),
+                                    membership: Optional[dict] = Depends(class_membership)):
     """Remove a student from a class (instructors only)."""
     try:
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists or member_doc.to_dict().get("role") != "instructor":
+        if membership is None or membership.get("role") != "instructor":
             raise HTTPException(status_code=403, detail="Only instructors can remove students")
 
         # Ensure target student is in class
-        target_doc = db.collection("classMembers").document(f"{class_id}_{student_id}").get()
-        if not target_doc.exists:
+        if await get_membership(class_id, student_id) is None:
             raise HTTPException(status_code=404, detail="Student not in this class")
 
-        db.collection("classMembers").document(f"{class_id}_{student_id}").delete()
+        await db.collection("classMembers").document(f"{class_id}_{student_id}").delete()
+        invalidate_membership(class_id, student_id)
         return {"message": "Student removed"}
     except HTTPException:
         raise
@@ -1605,20 +2238,19 @@ async def remove_student_from_class(class_id: str, student_id: str, current_user
         raise HTTPException(status_code=500, detail=f"Failed to remove student: {str(e)}")
 
 @app.post("/api/v1/classes/{class_id}/grades/set")
-async def set_student_grade(class_id: str, request: SetGradeRequest, student_id: str, current_user: dict = Depends(get_current_user)):
+async def set_student_grade(class_id: str, request: SetGradeRequest, student_id: str, current_user: dict = Depends(get_current_user),
+                            membership: Optional[dict] = Depends(class_membership)):
     """Set a grade for a student on an assignment (instructors only)."""
     try:
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists or member_doc.to_dict().get("role") != "instructor":
+        if membership is None or membership.get("role") != "instructor":
             raise HTTPException(status_code=403, detail="Only instructors can set grades")
         # Ensure student is in class
-        stu_doc = db.collection("classMembers").document(f"{class_id}_{student_id}").get()
-        if not stu_doc.exists:
+        if await get_membership(class_id, student_id) is None:
             raise HTTPException(status_code=404, detail="Student not in this class")
 
         grade_ref = (db.collection("classes").document(class_id)
                      .collection("grades").document(f"{request.assignment_id}_{student_id}"))
-        grade_ref.set({
+        await grade_ref.set({
             "assignmentId": request.assignment_id,
             "studentId": student_id,
             "grade": request.grade,
@@ -1632,13 +2264,13 @@ async def set_student_grade(class_id: str, request: SetGradeRequest, student_id:
         raise HTTPException(status_code=500, detail=f"Failed to set grade: {str(e)}")
 
 @app.get("/api/v1/classes/{class_id}/grades/student/{student_id}")
-async def get_student_grades(class_id: str, student_id: str, current_user: dict = Depends(get_current_user)):
+async def get_student_grades(class_id: str, student_id: str, current_user: dict = Depends(get_current_user),
+                             membership: Optional[dict] = Depends(class_membership)):
     """Get all grades for a student in a class. Students can view their own; instructors can view any."""
     try:
-        caller_member = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not caller_member.exists:
+        if membership is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
-        caller_role = caller_member.to_dict().get("role")
+        caller_role = membership.get("role")
         if current_user['uid'] != student_id and caller_role != "instructor":
             raise HTTPException(status_code=403, detail="Not allowed")
 
@@ -1646,7 +2278,7 @@ async def get_student_grades(class_id: str, student_id: str, current_user: dict
         grades = []
         total = 0.0
         count = 0
-        for gdoc in q.stream():
+        async for gdoc in q.stream():
             g = gdoc.to_dict()
             grades.append({
                 "assignment_id": g.get("assignmentId"),
@@ -1664,20 +2296,21 @@ async def get_student_grades(class_id: str, student_id: str, current_user: dict
         raise HTTPException(status_code=500, detail=f"Failed to get student grades: {str(e)}")
 
 @app.get("/api/v1/classes/{class_id}/grades/assignment/{assignment_id}")
-async def get_assignment_grades(class_id: str, assignment_id: str, current_user: dict = Depends(get_current_user)):
+async def get_assignment_grades(class_id: str, assignment_id: str, current_user: dict = Depends(get_current_user),
+                                membership: Optional[dict] = Depends(class_membership),
+                                loader: DocumentLoader = Depends(get_document_loader)):
     """List all student grades for an assignment (instructors only)."""
     try:
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists or member_doc.to_dict().get("role") != "instructor":
+        if membership is None or membership.get("role") != "instructor":
             raise HTTPException(status_code=403, detail="Only instructors can view assignment grades")
 
         q = (db.collection("classes").document(class_id)
              .collection("grades").where("assignmentId", "==", assignment_id))
+        grades = [gdoc.to_dict() for gdoc in await q.get()]
+        students = await loader.load_data("users", (g.get("studentId") for g in grades))
         results = []
-        for gdoc in q.stream():
-            g = gdoc.to_dict()
-            user_doc = db.collection("users").document(g.get("studentId", "")).get()
-            u = user_doc.to_dict() if user_doc.exists else {}
+        for g in grades:
+            u = students.get(g.get("studentId"), {})
             results.append({
                 "student_id": g.get("studentId"),
                 "student_name": u.get("full_name", "Unknown"),
@@ -1720,94 +2353,140 @@ async def chat_with_study_buddy_files(
         if not OPENAI_API_KEY or OPENAI_API_KEY == "your-openai-api-key-here":
             raise HTTPException(status_code=503, detail="AI service not configured")
         
-        # Process uploaded files
+        # Enforce upload caps, then process files from the spool
+        files = await spool_uploads(files)
         files_content = []
         file_types = []
         
         for file in files:
             if file.filename.lower().endswith('.pdf'):
-                pdf_text = extract_pdf_text(file)
+                pdf_text = await extract_pdf_text(file)
                 files_content.append({
                     "type": "text",
-                    "content": f"PDF content from {file.filename}:\n{pdf_text[:2000]}"  # Limit length
+                    "content": f"PDF content from {file.filename}:\n{token_budget.truncate_to_tokens(pdf_text, STUDY_BUDDY_FILE_TOKENS)}"
                 })
                 file_types.append("pdf")
                 
             elif file.filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-                base64_image = process_image(file)
+                base64_image = await process_image(file)
                 files_content.append({
                     "type": "image_url",
                     "image_url": {"url": base64_image}
                 })
                 file_types.append("image")
         
-        # Generate or use existing conversation ID
-        conversation_id = conversation_id or str(uuid.uuid4())
-        
-        # Get or create conversation history
-        conv_doc_ref = db.collection("ai_conversations").document(conversation_id)
-        conv_doc = conv_doc_ref.get()
-        
-        if conv_doc.exists:
-            conv_data = conv_doc.to_dict()
-            conversation_history = conv_data.get("messages", [])
-        else:
-            conversation_history = [
-                {"role": "system", "content": STUDY_BUDDY_SYSTEM_PROMPT}
-            ]
-        
-        # Create user message
+        # Load (or start) the conversation with the user's message
         user_message = message if message else "Can you help me understand these files?"
-        conversation_history.append({"role": "user", "content": user_message})
-        
-        # Get class context if provided
-        class_context_text = ""
-        if class_context:
-            class_context_text = get_class_context(class_context, db)
+        turn = await prepare_study_buddy_turn(AIStudyRequest(
+            message=user_message,
+            conversation_id=conversation_id,
+            class_context=class_context
+        ), current_user)
         
         # Get AI response with files
-        ai_response = get_ai_response_with_files(
-            conversation_history, 
+        ai_response = await get_ai_response_with_files(
+            turn["history"], 
             OPENAI_API_KEY, 
             files_content,
-            class_context_text
+            turn["class_context"],
+            turn["summary"]
         )
         
-        # Add AI response to history
-        conversation_history.append({"role": "assistant", "content": ai_response})
-        
-        # Save conversation to Firestore
-        conv_data = {
-            "conversation_id": conversation_id,
-            "messages": conversation_history,
-            "class_id": class_context,
-            "user_id": current_user['uid'],
-            "created_at": conv_doc.get("created_at") if conv_doc.exists else datetime.datetime.utcnow(),
-            "last_updated": datetime.datetime.utcnow(),
-            "file_types": file_types
-        }
-        conv_doc_ref.set(conv_data)
+        # Save the turn to Firestore
+        await save_study_buddy_turn(turn, ai_response, current_user, {"file_types": file_types})
         
         return {
             "response": ai_response,
-            "conversation_id": conversation_id,
+            "conversation_id": turn["conversation_id"],
             "timestamp": datetime.datetime.utcnow().isoformat(),
             "processed_files": len(files),
             "file_types": file_types
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"File analysis error: {str(e)}")
     
 
+async def analyze_uploads(files: List[SpooledUpload], class_id: str, title: Optional[str], user_id: str) -> SummaryResponse:
+    """Extract, summarize and store uploaded note files (shared by the endpoint and background jobs)"""
+    file_sources = [file.filename for file in files]
+    file_texts = await extract_uploads_text(files, OPENAI_API_KEY, class_id)
+    combined_content = "".join(
+        f"\n\n--- Content from {name} ---\n{text}"
+        for name, text in zip(file_sources, file_texts) if text is not None
+    )
+    
+    if not combined_content.strip():
+        raise HTTPException(status_code=400, detail="No readable content found in uploaded files")
+    
+    # Get structured summary from AI (or the content-hash cache)
+    summary_data, cache_hit = await get_cached_structured_summary(
+        combined_content,
+        OPENAI_API_KEY,
+        title
+    )
+
+    # Generate summary ID and create database document
+    summary_id = str(uuid.uuid4())
+
+    # Use provided title or AI-generated one
+    final_title = title or summary_data.get("title", "Study Notes")
+    
+    # Create NoteSummary object
+    note_summary = NoteSummary(
+        summary_id=summary_id,
+        title=final_title,
+        key_concepts=summary_data.get("key_concepts", []),
+        main_points=summary_data.get("main_points", []),
+        study_tips=summary_data.get("study_tips", []),
+        questions_for_review=summary_data.get("questions_for_review", []),
+        difficulty_level=summary_data.get("difficulty_level", "intermediate"),
+        estimated_study_time=summary_data.get("estimated_study_time", "30 minutes"),
+        created_at=datetime.datetime.utcnow().isoformat(),
+        file_sources=file_sources,  # Original filenames
+        class_id=class_id,
+        user_id=user_id
+    )
+    
+    # Store in Firestore
+    summary_doc = {
+        "summary_id": summary_id,
+        "title": final_title,
+        "key_concepts": summary_data.get("key_concepts", []),
+        "main_points": summary_data.get("main_points", []),
+        "study_tips": summary_data.get("study_tips", []),
+        "questions_for_review": summary_data.get("questions_for_review", []),
+        "difficulty_level": summary_data.get("difficulty_level", "intermediate"),
+        "estimated_study_time": summary_data.get("estimated_study_time", "30 minutes"),
+        "created_at": datetime.datetime.utcnow(),
+        "file_sources": file_sources,
+        "class_id": class_id,
+        "user_id": user_id,
+        "raw_content": combined_content[:1000]  # Store preview of original content
+    }
+
+    # Save as subcollection under the class
+    await db.collection("classes").document(class_id).collection("note_summaries").document(summary_id).set(summary_doc)
+    invalidate_class_content(class_id, vector_index.summary_chunks(summary_id, summary_doc))
+
+    return SummaryResponse(
+        summary=note_summary,
+        raw_content_preview=combined_content[:200] + "..." if len(combined_content) > 200 else combined_content,
+        cache_hit=cache_hit
+    )
+
+
 @app.post("/api/v1/notes/analyze", response_model=SummaryResponse)
 async def analyze_notes_to_json(
     files: List[UploadFile] = File(...),
     class_id: str = Form(...),
     title: Optional[str] = Form(None),
+    background: bool = False,
     current_user: dict = Depends(get_current_user)
 ):
-    """Analyze uploaded files and return structured JSON summary"""
+    """Analyze uploaded files and return structured JSON summary (or a job id with ?background=true)"""
     try:
         if not OPENAI_API_KEY or OPENAI_API_KEY == "your-openai-api-key-here":
             raise HTTPException(status_code=503, detail="AI service not configured")
@@ -1815,82 +2494,15 @@ async def analyze_notes_to_json(
         if not files:
             raise HTTPException(status_code=400, detail="No files uploaded")
         
-        # Process files and combine content
-        combined_content = ""
-        file_sources = []
-        
-        for file in files:
-            file_sources.append(file.filename)
-            
-            if file.filename.lower().endswith('.pdf'):
-                pdf_text = extract_pdf_text(file)
-                combined_content += f"\n\n--- Content from {file.filename} ---\n{pdf_text}"
-                
-            elif file.filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-                # Use OpenAI Vision API to extract text from image
-                image_text = extract_text_from_image(file, OPENAI_API_KEY)
-                combined_content += f"\n\n--- Content from {file.filename} ---\n{image_text}"
-            
-            elif file.filename.lower().endswith('.txt'):
-                text_content = (await file.read()).decode('utf-8')
-                combined_content += f"\n\n--- Content from {file.filename} ---\n{text_content}"
-        
-        if not combined_content.strip():
-            raise HTTPException(status_code=400, detail="No readable content found in uploaded files")
-        
-        # Get structured summary from AI
-        summary_data = get_structured_summary(
-            combined_content,
-            OPENAI_API_KEY,
-            title
-        )
-
-        # Generate summary ID and create database document
-        summary_id = str(uuid.uuid4())
-
-        # Use provided title or AI-generated one
-        final_title = title or summary_data.get("title", "Study Notes")
-        
-        # Create NoteSummary object
-        note_summary = NoteSummary(
-            summary_id=summary_id,
-            title=final_title,
-            key_concepts=summary_data.get("key_concepts", []),
-            main_points=summary_data.get("main_points", []),
-            study_tips=summary_data.get("study_tips", []),
-            questions_for_review=summary_data.get("questions_for_review", []),
-            difficulty_level=summary_data.get("difficulty_level", "intermediate"),
-            estimated_study_time=summary_data.get("estimated_study_time", "30 minutes"),
-            created_at=datetime.datetime.utcnow().isoformat(),
-            file_sources=file_sources,  # Original filenames
-            class_id=class_id,
-            user_id=current_user['uid']
-        )
-        
-        # Store in Firestore
-        summary_doc = {
-            "summary_id": summary_id,
-            "title": final_title,
-            "key_concepts": summary_data.get("key_concepts", []),
-            "main_points": summary_data.get("main_points", []),
-            "study_tips": summary_data.get("study_tips", []),
-            "questions_for_review": summary_data.get("questions_for_review", []),
-            "difficulty_level": summary_data.get("difficulty_level", "intermediate"),
-            "estimated_study_time": summary_data.get("estimated_study_time", "30 minutes"),
-            "created_at": datetime.datetime.utcnow(),
-            "file_sources": file_sources,
-            "class_id": class_id,
-            "user_id": current_user['uid'],
-            "raw_content": combined_content[:1000]  # Store preview of original content
-        }
-
-        # Save as subcollection under the class
-        db.collection("classes").document(class_id).collection("note_summaries").document(summary_id).set(summary_doc)
-
-        return SummaryResponse(
-            summary=note_summary,
-            raw_content_preview=combined_content[:200] + "..." if len(combined_content) > 200 else combined_content
-        )
+        # Enforce upload caps, then process files and combine content
+        files = await spool_uploads(files)
+        if background:
+            job = await note_jobs.enqueue(
+                "analyze", current_user['uid'], {"class_id": class_id, "title": title},
+                files=[(file.filename, file.upload.file) for file in files]
+            )
+            return JSONResponse(status_code=202, content=job_status_view(job))
+        return await analyze_uploads(files, class_id, title, current_user['uid'])
         
     except HTTPException:
         raise
@@ -1902,6 +2514,7 @@ async def analyze_notes_to_json(
 async def get_class_note_summaries(
     class_id: str,
     limit: int = 50,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Get note summaries for a specific class"""
@@ -1909,7 +2522,8 @@ async def get_class_note_summaries(
         # Fetch summaries from the class's subcollection (shared with all students)
         summaries_ref = db.collection("classes").document(class_id).collection("note_summaries")
         # All students can see all notes in this class
-        summaries = summaries_ref.order_by("created_at", direction=firestore.Query.DESCENDING).limit(limit).stream()
+        query = summaries_ref.order_by("created_at", direction=firestore.Query.DESCENDING)
+        summaries, next_cursor = await fetch_page(query, summaries_ref, limit, cursor)
 
         summary_list = []
         for summary_doc in summaries:
@@ -1930,8 +2544,10 @@ async def get_class_note_summaries(
                 "questions_for_review": summary_data.get("questions_for_review", [])
             })
         
-        return {"summaries": summary_list}
+        return {"summaries": summary_list, "next_cursor": next_cursor}
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get summaries: {str(e)}")
 
@@ -1943,7 +2559,7 @@ async def get_summary_details(
 ):
     """Get detailed summary by ID"""
     try:
-        summary_doc = db.collection("note_summaries").document(summary_id).get()
+        summary_doc = await db.collection("note_summaries").document(summary_id).get()
         
         if not summary_doc.exists:
             raise HTTPException(status_code=404, detail="Summary not found")
@@ -1980,33 +2596,31 @@ async def get_class_summaries(
 
     class_id: str,
     limit: int = 50,
-    current_user: dict = Depends(get_current_user)
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user),
+    membership: Optional[dict] = Depends(class_membership),
+    loader: DocumentLoader = Depends(get_document_loader)
 ):
     """Get all summaries for a specific class (shared with all class members)"""
     try:
         # Verify user is member of class
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        if membership is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
 
         # Query ALL summaries for this class (not just current user's)
-        query = db.collection("note_summaries").where("class_id", "==", class_id)
-        summaries = query.order_by("created_at", direction=firestore.Query.DESCENDING).limit(limit).stream();
+        summaries_col = db.collection("note_summaries")
+        query = summaries_col.where("class_id", "==", class_id).order_by("created_at", direction=firestore.Query.DESCENDING)
+        summaries, next_cursor = await fetch_page(query, summaries_col, limit, cursor)
+
+        # Resolve every creator's name in one batched read
+        creators = await loader.load_data("users", (summary_doc.to_dict().get("user_id") for summary_doc in summaries))
 
         summary_list = []
         for summary_doc in summaries:
             summary_data = summary_doc.to_dict();
 
-            # Get the creator's name
-            creator_name = "Unknown"
             creator_id = summary_data.get("user_id")
-            if creator_id:
-                try:
-                    user_doc = db.collection("users").document(creator_id).get()
-                    if user_doc.exists:
-                        creator_name = user_doc.to_dict().get("full_name", "Unknown")
-                except Exception:
-                    pass
+            creator_name = creators.get(creator_id, {}).get("full_name", "Unknown")
 
             summary_list.append({
                 "summary_id": summary_data.get("summary_id"),
@@ -2021,7 +2635,7 @@ async def get_class_summaries(
                 "created_by": creator_name
             })
 
-        return {"summaries": summary_list}
+        return {"summaries": summary_list, "next_cursor": next_cursor}
 
     except HTTPException:
         raise
@@ -2058,7 +2672,7 @@ async def create_note(
             note_doc["linked_summary_id"] = request.linked_summary_id
 
         # Save as subcollection under the user
-        db.collection("users").document(current_user['uid']).collection("notes").document(note_id).set(note_doc)
+        await db.collection("users").document(current_user['uid']).collection("notes").document(note_id).set(note_doc)
 
         return Note(
             note_id=note_id,
@@ -2077,19 +2691,21 @@ async def create_note(
 async def get_notes(
     class_id: Optional[str] = None,
     limit: int = 50,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Get user's notes, optionally filtered by class"""
     try:
         # Fetch from user's subcollection
-        query = db.collection("users").document(current_user['uid']).collection("notes")
+        notes_col = db.collection("users").document(current_user['uid']).collection("notes")
+        query = notes_col
 
         if class_id:
             query = query.where("class_id", "==", class_id)
 
-        # Retrieve notes without ordering to avoid needing a composite index
-        # We'll sort them in memory instead
-        notes = query.limit(limit).stream()
+        # Most recently updated first (class_id + updated_at index in firestore.indexes.json)
+        query = query.order_by("updated_at", direction=firestore.Query.DESCENDING)
+        notes, next_cursor = await fetch_page(query, notes_col, limit, cursor)
 
         notes_list = []
         for note_doc in notes:
@@ -2101,18 +2717,12 @@ async def get_notes(
                 "class_id": note_data.get("class_id"),
                 "user_id": note_data.get("user_id"),
                 "created_at": serialize_datetime(note_data.get("created_at")),
-                "updated_at": serialize_datetime(note_data.get("updated_at")),
-                "_sort_key": note_data.get("updated_at")  # Keep for sorting
+                "updated_at": serialize_datetime(note_data.get("updated_at"))
             })
 
-        # Sort by updated_at in memory (most recent first)
-        notes_list.sort(key=lambda x: x.get("_sort_key") or datetime.datetime.min, reverse=True)
-
-        # Remove the temporary sort key before returning
-        for note in notes_list:
-            note.pop("_sort_key", None)
-
-        return {"notes": notes_list}
+        return {"notes": notes_list, "next_cursor": next_cursor}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get notes: {str(e)}")
 
@@ -2125,7 +2735,7 @@ async def get_note(
     """Get a specific note by ID"""
     try:
         # Fetch from user's subcollection
-        note_doc = db.collection("users").document(current_user['uid']).collection("notes").document(note_id).get()
+        note_doc = await db.collection("users").document(current_user['uid']).collection("notes").document(note_id).get()
 
         if not note_doc.exists:
             raise HTTPException(status_code=404, detail="Note not found")
@@ -2157,7 +2767,7 @@ async def update_note(
     try:
         # Fetch from user's subcollection
         note_ref = db.collection("users").document(current_user['uid']).collection("notes").document(note_id)
-        note_doc = note_ref.get()
+        note_doc = await note_ref.get()
 
         if not note_doc.exists:
             raise HTTPException(status_code=404, detail="Note not found")
@@ -2171,10 +2781,10 @@ async def update_note(
         if request.content is not None:
             update_data["content"] = request.content
 
-        note_ref.update(update_data)
+        await note_ref.update(update_data)
 
         # Get updated note
-        updated_doc = note_ref.get()
+        updated_doc = await note_ref.get()
         updated_data = updated_doc.to_dict()
 
         return Note(
@@ -2201,12 +2811,12 @@ async def delete_note(
     try:
         # Fetch from user's subcollection
         note_ref = db.collection("users").document(current_user['uid']).collection("notes").document(note_id)
-        note_doc = note_ref.get()
+        note_doc = await note_ref.get()
 
         if not note_doc.exists:
             raise HTTPException(status_code=404, detail="Note not found")
 
-        note_ref.delete()
+        await note_ref.delete()
 
         return {"message": "Note deleted successfully"}
     except HTTPException:
@@ -2222,7 +2832,7 @@ async def get_note_with_linked_summary(
     """Get a note with its linked summary details"""
     try:
         note_ref = db.collection("users").document(current_user['uid']).collection("notes").document(note_id)
-        note_doc = note_ref.get()
+        note_doc = await note_ref.get()
 
         if not note_doc.exists:
             raise HTTPException(status_code=404, detail="Note not found")
@@ -2248,7 +2858,7 @@ async def get_note_with_linked_summary(
         if linked_summary_id:
             class_id = note_data.get("class_id")
             if class_id:
-                summary_doc = db.collection("classes").document(class_id).collection("note_summaries").document(linked_summary_id).get()
+                summary_doc = await db.collection("classes").document(class_id).collection("note_summaries").document(linked_summary_id).get()
                 if summary_doc.exists:
                     summary_data = summary_doc.to_dict()
                     result["summary"] = {
@@ -2274,13 +2884,13 @@ async def get_note_with_linked_summary(
 async def get_notes_linked_to_summary(
     summary_id: str,
     class_id: str,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    membership: Optional[dict] = Depends(class_membership)
 ):
     """Get all user notes linked to a specific summary"""
     try:
         # Verify user is member of class
-        member_doc = db.collection("classMembers").document(f"{class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        if membership is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
 
         # Query user's notes that are linked to this summary
@@ -2291,7 +2901,7 @@ async def get_notes_linked_to_summary(
         notes = query.stream()
         notes_list = []
         
-        for note_doc in notes:
+        async for note_doc in notes:
             note_data = note_doc.to_dict()
             notes_list.append({
                 "note_id": note_data.get("note_id"),
@@ -2308,12 +2918,100 @@ async def get_notes_linked_to_summary(
         raise HTTPException(status_code=500, detail=f"Failed to get linked notes: {str(e)}")
 
 
+async def summarize_notes(request: SummarizeNotesRequest, user_id: str) -> SummaryResponse:
+    """Summarize, store and back-link a user's notes (shared by the endpoint and background jobs)"""
+    # Fetch and combine note content
+    combined_content = ""
+    note_titles = []
+    
+    for note_id in request.note_ids:
+        note_ref = db.collection("users").document(user_id).collection("notes").document(note_id)
+        note_doc = await note_ref.get()
+        
+        if not note_doc.exists:
+            continue
+            
+        note_data = note_doc.to_dict()
+        
+        # Verify note belongs to the specified class
+        if note_data.get("class_id") != request.class_id:
+            continue
+        
+        note_titles.append(note_data.get("title", "Untitled"))
+        combined_content += f"\n\n--- {note_data.get('title', 'Untitled')} ---\n{note_data.get('content', '')}"
+    
+    if not combined_content.strip():
+        raise HTTPException(status_code=400, detail="No valid note content found")
+
+    # Get structured summary from AI (or the content-hash cache)
+    summary_data, cache_hit = await get_cached_structured_summary(
+        combined_content,
+        OPENAI_API_KEY,
+        request.title
+    )
+
+    # Generate summary ID
+    summary_id = str(uuid.uuid4())
+    final_title = request.title or summary_data.get("title", f"Summary of {len(note_titles)} notes")
+
+    # Create NoteSummary object
+    note_summary = NoteSummary(
+        summary_id=summary_id,
+        title=final_title,
+        key_concepts=summary_data.get("key_concepts", []),
+        main_points=summary_data.get("main_points", []),
+        study_tips=summary_data.get("study_tips", []),
+        questions_for_review=summary_data.get("questions_for_review", []),
+        difficulty_level=summary_data.get("difficulty_level", "intermediate"),
+        estimated_study_time=summary_data.get("estimated_study_time", "30 minutes"),
+        created_at=datetime.datetime.utcnow().isoformat(),
+        file_sources=note_titles,  # Use note titles as "sources"
+        class_id=request.class_id,
+        user_id=user_id
+    )
+
+    # Store in Firestore
+    summary_doc = {
+        "summary_id": summary_id,
+        "title": final_title,
+        "key_concepts": summary_data.get("key_concepts", []),
+        "main_points": summary_data.get("main_points", []),
+        "study_tips": summary_data.get("study_tips", []),
+        "questions_for_review": summary_data.get("questions_for_review", []),
+        "difficulty_level": summary_data.get("difficulty_level", "intermediate"),
+        "estimated_study_time": summary_data.get("estimated_study_time", "30 minutes"),
+        "created_at": datetime.datetime.utcnow(),
+        "file_sources": note_titles,
+        "class_id": request.class_id,
+        "user_id": user_id,
+        "raw_content": combined_content[:1000],
+        "source_type": "user_notes",  # Track that this came from user notes
+        "source_note_ids": request.note_ids  # Track which notes were used
+    }
+
+    # Save to class's note_summaries subcollection
+    await db.collection("classes").document(request.class_id).collection("note_summaries").document(summary_id).set(summary_doc)
+    invalidate_class_content(request.class_id, vector_index.summary_chunks(summary_id, summary_doc))
+
+    # Optionally: Update the source notes to link back to this summary
+    for note_id in request.note_ids:
+        note_ref = db.collection("users").document(user_id).collection("notes").document(note_id)
+        await note_ref.update({"linked_summary_id": summary_id})
+
+    return SummaryResponse(
+        summary=note_summary,
+        raw_content_preview=combined_content[:200] + "..." if len(combined_content) > 200 else combined_content,
+        cache_hit=cache_hit
+    )
+
+
 @app.post("/api/v1/notes/summarize", response_model=SummaryResponse)
 async def create_summary_from_notes(
     request: SummarizeNotesRequest,
+    background: bool = False,
     current_user: dict = Depends(get_current_user)
 ):
-    """Create AI summary from existing user notes"""
+    """Create AI summary from existing user notes (or a job id with ?background=true)"""
     try:
         if not OPENAI_API_KEY or OPENAI_API_KEY == "your-openai-api-key-here":
             raise HTTPException(status_code=503, detail="AI service not configured")
@@ -2322,96 +3020,131 @@ async def create_summary_from_notes(
             raise HTTPException(status_code=400, detail="No notes selected")
 
         # Verify user is member of class
-        member_doc = db.collection("classMembers").document(f"{request.class_id}_{current_user['uid']}").get()
-        if not member_doc.exists:
+        if await get_membership(request.class_id, current_user['uid']) is None:
             raise HTTPException(status_code=403, detail="Not a member of this class")
 
-        # Fetch and combine note content
-        combined_content = ""
-        note_titles = []
-        
-        for note_id in request.note_ids:
-            note_ref = db.collection("users").document(current_user['uid']).collection("notes").document(note_id)
-            note_doc = note_ref.get()
-            
-            if not note_doc.exists:
-                continue
-                
-            note_data = note_doc.to_dict()
-            
-            # Verify note belongs to the specified class
-            if note_data.get("class_id") != request.class_id:
-                continue
-            
-            note_titles.append(note_data.get("title", "Untitled"))
-            combined_content += f"\n\n--- {note_data.get('title', 'Untitled')} ---\n{note_data.get('content', '')}"
-        
-        if not combined_content.strip():
-            raise HTTPException(status_code=400, detail="No valid note content found")
+        if background:
+            job = await note_jobs.enqueue("summarize", current_user['uid'], request.model_dump())
+            return JSONResponse(status_code=202, content=job_status_view(job))
+        return await summarize_notes(request, current_user['uid'])
 
-        # Get structured summary from AI
-        summary_data = get_structured_summary(
-            combined_content,
-            OPENAI_API_KEY,
-            request.title
-        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to create summary from notes: {str(e)}")
 
-        # Generate summary ID
-        summary_id = str(uuid.uuid4())
-        final_title = request.title or summary_data.get("title", f"Summary of {len(note_titles)} notes")
+# -------------------------------
+# Background note jobs
+# -------------------------------
+# /notes/analyze and /notes/summarize accept ?background=true to return a job id
+# right away; progress is read from /jobs/{job_id} (or its SSE stream).
+JOB_EVENTS_POLL_SECONDS = float(os.getenv("JOB_EVENTS_POLL_SECONDS", "2"))
+note_jobs = JobQueue(db)
 
-        # Create NoteSummary object
-        note_summary = NoteSummary(
-            summary_id=summary_id,
-            title=final_title,
-            key_concepts=summary_data.get("key_concepts", []),
-            main_points=summary_data.get("main_points", []),
-            study_tips=summary_data.get("study_tips", []),
-            questions_for_review=summary_data.get("questions_for_review", []),
-            difficulty_level=summary_data.get("difficulty_level", "intermediate"),
-            estimated_study_time=summary_data.get("estimated_study_time", "30 minutes"),
-            created_at=datetime.datetime.utcnow().isoformat(),
-            file_sources=note_titles,  # Use note titles as "sources"
-            class_id=request.class_id,
-            user_id=current_user['uid']
-        )
+def job_status_view(job: dict) -> dict:
+    """Client-facing job state (no spool paths or lease bookkeeping)"""
+    return {
+        "job_id": job["job_id"],
+        "kind": job.get("kind"),
+        "status": job.get("status"),
+        "attempts": job.get("attempts", 0),
+        "error": job.get("error"),
+        "result": job.get("result"),
+        "created_at": serialize_datetime(job.get("created_at")),
+        "updated_at": serialize_datetime(job.get("updated_at")),
+        "status_url": f"/api/v1/jobs/{job['job_id']}",
+        "events_url": f"/api/v1/jobs/{job['job_id']}/events",
+    }
 
-        # Store in Firestore
-        summary_doc = {
-            "summary_id": summary_id,
-            "title": final_title,
-            "key_concepts": summary_data.get("key_concepts", []),
-            "main_points": summary_data.get("main_points", []),
-            "study_tips": summary_data.get("study_tips", []),
-            "questions_for_review": summary_data.get("questions_for_review", []),
-            "difficulty_level": summary_data.get("difficulty_level", "intermediate"),
-            "estimated_study_time": summary_data.get("estimated_study_time", "30 minutes"),
-            "created_at": datetime.datetime.utcnow(),
-            "file_sources": note_titles,
-            "class_id": request.class_id,
-            "user_id": current_user['uid'],
-            "raw_content": combined_content[:1000],
-            "source_type": "user_notes",  # Track that this came from user notes
-            "source_note_ids": request.note_ids  # Track which notes were used
-        }
+async def run_job_step(step) -> dict:
+    """Await a summary pipeline; client errors (4xx) fail the job, anything else is retried"""
+    try:
+        response = await step
+    except HTTPException as e:
+        if e.status_code < 500:
+            raise JobFailed(e.detail)
+        raise
+    return response.model_dump()
+
+async def run_analyze_job(job: dict) -> dict:
+    params = job["params"]
+    files = []
+    for spooled in job.get("files", []):
+        if not os.path.exists(spooled["path"]):
+            raise JobFailed("Uploaded files are no longer available; please upload again")
+        upload = UploadFile(file=open(spooled["path"], "rb"), filename=spooled["filename"])
+        files.append(SpooledUpload(upload, os.path.getsize(spooled["path"])))
+    try:
+        return await run_job_step(analyze_uploads(files, params["class_id"], params.get("title"), job["user_id"]))
+    finally:
+        for file in files:
+            await file.close()
 
-        # Save to class's note_summaries subcollection
-        db.collection("classes").document(request.class_id).collection("note_summaries").document(summary_id).set(summary_doc)
+async def run_summarize_job(job: dict) -> dict:
+    return await run_job_step(summarize_notes(SummarizeNotesRequest(**job["params"]), job["user_id"]))
 
-        # Optionally: Update the source notes to link back to this summary
-        for note_id in request.note_ids:
-            note_ref = db.collection("users").document(current_user['uid']).collection("notes").document(note_id)
-            note_ref.update({"linked_summary_id": summary_id})
+note_jobs.register("analyze", run_analyze_job)
+note_jobs.register("summarize", run_summarize_job)
 
-        return SummaryResponse(
-            summary=note_summary,
-            raw_content_preview=combined_content[:200] + "..." if len(combined_content) > 200 else combined_content
-        )
+@app.on_event("startup")
+async def start_note_jobs():
+    await note_jobs.start()
+
+@app.on_event("shutdown")
+async def stop_note_jobs():
+    await note_jobs.stop()
+
+async def get_owned_job(job_id: str, current_user: dict) -> dict:
+    job = await note_jobs.get(job_id)
+    if job is None or job.get("user_id") != current_user['uid']:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
+@app.get("/api/v1/jobs/{job_id}")
+async def get_job_status(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Poll a background note job; `result` holds the SummaryResponse once it succeeds"""
+    try:
+        return job_status_view(await get_owned_job(job_id, current_user))
     except HTTPException:
         raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to create summary from notes: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to get job: {str(e)}")
+
+async def stream_job_events(job_id: str):
+    """Emit `status` frames on every change, then `done` (or `error`) when the job finishes"""
+    last_state = None
+    while True:
+        job = await note_jobs.get(job_id)
+        if job is None:
+            yield format_sse({"job_id": job_id, "detail": "Job not found"}, event="error")
+            return
+        view = job_status_view(job)
+        state = (view["status"], view["attempts"])
+        if state != last_state:
+            yield format_sse(view, event="status")
+            last_state = state
+        if view["status"] == "succeeded":
+            yield format_sse(view, event="done")
+            return
+        if view["status"] == "failed":
+            yield format_sse(view, event="error")
+            return
+        await note_jobs.wait_for_change(job_id, JOB_EVENTS_POLL_SECONDS)
+
+@app.get("/api/v1/jobs/{job_id}/events")
+async def get_job_events(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Server-sent events for a background note job"""
+    try:
+        await get_owned_job(job_id, current_user)
+        return StreamingResponse(
+            stream_job_events(job_id),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to stream job: {str(e)}")
 
 
 @app.put("/api/v1/notes/{note_id}/link-summary")
@@ -2423,13 +3156,13 @@ async def link_note_to_summary(
     """Link an existing note to a summary"""
     try:
         note_ref = db.collection("users").document(current_user['uid']).collection("notes").document(note_id)
-        note_doc = note_ref.get()
+        note_doc = await note_ref.get()
 
         if not note_doc.exists:
             raise HTTPException(status_code=404, detail="Note not found")
 
         # Update the note with the linked summary
-        note_ref.update({
+        await note_ref.update({
             "linked_summary_id": summary_id,
             "updated_at": datetime.datetime.utcnow()
         })
@@ -2450,13 +3183,13 @@ async def unlink_note_from_summary(
     """Remove summary link from a note"""
     try:
         note_ref = db.collection("users").document(current_user['uid']).collection("notes").document(note_id)
-        note_doc = note_ref.get()
+        note_doc = await note_ref.get()
 
         if not note_doc.exists:
             raise HTTPException(status_code=404, detail="Note not found")
 
         # Remove the linked summary
-        note_ref.update({
+        await note_ref.update({
             "linked_summary_id": firestore.DELETE_FIELD,
             "updated_at": datetime.datetime.utcnow()
         })
@@ -2475,8 +3208,14 @@ async def unlink_note_from_summary(
 async def health_check():
     return {"message": "Classroom API v1.0.0 is running ✅", "timestamp": datetime.datetime.utcnow().isoformat()}
 
+@app.get("/api/v1/metrics/caches")
+async def get_cache_metrics(current_user: dict = Depends(get_current_user)):
+    """Hit/miss/eviction counters for this worker's in-process caches"""
+    return {"caches": cache_stats(), "timestamp": datetime.datetime.utcnow().isoformat()}
+
 if __name__ == "__main__":
-    import uvicorn
-    import os
-    port = int(os.environ.get("PORT", 8080))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    import sys
+    # Re-exec through uvicorn's entry point: the PDF pool's spawned workers re-import
+    # the launcher's __main__, which must not be this module (see pdf_extract)
+    port = os.environ.get("PORT", "8080")
+    os.execv(sys.executable, [sys.executable, "-m", "uvicorn", "main:app", "--host", "0.0.0.0", "--port", port])
\ No newline at end of file
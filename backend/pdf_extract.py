@@ -0,0 +1,142 @@
+"""PDF text extraction in a process pool.
+
+PyPDF2 parsing is pure-Python and CPU bound, so running it on the event loop
+(or in the thread pool, under the GIL) stalls every other request. Documents
+are split into page ranges that worker processes extract in parallel; the
+results are joined once, in page order.
+
+Each file gets a page budget (PDF_MAX_PAGES) and a wall-clock budget
+(PDF_EXTRACT_TIMEOUT_SECONDS). Pages past either budget are left out and noted
+at the end of the text.
+
+The upload is copied once to a temporary file and workers receive only its path
+and a page range, so no task pickles the document and memory does not grow with
+the number of ranges.
+
+Workers are started with "spawn", which imports this module and also re-imports
+the launcher's `__main__` in every worker. The API must therefore be started
+through uvicorn (`uvicorn main:app`, as in the Dockerfile; `python main.py`
+re-executes itself that way) so that `__main__` is never the app module and
+workers do not run its Firebase setup. Keep this module free of app imports.
+"""
+import asyncio
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import PyPDF2
+
+PDF_POOL_WORKERS = int(os.getenv("PDF_POOL_WORKERS", str(os.cpu_count() or 2)))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "20"))
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "300"))
+PDF_EXTRACT_TIMEOUT_SECONDS = float(os.getenv("PDF_EXTRACT_TIMEOUT_SECONDS", "60"))
+
+# Part of the extraction cache key: output changes with the parser or the page budget
+EXTRACTOR_VERSION = f"pypdf2-{PyPDF2.__version__}:pages-{PDF_MAX_PAGES}"
+
+_pool: ProcessPoolExecutor = None
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """Process-wide extraction pool, created on first use"""
+    global _pool
+    if _pool is None:
+        # spawn, not fork: the API process runs gRPC threads that must not be forked
+        _pool = ProcessPoolExecutor(
+            max_workers=PDF_POOL_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pool
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _count_pages(path: str) -> int:
+    with open(path, "rb") as f:
+        return len(PyPDF2.PdfReader(f).pages)
+
+
+def _extract_range(path: str, start: int, stop: int) -> list:
+    """Text of pages [start, stop); a page that fails to parse yields an empty string"""
+    texts = []
+    with open(path, "rb") as f:
+        reader = PyPDF2.PdfReader(f)
+        for index in range(start, stop):
+            try:
+                texts.append(reader.pages[index].extract_text() or "")
+            except Exception:
+                texts.append("")
+    return texts
+
+
+def _copy_to_temp(fileobj) -> str:
+    fileobj.seek(0)
+    with tempfile.NamedTemporaryFile(prefix="pdf_extract_", suffix=".pdf", delete=False) as out:
+        shutil.copyfileobj(fileobj, out)
+    fileobj.seek(0)
+    return out.name
+
+
+async def extract_text(fileobj) -> str:
+    """Extract a PDF's text within the page and time budgets"""
+    text, _ = await extract_text_result(fileobj)
+    return text
+
+
+async def extract_text_result(fileobj) -> tuple:
+    """(text, incomplete) for a readable binary file object.
+
+    incomplete is True when the time budget or a failed range stopped short of the page budget.
+    """
+    loop = asyncio.get_running_loop()
+    path = await loop.run_in_executor(None, _copy_to_temp, fileobj)
+    try:
+        return await _extract_path(path)
+    finally:
+        # A range still running past the deadline already has the file open
+        os.unlink(path)
+
+
+async def _extract_path(path: str) -> tuple:
+    loop = asyncio.get_running_loop()
+    pool = get_pool()
+    deadline = loop.time() + PDF_EXTRACT_TIMEOUT_SECONDS
+
+    total_pages = await asyncio.wait_for(
+        loop.run_in_executor(pool, _count_pages, path), PDF_EXTRACT_TIMEOUT_SECONDS
+    )
+    page_budget = min(total_pages, PDF_MAX_PAGES)
+
+    ranges = [(start, min(start + PDF_PAGES_PER_TASK, page_budget))
+              for start in range(0, page_budget, PDF_PAGES_PER_TASK)]
+    tasks = [loop.run_in_executor(pool, _extract_range, path, start, stop) for start, stop in ranges]
+    if tasks:
+        await asyncio.wait(tasks, timeout=max(0.0, deadline - loop.time()))
+
+    # Keep the longest contiguous run of finished ranges from the first page
+    parts = []
+    extracted_pages = 0
+    for (start, stop), task in zip(ranges, tasks):
+        if not task.done() or task.exception() is not None:
+            break
+        parts.extend(task.result())
+        extracted_pages = stop
+
+    for task in tasks:
+        # Queued ranges are dropped; a range already running finishes in the background
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled():
+            task.exception()  # mark retrieved so failures past the cut-off are not logged as unhandled
+
+    text = "\n".join(parts)
+    if extracted_pages < total_pages:
+        text += f"\n[Extraction stopped after {extracted_pages} of {total_pages} pages]"
+    return text, extracted_pages < page_budget
@@ -0,0 +1,57 @@
+"""Request coalescing: concurrent calls with the same key share one upstream call.
+
+The first caller for a key starts the work as a task; callers that arrive while
+it is in flight await the same task instead of calling the provider again. The
+key is forgotten as soon as the task finishes, so this only merges bursts; the
+caches behind each call site serve everything afterwards.
+
+Waiters await the task through `asyncio.shield`, so a caller that disconnects
+does not cancel the work for the others. Results and exceptions are shared as-is,
+so callers must not mutate a shared result. Coalescing is per process.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from caches import register_cache
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        self._stats = {"calls": 0, "leaders": 0, "coalesced": 0, "errors": 0}
+        register_cache(name, self)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Result of `fn()`, shared with every concurrent call for the same key"""
+        result, _ = await self.do_shared(key, fn)
+        return result
+
+    async def do_shared(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """(result, joined): `joined` is True when this call awaited another caller's flight"""
+        self._stats["calls"] += 1
+        task = self._in_flight.get(key)
+        joined = task is not None
+        if joined:
+            self._stats["coalesced"] += 1
+        else:
+            self._stats["leaders"] += 1
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(task), joined
+
+    def _finish(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Retrieve the exception so one nobody awaited (all waiters gone) is not logged as lost
+        if not task.cancelled() and task.exception() is not None:
+            self._stats["errors"] += 1
+
+    def stats(self) -> dict:
+        calls = self._stats["calls"]
+        return {
+            **self._stats,
+            "in_flight": len(self._in_flight),
+            "coalesced_ratio": round(self._stats["coalesced"] / calls, 4) if calls else 0.0,
+        }
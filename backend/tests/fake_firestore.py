@@ -0,0 +1,74 @@
+"""Minimal in-memory stand-in for the async Firestore client, keyed by document path.
+
+Queries ignore ordering but honour `limit`. `FakeSnapshot.get` raises KeyError on
+a missing field, as DocumentSnapshot.get does.
+"""
+
+
+class FakeSnapshot:
+    def __init__(self, path, data, store):
+        self.id = path.rsplit("/", 1)[-1]
+        self.reference = FakeDocument(path, store)
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return self._data[field]
+
+
+class FakeQuery:
+    def __init__(self, path, store, limit=None):
+        self._path = path
+        self._store = store
+        self._limit = limit
+
+    def order_by(self, *args, **kwargs):
+        return self
+
+    def limit(self, count):
+        return FakeQuery(self._path, self._store, count)
+
+    def _snapshots(self):
+        prefix = f"{self._path}/"
+        snapshots = [
+            FakeSnapshot(path, data, self._store)
+            for path, data in list(self._store.items())
+            if path.startswith(prefix) and "/" not in path[len(prefix):]
+        ]
+        return snapshots[:self._limit] if self._limit is not None else snapshots
+
+    async def get(self):
+        return self._snapshots()
+
+    async def stream(self):
+        for snapshot in self._snapshots():
+            yield snapshot
+
+
+class FakeCollection(FakeQuery):
+    def document(self, doc_id):
+        return FakeDocument(f"{self._path}/{doc_id}", self._store)
+
+
+class FakeDocument:
+    def __init__(self, path, store):
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+        self._store = store
+
+    def collection(self, name):
+        return FakeCollection(f"{self.path}/{name}", self._store)
+
+    async def get(self):
+        return FakeSnapshot(self.path, self._store.get(self.path), self._store)
+
+
+class FakeClient:
+    def __init__(self, store):
+        self._store = store
+
+    def collection(self, name):
+        return FakeCollection(name, self._store)
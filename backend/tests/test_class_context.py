@@ -0,0 +1,26 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from class_context import ClassContextService  # noqa: E402
+from fake_firestore import FakeClient  # noqa: E402
+
+
+def test_context_includes_comments_on_posts_without_comment_count():
+    store = {
+        "classes/c1": {"name": "Biology 101"},
+        # Written before the denormalized counters existed
+        "classes/c1/posts/legacy": {"title": "Krebs cycle", "content": "Where is ATP made?"},
+        "classes/c1/posts/legacy/comments/k1": {"content": "Oxidative phosphorylation in the mitochondria"},
+        "classes/c1/posts/quiet": {"title": "Mitosis", "content": "Prophase first", "comment_count": 0},
+        "classes/c1/posts/quiet/comments/k2": {"content": "Stray reply the counter does not know about"},
+    }
+    service = ClassContextService(FakeClient(store))
+
+    context = asyncio.run(service.context_for("c1", "where is ATP made"))
+
+    assert context.startswith("Class: Biology 101")
+    assert "Oxidative phosphorylation in the mitochondria" in context
+    assert "Stray reply" not in context
@@ -0,0 +1,53 @@
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embeddings import HashEmbedder  # noqa: E402
+from fake_firestore import FakeClient  # noqa: E402
+from vector_index import VectorIndex  # noqa: E402
+
+
+def test_rebuild_indexes_posts_without_comment_count(tmp_path):
+    store = {
+        # Written before the denormalized counters existed
+        "classes/c1/posts/legacy": {"title": "Krebs cycle", "content": "The Krebs cycle produces NADH and ATP"},
+        "classes/c1/posts/legacy/comments/k0": {"content": "Oxidative phosphorylation happens in the mitochondria"},
+        "classes/c1/posts/p2": {"title": "Mitosis", "content": "Prophase comes before metaphase", "comment_count": 1},
+        "classes/c1/posts/p2/comments/k1": {"content": "Anaphase separates the chromatids"},
+    }
+    index = VectorIndex(FakeClient(store), HashEmbedder(), directory=str(tmp_path))
+
+    async def run():
+        await index.rebuild("c1")
+        return (await index.search("c1", "krebs cycle ATP", 4),
+                await index.search("c1", "oxidative phosphorylation mitochondria", 1))
+
+    hits, comment_hits = asyncio.run(run())
+
+    assert index.stats()["rebuilds"] == 1
+    assert hits[0]["source"] == "post:legacy"
+    assert {hit["source"] for hit in hits} == {"post:legacy", "comment:legacy/k0", "post:p2", "comment:p2/k1"}
+    assert comment_hits[0]["source"] == "comment:legacy/k0"
+    assert "Oxidative phosphorylation happens in the mitochondria" in comment_hits[0]["text"]
+
+
+def test_append_refreshes_index_age(tmp_path):
+    store = {"classes/c1/posts/p1": {"title": "Mitosis", "content": "Prophase comes first", "comment_count": 0}}
+    index = VectorIndex(FakeClient(store), HashEmbedder(), directory=str(tmp_path))
+
+    async def run():
+        await index.rebuild("c1")
+        class_index = await index._load("c1")
+        class_index.refreshed_at = 0.0
+        await index.add("c1", [("post:p2", "Post: Meiosis\nTwo divisions")])
+        return class_index
+
+    class_index = asyncio.run(run())
+
+    assert class_index.refreshed_at > 0
+    assert class_index.count == len(class_index.sources) == 2
+    with open(tmp_path / "c1" / "index.json") as f:
+        assert json.load(f)["refreshed_at"] == class_index.refreshed_at
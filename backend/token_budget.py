@@ -0,0 +1,67 @@
+"""Token estimation and token-aware chunking for prompts.
+
+Estimates use the ~4 characters per token rule of thumb for OpenAI's English
+tokenizers. That is close enough for budgeting and needs no tokenizer
+dependency; keep budgets a little below the model's real limits.
+"""
+import math
+import re
+from typing import List
+
+CHARS_PER_TOKEN = 4
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text or "") / CHARS_PER_TOKEN)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut `text` to roughly `max_tokens`, preferring a line break near the limit"""
+    limit = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    cut = text.rfind("\n", int(limit * 0.8), limit)
+    return text[:cut if cut != -1 else limit]
+
+
+def _split_oversized(unit: str, max_chars: int) -> List[str]:
+    """Break a paragraph bigger than one chunk into sentences, then hard slices"""
+    pieces = []
+    for sentence in _SENTENCE_END.split(unit):
+        while len(sentence) > max_chars:
+            pieces.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+        if sentence:
+            pieces.append(sentence)
+    return pieces
+
+
+def chunk_text(text: str, max_tokens: int) -> List[str]:
+    """Split text into chunks of at most ~max_tokens, on paragraph then sentence boundaries"""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    units = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) > max_chars:
+            units.extend(_split_oversized(paragraph, max_chars))
+        else:
+            units.append(paragraph)
+
+    chunks = []
+    current = []
+    current_len = 0
+    for unit in units:
+        added = len(unit) + (2 if current else 0)
+        if current and current_len + added > max_chars:
+            chunks.append("\n\n".join(current))
+            current, current_len = [], 0
+            added = len(unit)
+        current.append(unit)
+        current_len += added
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
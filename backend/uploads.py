@@ -0,0 +1,114 @@
+"""Bounded-memory handling of multipart uploads.
+
+Starlette already spools every multipart file part to a SpooledTemporaryFile
+(in memory up to 1 MB, on disk beyond that). This module keeps uploads there:
+sizes are measured by seeking, caps are enforced before anything is read, and
+base64 data URLs are built from fixed-size chunks rather than from one
+`file.read()` of the whole image. Oversized requests are turned away from their
+Content-Length before the body is parsed at all (see `check_request_size`).
+"""
+import base64
+import hashlib
+import io
+import os
+from typing import List
+
+from fastapi import HTTPException, UploadFile
+from starlette.concurrency import run_in_threadpool
+
+UPLOAD_MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", str(50 * 1024 * 1024)))
+# Multiple of 3 so each chunk encodes to base64 without padding in the middle of the stream
+UPLOAD_CHUNK_BYTES = 3 * 256 * 1024
+
+# Allowance for multipart boundaries, headers and form fields on top of the file bytes
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+def _measure(fileobj) -> int:
+    fileobj.seek(0, io.SEEK_END)
+    size = fileobj.tell()
+    fileobj.seek(0)
+    return size
+
+
+def _encode_base64(fileobj) -> str:
+    fileobj.seek(0)
+    parts = []
+    while True:
+        chunk = fileobj.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        parts.append(base64.b64encode(chunk).decode("ascii"))
+    fileobj.seek(0)
+    return "".join(parts)
+
+
+def _sha256(fileobj) -> str:
+    fileobj.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(UPLOAD_CHUNK_BYTES), b""):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+class SpooledUpload:
+    """An uploaded file that stays in Starlette's spool until a consumer needs it."""
+
+    def __init__(self, upload: UploadFile, size: int):
+        self.upload = upload
+        self.filename = upload.filename or ""
+        self.size = size
+
+    @property
+    def extension(self) -> str:
+        return self.filename.rsplit(".", 1)[-1].lower() if "." in self.filename else ""
+
+    async def read(self) -> bytes:
+        await self.upload.seek(0)
+        return await self.upload.read()
+
+    async def read_text(self, encoding: str = "utf-8") -> str:
+        return (await self.read()).decode(encoding)
+
+    async def sha256(self) -> str:
+        """Hex digest of the file, hashed chunk by chunk from the spool"""
+        return await run_in_threadpool(_sha256, self.upload.file)
+
+    async def data_url(self, mime_type: str) -> str:
+        """`data:` URL built by encoding the spooled file chunk by chunk"""
+        encoded = await run_in_threadpool(_encode_base64, self.upload.file)
+        return f"data:{mime_type};base64,{encoded}"
+
+    async def close(self):
+        await self.upload.close()
+
+
+async def spool_uploads(files: List[UploadFile]) -> List[SpooledUpload]:
+    """Measure each upload and enforce the per-file and per-request caps (413 on breach)"""
+    spooled = []
+    total = 0
+    for upload in files:
+        size = await run_in_threadpool(_measure, upload.file)
+        if size > UPLOAD_MAX_FILE_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"{upload.filename} is larger than {UPLOAD_MAX_FILE_BYTES // (1024 * 1024)} MB",
+            )
+        total += size
+        if total > UPLOAD_MAX_REQUEST_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Uploads exceed {UPLOAD_MAX_REQUEST_BYTES // (1024 * 1024)} MB per request",
+            )
+        spooled.append(SpooledUpload(upload, size))
+    return spooled
+
+
+def check_request_size(content_length) -> bool:
+    """False when a declared Content-Length cannot fit within the per-request cap"""
+    try:
+        return int(content_length) <= UPLOAD_MAX_REQUEST_BYTES + MULTIPART_OVERHEAD_BYTES
+    except (TypeError, ValueError):
+        return True
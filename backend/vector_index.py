@@ -0,0 +1,354 @@
+"""Per-class vector index over class posts, comments and note summaries.
+
+Each class has a directory under VECTOR_INDEX_DIR:
+
+    vectors.f32    float32 rows, one per chunk
+    chunks.jsonl   one {"source", "text"} line per row, read by offset on a hit
+    index.json     model id, dimension and committed row count
+
+Appends write vectors and chunk lines first and rewrite index.json last, so a
+crash mid-append leaves a tail beyond `count` that the next append truncates.
+Open indexes keep their vectors in memory (50k chunks at 256 dimensions is 50 MB)
+and search is a single matrix-vector product plus argpartition for the top k.
+Chunk text stays on disk and only the k hits are read back.
+
+Indexes are built incrementally: new posts, comments and note summaries are
+embedded and appended in the background by the instance that handled the write.
+A class without a local index is built from Firestore in the background;
+searches return nothing until that first build finishes. After that, a full
+rebuild (re-reading and re-embedding the whole class) happens only when the index
+has had no successful append for VECTOR_INDEX_MAX_AGE_SECONDS, which picks up
+writes handled by other instances. Set it to 0 to disable periodic rebuilds.
+"""
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from firebase_admin import firestore
+
+import token_budget
+from caches import TTLCache
+from class_context import may_have_comments
+
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", os.path.join(tempfile.gettempdir(), "vector_index"))
+VECTOR_INDEX_MAX_AGE_SECONDS = float(os.getenv("VECTOR_INDEX_MAX_AGE_SECONDS", "86400"))
+VECTOR_INDEX_OPEN_CLASSES = int(os.getenv("VECTOR_INDEX_OPEN_CLASSES", "64"))
+VECTOR_CHUNK_TOKENS = int(os.getenv("VECTOR_CHUNK_TOKENS", "200"))
+# Chunks embedded per call while building
+VECTOR_BUILD_BATCH = int(os.getenv("VECTOR_BUILD_BATCH", "256"))
+# Excerpts rendered into a study-buddy prompt
+VECTOR_EXCERPTS = int(os.getenv("VECTOR_EXCERPTS", "5"))
+VECTOR_EXCERPT_TOKENS = int(os.getenv("VECTOR_EXCERPT_TOKENS", "500"))
+VECTOR_MIN_SCORE = float(os.getenv("VECTOR_MIN_SCORE", "0.15"))
+
+Chunk = Tuple[str, str]  # (source, text)
+
+
+def _chunks(source: str, header: str, body: str) -> List[Chunk]:
+    return [(source, f"{header}\n{piece}" if header else piece)
+            for piece in token_budget.chunk_text(body, VECTOR_CHUNK_TOKENS)]
+
+
+def post_chunks(post_id: str, post: dict) -> List[Chunk]:
+    return _chunks(f"post:{post_id}", f"Post: {post.get('title', 'Untitled')}", post.get("content") or "")
+
+
+def comment_chunks(post_id: str, comment_id: str, content: str) -> List[Chunk]:
+    return _chunks(f"comment:{post_id}/{comment_id}", "Reply in the class discussion:", content or "")
+
+
+def summary_chunks(summary_id: str, summary: dict) -> List[Chunk]:
+    body = "\n".join(
+        [f"Key concepts: {', '.join(summary.get('key_concepts', []))}"] + list(summary.get("main_points", []))
+    )
+    return _chunks(f"summary:{summary_id}", f"Note summary: {summary.get('title', 'Study Notes')}", body)
+
+
+class ClassIndex:
+    """On-disk index of one class (blocking; call from an executor)"""
+
+    def __init__(self, directory: str, dim: int, model_id: str):
+        self.directory = directory
+        self.dim = dim
+        self.model_id = model_id
+        self.count = 0
+        # Last successful build or append; drives VECTOR_INDEX_MAX_AGE_SECONDS
+        self.refreshed_at = 0.0
+        self.sources = set()
+        self._offsets = np.zeros(1, dtype=np.int64)
+        # Rows [0, count) of an over-allocated buffer
+        self._buffer = np.zeros((0, dim), dtype=np.float32)
+        self._vectors = self._buffer
+        # Appends and searches run on executor threads; count, offsets and vectors change together
+        self._lock = threading.Lock()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def load(self) -> bool:
+        """Open an existing index; False when missing or built by another model"""
+        try:
+            with open(self._path("index.json")) as f:
+                header = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        if header.get("model_id") != self.model_id or header.get("dim") != self.dim:
+            return False
+
+        self.count = header["count"]
+        self.refreshed_at = header.get("refreshed_at", header.get("built_at", 0.0))
+        offsets = [0]
+        with open(self._path("chunks.jsonl"), "rb") as f:
+            for _ in range(self.count):
+                line = f.readline()
+                self.sources.add(json.loads(line)["source"])
+                offsets.append(offsets[-1] + len(line))
+        self._offsets = np.asarray(offsets, dtype=np.int64)
+        self._read_vectors()
+        return True
+
+    def _read_vectors(self):
+        if self.count:
+            self._buffer = np.fromfile(self._path("vectors.f32"), dtype=np.float32,
+                                       count=self.count * self.dim).reshape(self.count, self.dim)
+        else:
+            self._buffer = np.zeros((0, self.dim), dtype=np.float32)
+        self._vectors = self._buffer
+
+    def _store(self, vectors: np.ndarray) -> None:
+        """Copy appended rows into memory, growing the buffer geometrically so builds stay linear"""
+        start = len(self._vectors)
+        if start + len(vectors) > len(self._buffer):
+            grown = np.empty((max(start + len(vectors), 2 * len(self._buffer)), self.dim), dtype=np.float32)
+            grown[:start] = self._vectors
+            self._buffer = grown
+        self._buffer[start:start + len(vectors)] = vectors
+        self._vectors = self._buffer[:start + len(vectors)]
+
+    def append(self, chunks: List[Chunk], vectors: np.ndarray) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        vector_bytes = self.count * self.dim * 4
+        with open(self._path("vectors.f32"), "ab") as f:
+            f.truncate(vector_bytes)
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        lines = [(json.dumps({"source": source, "text": text}) + "\n").encode("utf-8") for source, text in chunks]
+        with open(self._path("chunks.jsonl"), "ab") as f:
+            f.truncate(int(self._offsets[-1]))
+            f.writelines(lines)
+
+        with self._lock:
+            self._offsets = np.concatenate([self._offsets, self._offsets[-1] + np.cumsum([len(line) for line in lines])])
+            self._store(np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim))
+            self.count += len(chunks)
+            self.sources.update(source for source, _ in chunks)
+            self.refreshed_at = time.time()
+        self.write_header()
+
+    def write_header(self):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self._path("index.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"model_id": self.model_id, "dim": self.dim, "count": self.count,
+                       "refreshed_at": self.refreshed_at}, f)
+        os.replace(tmp_path, self._path("index.json"))
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[float, int]]:
+        """(score, row) of the k most similar rows, best first"""
+        with self._lock:
+            vectors = self._vectors
+        if not len(vectors):
+            return []
+        scores = vectors @ query
+        k = min(k, len(vectors))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[row]), int(row)) for row in top]
+
+    def chunks(self, rows: List[int]) -> List[dict]:
+        with self._lock:
+            offsets = self._offsets
+        found = []
+        with open(self._path("chunks.jsonl"), "rb") as f:
+            for row in rows:
+                f.seek(int(offsets[row]))
+                found.append(json.loads(f.readline()))
+        return found
+
+
+class VectorIndex:
+    def __init__(self, client, embedder, directory: str = VECTOR_INDEX_DIR):
+        self._client = client
+        self._embedder = embedder
+        self._directory = directory
+        self._open = TTLCache("vector_index_open", maxsize=VECTOR_INDEX_OPEN_CLASSES)
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._building = set()
+        # Chunks appended while a rebuild runs, replayed into the new index after the swap
+        self._added_during_build: Dict[str, List[Chunk]] = {}
+        self._tasks = set()
+        self._stats = {"searches": 0, "empty": 0, "chunks_added": 0, "rebuilds": 0, "errors": 0}
+
+    def _class_dir(self, class_id: str) -> str:
+        return os.path.join(self._directory, class_id)
+
+    def _lock(self, class_id: str) -> asyncio.Lock:
+        return self._locks.setdefault(class_id, asyncio.Lock())
+
+    def _new_index(self, directory: str) -> ClassIndex:
+        return ClassIndex(directory, self._embedder.dim, self._embedder.model_id)
+
+    async def _load(self, class_id: str) -> Optional[ClassIndex]:
+        index = self._open.get(class_id)
+        if index is None:
+            index = self._new_index(self._class_dir(class_id))
+            loaded = await asyncio.get_running_loop().run_in_executor(None, index.load)
+            if not loaded:
+                return None
+            self._open.set(class_id, index)
+        return index
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def search(self, class_id: str, query: str, k: int) -> List[dict]:
+        """Top-k chunks ({source, text, score}) for `query`; schedules a build if the index is missing or old"""
+        self._stats["searches"] += 1
+        index = await self._load(class_id)
+        if index is None or (VECTOR_INDEX_MAX_AGE_SECONDS > 0
+                             and time.time() - index.refreshed_at > VECTOR_INDEX_MAX_AGE_SECONDS):
+            self.schedule_rebuild(class_id)
+        if index is None or not index.count:
+            self._stats["empty"] += 1
+            return []
+
+        query_vector = (await self._embedder.embed([query]))[0]
+
+        def run():
+            hits = index.search(query_vector, k)
+            return [{**chunk, "score": score} for (score, _), chunk in zip(hits, index.chunks([row for _, row in hits]))]
+
+        return await asyncio.get_running_loop().run_in_executor(None, run)
+
+    async def excerpts(self, class_id: str, question: str) -> str:
+        """Prompt block of the chunks most similar to the question, within VECTOR_EXCERPT_TOKENS"""
+        hits = [hit for hit in await self.search(class_id, question, VECTOR_EXCERPTS) if hit["score"] >= VECTOR_MIN_SCORE]
+        budget = VECTOR_EXCERPT_TOKENS
+        lines = []
+        for hit in hits:
+            cost = token_budget.estimate_tokens(hit["text"]) + 1
+            if cost > budget:
+                continue
+            lines.append(f"- {' '.join(hit['text'].split())}")
+            budget -= cost
+        return "\n".join(["Relevant excerpts from class material:"] + lines) if lines else ""
+
+    async def add(self, class_id: str, chunks: List[Chunk]) -> None:
+        """Embed and append chunks whose source is not indexed yet (no-op without a local index)"""
+        async with self._lock(class_id):
+            if class_id in self._added_during_build:
+                self._added_during_build[class_id].extend(chunks)
+            index = await self._load(class_id)
+            if index is None:
+                return
+            chunks = [chunk for chunk in chunks if chunk[0] not in index.sources]
+            if not chunks:
+                return
+            vectors = await self._embedder.embed([text for _, text in chunks])
+            await asyncio.get_running_loop().run_in_executor(None, index.append, chunks, vectors)
+            self._stats["chunks_added"] += len(chunks)
+
+    def schedule_add(self, class_id: str, chunks: List[Chunk]) -> None:
+        async def run():
+            try:
+                await self.add(class_id, chunks)
+            except Exception as e:
+                self._stats["errors"] += 1
+                print(f"⚠️ Vector index append failed for {class_id}: {e}")
+        if chunks:
+            self._spawn(run())
+
+    async def _class_chunks(self, class_id: str):
+        """Every chunk of a class, read from Firestore in batches"""
+        class_ref = self._client.collection("classes").document(class_id)
+        batch = []
+        async for post in class_ref.collection("posts").stream():
+            post_data = post.to_dict()
+            batch.extend(post_chunks(post.id, post_data))
+            if may_have_comments(post_data):
+                async for comment in post.reference.collection("comments").stream():
+                    batch.extend(comment_chunks(post.id, comment.id, comment.to_dict().get("content")))
+            if len(batch) >= VECTOR_BUILD_BATCH:
+                yield batch
+                batch = []
+        summaries = class_ref.collection("note_summaries").order_by("created_at", direction=firestore.Query.DESCENDING)
+        async for summary in summaries.stream():
+            batch.extend(summary_chunks(summary.id, summary.to_dict()))
+            if len(batch) >= VECTOR_BUILD_BATCH:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    async def rebuild(self, class_id: str) -> None:
+        """Build a fresh index beside the live one, then swap it in"""
+        loop = asyncio.get_running_loop()
+        class_dir = self._class_dir(class_id)
+        build_dir = f"{class_dir}.building"
+        self._added_during_build[class_id] = []
+        await loop.run_in_executor(None, shutil.rmtree, build_dir, True)
+        index = self._new_index(build_dir)
+        index.refreshed_at = time.time()
+        async for batch in self._class_chunks(class_id):
+            vectors = await self._embedder.embed([text for _, text in batch])
+            await loop.run_in_executor(None, index.append, batch, vectors)
+        await loop.run_in_executor(None, index.write_header)
+
+        async with self._lock(class_id):
+            def swap():
+                trash_dir = f"{class_dir}.old"
+                shutil.rmtree(trash_dir, ignore_errors=True)
+                if os.path.exists(class_dir):
+                    os.replace(class_dir, trash_dir)
+                os.replace(build_dir, class_dir)
+                shutil.rmtree(trash_dir, ignore_errors=True)
+            await loop.run_in_executor(None, swap)
+            index.directory = class_dir
+            self._open.set(class_id, index)
+
+            replay = [chunk for chunk in self._added_during_build.pop(class_id, []) if chunk[0] not in index.sources]
+            if replay:
+                vectors = await self._embedder.embed([text for _, text in replay])
+                await loop.run_in_executor(None, index.append, replay, vectors)
+        self._stats["rebuilds"] += 1
+
+    def schedule_rebuild(self, class_id: str) -> None:
+        if class_id in self._building:
+            return
+        self._building.add(class_id)
+
+        async def run():
+            try:
+                await self.rebuild(class_id)
+            except Exception as e:
+                self._stats["errors"] += 1
+                print(f"⚠️ Vector index build failed for {class_id}: {e}")
+            finally:
+                self._building.discard(class_id)
+                self._added_during_build.pop(class_id, None)
+        self._spawn(run())
+
+    async def drop(self, class_id: str) -> None:
+        async with self._lock(class_id):
+            self._open.pop(class_id)
+            await asyncio.get_running_loop().run_in_executor(None, shutil.rmtree, self._class_dir(class_id), True)
+
+    def stats(self) -> dict:
+        return {**self._stats, "open_indexes": len(self._open), "building": len(self._building)}